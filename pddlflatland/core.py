@@ -13,16 +13,25 @@ and current problem PDDL file to facilitate interaction with a planner.
 import gym
 from flatland.core.env_observation_builder import ObservationBuilder
 from flatland.envs.observations import GlobalObsForRailEnv
-from pddlflatland.inference import find_satisfying_assignments, check_goal
+from pddlflatland.inference import find_satisfying_assignments, check_goal, QueryPlan
+from pddlflatland.prolog_interface import PrologSession
 from pddlflatland.parser import PDDLDomainParser, PDDLProblemParser, PDDLParser
 from pddlflatland.inference import find_satisfying_assignments
-from pddlflatland.structs import ground_literal, Literal, State, ProbabilisticEffect, LiteralConjunction
-from pddlflatland.spaces import LiteralSpace, LiteralSetSpace, LiteralActionSpace
+from pddlflatland.structs import (ground_literal, Literal, FLiteral, State, ProbabilisticEffect, LiteralConjunction,
+                                  BitsetState, When, Assign)
+from pddlflatland.spaces import LiteralSpace, LiteralSetSpace, LiteralActionSpace, EnumeratedLiteralSpace
+from pddlflatland.pddl_writer import ProblemWriter
+from pddlflatland import pddl_cache
+from pddlflatland.lazy_problems import LazyProblems, parse_domain, parse_problem
+from pddlflatland.numeric import NumericFluents, ConditionalEffects, fluent_literal, get_split_preconds
+from pddlflatland.flatland_encoding import RailEnvEncoder, DIRECTION_OFFSETS, EXIT_MASKS
 # ---------------flatland--------------
 from flatland.envs.rail_env import RailEnv, RailEnvActions
 # ---------------functional-------------
 import pyperplan
 import functools
+import itertools
+from collections import Counter, defaultdict
 import glob
 import os
 import tempfile
@@ -37,24 +46,67 @@ class InvalidAction(Exception):
 
 
 def get_successor_state(state, action, domain, raise_error_on_invalid_action=False,
-                        inference_mode="infer", require_unique_assignment=True):
+                        inference_mode="infer", require_unique_assignment=True,
+                        prolog_session=None, return_delta=False):
     """
     Compute successor state using operators in the domain
     Parameters
     ----------
-    state : State
+    state : State or BitsetState
     action : Literal
     domain : PDDLDomain
     raise_error_on_invalid_action : bool
-    inference_mode : "csp" or "prolog" or "infer"
+    inference_mode : "csp" or "prolog" or "grounded" or "infer"
+        "grounded" looks up precomputed ground operators and falls
+        back to "infer" for operators that cannot be grounded. With
+        a BitsetState, "grounded" works on bit masks, except for
+        numeric preconditions and conditional effects.
     require_unique_assignment : bool
+    prolog_session : PrologSession or None
+        If given, "prolog" queries are answered by this session
+        instead of a new swipl process per query.
+    return_delta : bool
+        If True, also return the literals that were added and deleted.
     Returns
     -------
     next_state : State
+    added : { Literal }
+        Only if return_delta. Literals in next_state but not in state.
+    deleted : { Literal }
+        Only if return_delta. Literals in state but not in next_state.
     """
+    if inference_mode == "grounded":
+        groundable, ground_operator, masks = _select_ground_operator(
+            state, action, domain, require_unique_assignment=require_unique_assignment)
+        if groundable:
+            if ground_operator is None:
+                if raise_error_on_invalid_action:
+                    raise InvalidAction()
+                return (state, set(), set()) if return_delta else state
+            if not ground_operator.is_deterministic:
+                return _apply_effects(state, ground_operator.lifted_effects,
+                                      ground_operator.assignment,
+                                      return_delta=return_delta,
+                                      operator=ground_operator.operator)
+            if masks is not None:
+                next_state = state.apply(masks[2], masks[3])
+                if not return_delta:
+                    return next_state
+                return (next_state, state.table.decode(next_state.bits & ~state.bits),
+                        state.table.decode(state.bits & ~next_state.bits))
+            next_state = state.with_literals(ground_operator.apply(state.literals))
+            if not return_delta:
+                return next_state
+            added = ground_operator.add_effects - state.literals
+            deleted = (ground_operator.delete_effects & state.literals) - \
+                ground_operator.add_effects
+            return next_state, set(added), set(deleted)
+        inference_mode = "infer"
+
     selected_operator, assignment = _select_operator(state, action, domain,
                                                      inference_mode=inference_mode,
-                                                     require_unique_assignment=require_unique_assignment)
+                                                     require_unique_assignment=require_unique_assignment,
+                                                     prolog_session=prolog_session)
 
     # A ground operator was found; execute the ground effects
     if assignment is not None:
@@ -65,48 +117,85 @@ def get_successor_state(state, action, domain, raise_error_on_invalid_action=Fal
             assert isinstance(selected_operator.effects, Literal)
             effects = [selected_operator.effects]
 
-        state = _apply_effects(
+        return _apply_effects(
             state,
             effects,
             assignment,
+            return_delta=return_delta,
+            operator=selected_operator,
         )
 
     # No operator was found
     elif raise_error_on_invalid_action:
         raise InvalidAction()
 
-    return state
+    return (state, set(), set()) if return_delta else state
+
+
+def _select_ground_operator(state, action, domain, require_unique_assignment=True):
+    """
+    Helper for successor generation with inference_mode="grounded"
+    Returns
+    -------
+    groundable : bool
+        False if lifted inference must be used for this action.
+    ground_operator : GroundOperator or None
+    masks : (int, int, int, int) or None
+        For a BitsetState, the masks of ground_operator, see
+        GroundOperatorTable.select_bitset.
+    """
+    table = domain.ground_operator_table
+    if table.get_ground_operators(action, state.objects) is None:
+        return False, None, None
+    if isinstance(state, BitsetState):
+        ground_operator, masks = table.select_bitset(
+            state, action, require_unique_assignment=require_unique_assignment)
+        return True, ground_operator, masks
+    return True, table.select(state, action,
+                              require_unique_assignment=require_unique_assignment), None
 
 
 def _select_operator(state, action, domain, inference_mode="infer",
-                     require_unique_assignment=True):
+                     require_unique_assignment=True, prolog_session=None):
     """
     Helper for successor generation
     """
+    if inference_mode == "grounded":
+        groundable, ground_operator, _ = _select_ground_operator(
+            state, action, domain, require_unique_assignment=require_unique_assignment)
+        if groundable:
+            if ground_operator is None:
+                return None, None
+            return ground_operator.operator, ground_operator.assignment
+        inference_mode = "infer"
+
     if inference_mode == "infer":
-        inference_mode = "csp" if _check_domain_for_strips(domain) else "prolog"
-
-    if domain.operators_as_actions:
-        # There should be only one possible operator if actions are operators
-        possible_operators = set()
-        for name, operator in domain.operators.items():
-            if name.lower() == action.predicate.name.lower():
-                assert len(possible_operators) == 0
-                possible_operators.add(operator)
+        inference_mode = "csp" if _check_domain_for_csp(domain) else "prolog"
+
+    # Only one possible operator if actions are operators, otherwise the
+    # operators with the action among their preconditions
+    possible_operators = domain.get_action_operators(action.predicate)
+    if not possible_operators:
+        return None, None
+
+    # Knowledge base: literals in the state + action taken. The CSP
+    # checks numeric conditions with state.fluents instead of FLiterals
+    if inference_mode == "csp":
+        kb = {lit for lit in state.literals if isinstance(lit, Literal)} | {action}
     else:
-        # Possibly multiple operators per action
-        possible_operators = set(domain.operators.values())
-
-    # Knowledge base: literals in the state + action taken
-    kb = set(state.literals) | {action}
+        kb = set(state.literals) | {action}
 
     selected_operator = None
     assignment = None
     for operator in possible_operators:
-        if isinstance(operator.preconds, Literal):
-            conds = [operator.preconds]
-        else:
-            conds = operator.preconds.literals
+        numeric_condition = None
+        if inference_mode == "csp":
+            conds, numeric_condition = get_split_preconds(operator)
+        if inference_mode != "csp" or conds is None:
+            if isinstance(operator.preconds, Literal):
+                conds = [operator.preconds]
+            else:
+                conds = operator.preconds.literals
         # Necessary for binding the operator arguments to the variables
         if domain.operators_as_actions:
             conds = [action.predicate(*operator.params)] + conds
@@ -118,14 +207,31 @@ def _select_operator(state, action, domain, inference_mode="infer",
                 break
         if action_literal is None:
             continue
-        # For proving, consider action variable first
-        action_variables = action_literal.variables
-        variable_sort_fn = lambda v: (not v in action_variables, v)
-        assignments = find_satisfying_assignments(kb, conds,
-                                                  variable_sort_fn=variable_sort_fn,
-                                                  type_to_parent_types=domain.type_to_parent_types,
-                                                  constants=domain.constants,
-                                                  mode=inference_mode)
+        if inference_mode == "csp":
+            # The preconditions never change, so they are compiled once
+            if operator.query_plan is None:
+                operator.query_plan = QueryPlan(
+                    conds, constants=domain.constants,
+                    type_to_parent_types=domain.type_to_parent_types,
+                    predicate_counts=Counter(lit.predicate.name for lit in kb))
+            # All assignments of the literals are needed to check the
+            # numeric conditions
+            max_assignment_count = 2 if numeric_condition is None else 99999
+            assignments = find_satisfying_assignments(kb, conds,
+                                                      max_assignment_count=max_assignment_count,
+                                                      query_plan=operator.query_plan)
+            if numeric_condition is not None and assignments:
+                assignments = _filter_numeric_assignments(state, numeric_condition, assignments)
+        else:
+            # For proving, consider action variable first
+            action_variables = action_literal.variables
+            variable_sort_fn = lambda v: (not v in action_variables, v)
+            assignments = find_satisfying_assignments(kb, conds,
+                                                      variable_sort_fn=variable_sort_fn,
+                                                      type_to_parent_types=domain.type_to_parent_types,
+                                                      constants=domain.constants,
+                                                      mode=inference_mode,
+                                                      prolog_session=prolog_session)
         num_assignments = len(assignments)
         if num_assignments > 0:
             if require_unique_assignment:
@@ -137,6 +243,39 @@ def _select_operator(state, action, domain, inference_mode="infer",
     return selected_operator, assignment
 
 
+def _filter_numeric_assignments(state, numeric_condition, assignments):
+    """
+    Helper for _select_operator. Keep the assignments for which a
+    compiled numeric condition holds in state.fluents.
+    """
+    fluents = state.fluents
+    if fluents is None:
+        fluents = NumericFluents.from_literals(state.literals)
+    holds = numeric_condition(fluents, {var: [assignment[var] for assignment in assignments]
+                                        for var in numeric_condition.variables})
+    holds = np.broadcast_to(holds, (len(assignments),))
+    return [assignment for assignment, h in zip(assignments, holds) if h]
+
+
+def _check_domain_for_csp(domain):
+    """
+    Check whether the preconditions of all operators in a domain can be
+    proven by the CSP: STRIPS, up to numeric conditions on the variables
+    of the literals (see numeric.get_split_preconds)
+    """
+    for operator in domain.operators.values():
+        literals, numeric_condition = get_split_preconds(operator)
+        if literals is None:
+            return False
+        if numeric_condition is not None:
+            variables = {var for lit in literals for var in lit.variables}
+            if domain.operators_as_actions:
+                variables.update(operator.params)
+            if not set(numeric_condition.variables) <= variables:
+                return False
+    return True
+
+
 def _check_domain_for_strips(domain):
     """
     Check whether all operators in a domain are STRIPS
@@ -158,7 +297,7 @@ def _check_struct_for_strips(struct):
     return False
 
 
-def _apply_effects(state, lifted_effects, assignments):
+def _apply_effects(state, lifted_effects, assignments, return_delta=False, operator=None):
     """
     Update a state given lifted operator effects and
     assignments of variables to objects.
@@ -166,15 +305,23 @@ def _apply_effects(state, lifted_effects, assignments):
     ----------
     state : State
         The state on which the effects are applied.
-    lifted_effects : { Literal }
+    lifted_effects : { Literal or When or Assign }
     assignments : { TypedEntity : TypedEntity }
         Maps variables to objects.
+    return_delta : bool
+        If True, also return the sets of added and deleted literals.
+    operator : Operator or None
+        The operator of the effects. If given, its When and Assign
+        effects are compiled once into operator.conditional_effects.
     """
     new_literals = set(state.literals)
     determinized_lifted_effects = []
+    conditional_effects = []
     # Handle probabilistic effects.
     for lifted_effect in lifted_effects:
-        if isinstance(lifted_effect, ProbabilisticEffect):
+        if isinstance(lifted_effect, (When, Assign)):
+            conditional_effects.append(lifted_effect)
+        elif isinstance(lifted_effect, ProbabilisticEffect):
             chosen_effect = lifted_effect.sample()
             if chosen_effect == "NOCHANGE":
                 continue
@@ -186,6 +333,13 @@ def _apply_effects(state, lifted_effects, assignments):
         else:
             determinized_lifted_effects.append(lifted_effect)
 
+    # When conditions are evaluated against the state before the effects
+    conditional_add_effects, conditional_delete_effects, updates = set(), set(), {}
+    if conditional_effects:
+        compiled_effects = _get_conditional_effects(operator, conditional_effects)
+        conditional_add_effects, conditional_delete_effects, updates = \
+            compiled_effects.apply(state, assignments)
+
     for lifted_effect in determinized_lifted_effects:
         effect = ground_literal(lifted_effect, assignments)
         # Negative effect
@@ -193,11 +347,102 @@ def _apply_effects(state, lifted_effects, assignments):
             literal = effect.inverted_anti
             if literal in new_literals:
                 new_literals.remove(literal)
+    new_literals -= conditional_delete_effects
     for lifted_effect in determinized_lifted_effects:
         effect = ground_literal(lifted_effect, assignments)
         if not effect.is_anti:
             new_literals.add(effect)
-    return state.with_literals(new_literals)
+    new_literals |= conditional_add_effects
+
+    next_state = state
+    if updates:
+        next_state = state.with_fluents(_assign_fluents(state, new_literals, updates))
+    if return_delta:
+        old_literals = set(state.literals)
+        return (next_state.with_literals(new_literals), new_literals - old_literals,
+                old_literals - new_literals)
+    return next_state.with_literals(new_literals)
+
+
+def _get_conditional_effects(operator, effects):
+    """
+    Helper for _apply_effects
+    """
+    if operator is None:
+        return ConditionalEffects(effects)
+    if operator.conditional_effects is None:
+        operator.conditional_effects = ConditionalEffects(effects)
+    return operator.conditional_effects
+
+
+def _assign_fluents(state, new_literals, updates):
+    """
+    Helper for _apply_effects. Replace the function literals of the
+    assigned terms in new_literals and return the updated fluents.
+    """
+    fluents = state.fluents
+    if fluents is None:
+        fluents = NumericFluents.from_literals(state.literals)
+    for (name, objects), (function, value) in updates.items():
+        old_value = fluents.get(name, objects)
+        if not np.isnan(old_value):
+            old_literal = fluent_literal(function, objects, old_value)
+            if old_literal in new_literals:
+                new_literals.remove(old_literal)
+            else:
+                # The value was written differently, e.g. 1.0 for 1
+                new_literals.difference_update([
+                    lit for lit in new_literals if isinstance(lit, FLiteral) and
+                    lit.function.name == name and tuple(lit.variables) == objects])
+        new_literals.add(fluent_literal(function, objects, value))
+    return fluents.assign({term: value for term, (_, value) in updates.items()})
+
+
+def _draw_problem_index(problems, rng):
+    """
+    Helper for PDDLEnv.reset and PDDLFlatlandEnv.reset
+    """
+    if isinstance(problems, LazyProblems):
+        # Lets the problems of the next resets be parsed ahead
+        return problems.draw(rng)
+    return rng.choice(len(problems))
+
+
+def _load_pddl(domain_file, problem_dir, operators_as_actions, cache_dir, streaming=False,
+               lazy=False, prefetch=0):
+    """
+    Helper for PDDLEnv.load_pddl and PDDLFlatlandEnv.load_pddl
+    """
+    problem_files = sorted(glob.glob(os.path.join(problem_dir, "*.pddl")))
+    if lazy:
+        domain = None
+        if cache_dir is not None:
+            key = pddl_cache.get_cache_key(domain_file, [],
+                                           operators_as_actions=operators_as_actions, lazy=True)
+            domain = pddl_cache.load(key, cache_dir=cache_dir)
+        if domain is None:
+            domain = parse_domain(domain_file, operators_as_actions=operators_as_actions)
+            if cache_dir is not None:
+                pddl_cache.save(key, domain, cache_dir=cache_dir)
+        problems = LazyProblems(domain, domain_file, problem_files,
+                                operators_as_actions=operators_as_actions, streaming=streaming,
+                                cache_dir=cache_dir, prefetch=prefetch)
+        return domain, problems
+
+    if cache_dir is not None:
+        key = pddl_cache.get_cache_key(domain_file, problem_files,
+                                       operators_as_actions=operators_as_actions,
+                                       streaming=streaming)
+        cached = pddl_cache.load(key, cache_dir=cache_dir)
+        if cached is not None:
+            return cached
+
+    domain = parse_domain(domain_file, operators_as_actions=operators_as_actions)
+    problems = [parse_problem(problem_file, domain, streaming=streaming)
+                for problem_file in problem_files]
+    if cache_dir is not None:
+        pddl_cache.save(key, (domain, problems), cache_dir=cache_dir)
+    return domain, problems
 
 
 class PDDLEnv(gym.Env):
@@ -222,12 +467,34 @@ class PDDLEnv(gym.Env):
     dynamic_action_space : bool
         Let self.action_space dynamically change on each iteration to
         include only valid actions (must match operator preconditions).
+    inference_mode : "csp" or "prolog" or "grounded" or "infer"
+        How operators are matched against the state on each step.
+        "infer" uses "csp" for STRIPS domains and "prolog" otherwise.
+    persistent_prolog : bool
+        If True, Prolog queries are answered by one long-lived swipl
+        process (see PrologSession) instead of one process per query.
+    lazy_problems : bool
+        If True, each problem is parsed when reset first picks it
+        instead of all of them on construction, see LazyProblems.
+        self.problems is then a LazyProblems instead of a list, and
+        errors in a problem file are only raised by reset.
+    prefetch_problems : int
+        With lazy_problems, the number of problems following the one
+        picked to parse ahead in a process pool.
+    cache_dir : str or None
+        If given, parsed PDDL files are cached in this directory, see
+        load_pddl. Nothing is written to disk by default.
     """
 
     def __init__(self, domain_file, problem_dir, render=None, seed=0,
                  raise_error_on_invalid_action=False,
                  operators_as_actions=False,
-                 dynamic_action_space=False):
+                 dynamic_action_space=False,
+                 inference_mode="infer",
+                 persistent_prolog=False,
+                 lazy_problems=False,
+                 prefetch_problems=0,
+                 cache_dir=None):
         self._state = None
         self._domain_file = domain_file
         self._problem_dir = problem_dir
@@ -235,6 +502,11 @@ class PDDLEnv(gym.Env):
         self.seed(seed)
         self._raise_error_on_invalid_action = raise_error_on_invalid_action
         self.operators_as_actions = operators_as_actions
+        self._prolog_session = PrologSession() if persistent_prolog else None
+        # Derived facts of self._derived_model_state, see
+        # self._update_derived_literals
+        self._derived_model = None
+        self._derived_model_state = None
 
         # Set by self.fix_problem_index
         self._problem_index_fixed = False
@@ -243,11 +515,16 @@ class PDDLEnv(gym.Env):
 
         # Parse the PDDL files
         self.domain, self.problems = self.load_pddl(domain_file, problem_dir,
-                                                    operators_as_actions=self.operators_as_actions)
+                                                    operators_as_actions=self.operators_as_actions,
+                                                    cache_dir=cache_dir,
+                                                    lazy=lazy_problems,
+                                                    prefetch=prefetch_problems)
 
         # Determine if the domain is STRIPS
         self._domain_is_strips = _check_domain_for_strips(self.domain)
-        self._inference_mode = "csp" if self._domain_is_strips else "prolog"
+        if inference_mode == "infer":
+            inference_mode = "csp" if _check_domain_for_csp(self.domain) else "prolog"
+        self._inference_mode = inference_mode
 
         # Initialize action space with problem-independent components
         actions = list(self.domain.actions)
@@ -276,7 +553,9 @@ class PDDLEnv(gym.Env):
             type_to_parent_types=self.domain.type_to_parent_types)
 
     @staticmethod
-    def load_pddl(domain_file, problem_dir, operators_as_actions=False):
+    def load_pddl(domain_file, problem_dir, operators_as_actions=False,
+                  cache_dir=None, streaming=False, lazy=False,
+                  prefetch=0):
         """
         Parse domain and problem PDDL files.
         Parameters
@@ -287,21 +566,26 @@ class PDDLEnv(gym.Env):
             Path to a directory of PDDL problem files.
         operators_as_actions : bool
             See class docstirng.
+        cache_dir : str or None
+            Directory of the parsed files cache, see pddl_cache, e.g.
+            pddl_cache.DEFAULT_CACHE_DIR. If None, the files are always
+            parsed.
+        streaming : bool
+            If True, problem files are read incrementally instead of as a
+            whole, see PDDLProblemParser.parse_stream.
+        lazy : bool
+            If True, problems are parsed when they are first accessed,
+            see LazyProblems.
+        prefetch : int
+            With lazy, the number of problems following the one accessed
+            to parse ahead in a process pool.
         Returns
         -------
         domain : PDDLDomainParser
-        problems : [ PDDLProblemParser ]
-        """
-        domain = PDDLDomainParser(domain_file,
-                                  expect_action_preds=(not operators_as_actions),
-                                  operators_as_actions=operators_as_actions)
-        problems = []
-        problem_files = [f for f in glob.glob(os.path.join(problem_dir, "*.pddl"))]
-        for problem_file in sorted(problem_files):
-            problem = PDDLProblemParser(problem_file, domain.domain_name,
-                                        domain.types, domain.predicates, domain.actions, domain.constants)
-            problems.append(problem)
-        return domain, problems
+        problems : [ PDDLProblemParser ] or LazyProblems
+        """
+        return _load_pddl(domain_file, problem_dir, operators_as_actions, cache_dir,
+                          streaming=streaming, lazy=lazy, prefetch=prefetch)
 
     @property
     def observation_space(self):
@@ -346,12 +630,15 @@ class PDDLEnv(gym.Env):
             See self._get_debug_info()
         """
         if not self._problem_index_fixed:
-            self._problem_idx = self.rng.choice(len(self.problems))
+            self._problem_idx = _draw_problem_index(self.problems, self.rng)
         self._problem = self.problems[self._problem_idx]
 
         initial_state = State(frozenset(self._problem.initial_state),
                               frozenset(self._problem.objects),
                               self._problem.goal)
+        if self.domain.functions:
+            initial_state = initial_state.with_fluents(NumericFluents.from_literals(
+                initial_state.literals, base=self._problem.static_fluents))
         initial_state = self._handle_derived_literals(initial_state)
         self.set_state(initial_state)
 
@@ -393,22 +680,36 @@ class PDDLEnv(gym.Env):
         debug_info : dict
             See self._get_debug_info.
         """
-        state, reward, done, debug_info = self.sample_transition(action)
+        state, reward, done, debug_info, added, deleted = self._sample_transition(action)
+        if isinstance(self._action_space, LiteralActionSpace):
+            self._action_space.update_applicable(self._state, state, added, deleted)
         self.set_state(state)
         return state, reward, done, debug_info
 
     def sample_transition(self, action):
-        state = self._get_successor_state(self._state, action, self.domain,
-                                          inference_mode=self._inference_mode,
-                                          raise_error_on_invalid_action=self._raise_error_on_invalid_action)
-        state = self._handle_derived_literals(state)
+        state, reward, done, debug_info, _, _ = self._sample_transition(action)
+        return state, reward, done, debug_info
+
+    def _sample_transition(self, action):
+        """Like sample_transition, but also return the literals that were
+        added and deleted, including derived literals.
+        """
+        state, added, deleted = self._get_successor_state(
+            self._state, action, self.domain,
+            inference_mode=self._inference_mode,
+            raise_error_on_invalid_action=self._raise_error_on_invalid_action,
+            prolog_session=self._prolog_session,
+            return_delta=True)
+        state, derived_added, derived_deleted = self._update_derived_literals(
+            self._state, state, added, deleted)
 
         done = self._is_goal_reached(state)
 
         reward = self.extrinsic_reward(state, done)
         debug_info = self._get_debug_info()
 
-        return state, reward, done, debug_info
+        return (state, reward, done, debug_info, set(added) | derived_added,
+                set(deleted) | derived_deleted)
 
     def _get_successor_state(self, *args, **kwargs):
         """Separated out to allow for overrides in subclasses
@@ -427,17 +728,62 @@ class PDDLEnv(gym.Env):
         """
         Check if the terminal condition is met, i.e., the goal is reached.
         """
-        return check_goal(state, self._goal)
+        return check_goal(state, self._goal, prolog_session=self._prolog_session)
 
     def _action_valid_test(self, state, action):
         _, assignment = _select_operator(state, action, self.domain,
-                                         inference_mode=self._inference_mode)
+                                         inference_mode=self._inference_mode,
+                                         prolog_session=self._prolog_session)
         return assignment is not None
 
     def render(self, *args, **kwargs):
         if self._render:
             return self._render(self._state.literals, *args, **kwargs)
 
+    def close(self):
+        if self._prolog_session is not None:
+            self._prolog_session.close()
+        if isinstance(self.problems, LazyProblems):
+            self.problems.close()
+        super().close()
+
+    def _update_derived_literals(self, state, next_state, added, deleted):
+        """
+        Update the derived literals after a transition.
+        Parameters
+        ----------
+        state : State
+            The state before the transition, with derived literals.
+        next_state : State
+            The state after the transition, with outdated derived literals.
+        added : { Literal }
+            The base literals added by the transition.
+        deleted : { Literal }
+            The base literals deleted by the transition.
+        Returns
+        -------
+        next_state : State
+            With up to date derived literals.
+        derived_added : { Literal }
+        derived_deleted : { Literal }
+        """
+        evaluator = self.domain.derived_predicate_evaluator
+        if evaluator is not None and self._derived_model_state is state and \
+                (next_state.objects is state.objects or next_state.objects == state.objects):
+            derived_added, derived_deleted = evaluator.update(self._derived_model, added, deleted)
+            # Avoid rebuilding the literals (e.g. decoding a BitsetState)
+            # if no derived literal changed
+            if derived_added or derived_deleted:
+                next_state = next_state.with_literals(
+                    (next_state.literals - derived_deleted) | derived_added)
+            self._derived_model_state = next_state
+            return next_state, derived_added, derived_deleted
+        # Recompute from scratch
+        old_derived = {lit for lit in state.literals if lit.predicate.is_derived}
+        next_state = self._handle_derived_literals(next_state)
+        new_derived = {lit for lit in next_state.literals if lit.predicate.is_derived}
+        return next_state, new_derived - old_derived, old_derived - new_derived
+
     def _handle_derived_literals(self, state):
         # first remove any old derived literals since they're outdated
         to_remove = set()
@@ -445,6 +791,12 @@ class PDDLEnv(gym.Env):
             if lit.predicate.is_derived:
                 to_remove.add(lit)
         state = state.with_literals(state.literals - to_remove)
+        evaluator = self.domain.derived_predicate_evaluator
+        if evaluator is not None:
+            model = evaluator.create_model(state.literals, state.objects)
+            state = state.with_literals(state.literals | evaluator.derived_literals(model.db))
+            self._derived_model, self._derived_model_state = model, state
+            return state
         while True:  # loop, because derived predicates can be recursive
             new_derived_literals = set()
             for pred in self.domain.predicates.values():
@@ -455,7 +807,8 @@ class PDDLEnv(gym.Env):
                     type_to_parent_types=self.domain.type_to_parent_types,
                     constants=self.domain.constants,
                     mode="prolog",
-                    max_assignment_count=99999)
+                    max_assignment_count=99999,
+                    prolog_session=self._prolog_session)
                 for assignment in assignments:
                     objects = [assignment[param_type(param_name)]
                                for param_name, param_type in zip(pred.param_names, pred.var_types)]
@@ -470,6 +823,20 @@ class PDDLEnv(gym.Env):
 
 
 class PDDLFlatlandEnv(RailEnv):
+    """
+    A RailEnv whose states and actions are those of a PDDL domain.
+    See PDDLEnv for the PDDL parameters.
+    Parameters
+    ----------
+    encode_rail_env : bool
+        If True, reset encodes the rail and agents that the RailEnv
+        generated as the PDDL state (see RailEnvEncoder) instead of
+        loading a problem from problem_dir.
+    lazy_problems : bool
+    prefetch_problems : int
+    cache_dir : str or None
+        See PDDLEnv.
+    """
     def __init__(self, width,
                  height,
                  rail_generator,
@@ -482,6 +849,13 @@ class PDDLFlatlandEnv(RailEnv):
                  raise_error_on_invalid_action=False,
                  operators_as_actions=True,
                  dynamic_action_space=False,
+                 inference_mode="infer",
+                 persistent_prolog=False,
+                 seed=0,
+                 encode_rail_env=False,
+                 lazy_problems=False,
+                 prefetch_problems=0,
+                 cache_dir=None,
                  ):
         super(PDDLFlatlandEnv, self).__init__(width,
                                               height,
@@ -493,8 +867,14 @@ class PDDLFlatlandEnv(RailEnv):
         self._domain_file = domain_file
         self._problem_dir = problem_dir
         self._render = render
+        self.seed(seed)
         self._raise_error_on_invalid_action = raise_error_on_invalid_action
         self.operators_as_actions = operators_as_actions
+        self._prolog_session = PrologSession() if persistent_prolog else None
+        # Derived facts of self._derived_model_state, see
+        # self._update_derived_literals
+        self._derived_model = None
+        self._derived_model_state = None
 
         # Set by self.fix_problem_index
         self._problem_index_fixed = False
@@ -503,11 +883,26 @@ class PDDLFlatlandEnv(RailEnv):
 
         # Parse the PDDL files
         self.domain, self.problems = self.load_pddl(domain_file, problem_dir,
-                                                    operators_as_actions=self.operators_as_actions)
+                                                    operators_as_actions=self.operators_as_actions,
+                                                    cache_dir=cache_dir,
+                                                    lazy=lazy_problems,
+                                                    prefetch=prefetch_problems)
+        self.encoder = RailEnvEncoder(self.domain) if encode_rail_env else None
+        # Writes the states of an episode relative to its initial state,
+        # see self.write_problem
+        self._problem_writer = ProblemWriter(self.domain.domain_name)
+        self._problem_writer_base = None
+        # Set by self.reset: the initial state of the episode, and the
+        # literals added to and deleted from it up to self._delta_state
+        self._episode_base = None
+        self._base_delta = None
+        self._delta_state = None
 
         # Determine if the domain is STRIPS
         self._domain_is_strips = _check_domain_for_strips(self.domain)
-        self._inference_mode = "csp" if self._domain_is_strips else "prolog"
+        if inference_mode == "infer":
+            inference_mode = "csp" if _check_domain_for_csp(self.domain) else "prolog"
+        self._inference_mode = inference_mode
 
         # Initialize action space with problem-independent components
         actions = list(self.domain.actions)
@@ -520,14 +915,16 @@ class PDDLFlatlandEnv(RailEnv):
                     type_hierarchy=self.domain.type_hierarchy,
                     type_to_parent_types=self.domain.type_to_parent_types)
             else:
-                self._action_space = LiteralSpace(
-                    self.action_predicates, lit_valid_test=self._action_valid_test,
+                self._action_space = EnumeratedLiteralSpace(
+                    self.action_predicates, ground_literals_fn=self.ground_actions,
+                    lit_valid_test=self._action_valid_test,
                     type_hierarchy=self.domain.type_hierarchy,
                     type_to_parent_types=self.domain.type_to_parent_types)
 
         else:
-            self._action_space = LiteralSpace(self.action_predicates,
-                                              type_to_parent_types=self.domain.type_to_parent_types)
+            self._action_space = EnumeratedLiteralSpace(
+                self.action_predicates, ground_literals_fn=self.ground_actions,
+                type_to_parent_types=self.domain.type_to_parent_types)
 
         # Initialize observation space with problem-independent components
         self._observation_space = LiteralSetSpace(
@@ -536,7 +933,9 @@ class PDDLFlatlandEnv(RailEnv):
             type_to_parent_types=self.domain.type_to_parent_types)
 
     @staticmethod
-    def load_pddl(domain_file, problem_dir, operators_as_actions=False):
+    def load_pddl(domain_file, problem_dir, operators_as_actions=False,
+                  cache_dir=None, streaming=False, lazy=False,
+                  prefetch=0):
         """
         Parse domain and problem PDDL files.
         Parameters
@@ -547,21 +946,100 @@ class PDDLFlatlandEnv(RailEnv):
             Path to a directory of PDDL problem files.
         operators_as_actions : bool
             See class docstirng.
+        cache_dir : str or None
+            Directory of the parsed files cache, see pddl_cache, e.g.
+            pddl_cache.DEFAULT_CACHE_DIR. If None, the files are always
+            parsed.
+        streaming : bool
+            If True, problem files are read incrementally instead of as a
+            whole, see PDDLProblemParser.parse_stream.
+        lazy : bool
+            If True, problems are parsed when they are first accessed,
+            see LazyProblems.
+        prefetch : int
+            With lazy, the number of problems following the one accessed
+            to parse ahead in a process pool.
         Returns
         -------
         domain : PDDLDomainParser
-        problems : [ PDDLProblemParser ]
-        """
-        domain = PDDLDomainParser(domain_file,
-                                  expect_action_preds=(not operators_as_actions),
-                                  operators_as_actions=operators_as_actions)
-        problems = []
-        problem_files = [f for f in glob.glob(os.path.join(problem_dir, "*.pddl"))]
-        for problem_file in sorted(problem_files):
-            problem = PDDLProblemParser(problem_file, domain.domain_name,
-                                        domain.types, domain.predicates, domain.actions, domain.constants)
-            problems.append(problem)
-        return domain, problems
+        problems : [ PDDLProblemParser ] or LazyProblems
+        """
+        return _load_pddl(domain_file, problem_dir, operators_as_actions, cache_dir,
+                          streaming=streaming, lazy=lazy, prefetch=prefetch)
+
+    def ground_actions(self, state):
+        """
+        Ground the action predicates for the objects of a state.
+        Actions whose last two arguments are cells (the move operators)
+        are only grounded for pairs of cells that are 4-neighbours on
+        the rail grid and where the rail allows leaving the first cell
+        towards the second, see self._get_adjacent_cell_pairs. Other
+        actions are grounded for all objects of their argument types.
+        Parameters
+        ----------
+        state : State
+        Returns
+        -------
+        ground_actions : { Literal }
+        """
+        type_to_objs = defaultdict(list)
+        for obj in sorted(state.objects):
+            for t in self.domain.type_to_parent_types.get(obj.var_type, {obj.var_type}):
+                type_to_objs[t].append(obj)
+        cell_pairs = None
+        ground_actions = set()
+        for predicate in self.action_predicates:
+            if predicate.arity >= 2 and \
+                    predicate.var_types[-2] == predicate.var_types[-1] == "cell":
+                if cell_pairs is None:
+                    cell_pairs = self._get_adjacent_cell_pairs(state)
+                choices = [type_to_objs[vt] for vt in predicate.var_types[:-2]] + [cell_pairs]
+                choices = (choice[:-1] + choice[-1] for choice in itertools.product(*choices))
+            else:
+                choices = itertools.product(*[type_to_objs[vt] for vt in predicate.var_types])
+            for choice in choices:
+                if len(set(choice)) != len(choice):
+                    continue
+                ground_actions.add(predicate(*choice))
+        return ground_actions
+
+    def _get_adjacent_cell_pairs(self, state):
+        """
+        Get the pairs of cells between which an agent may move.
+        Cells are located on the rail grid by their position fluents,
+        numbered row by row from 1. If the rail has been generated, the
+        transition map must also allow leaving the first cell in the
+        direction of the second.
+        Parameters
+        ----------
+        state : State
+        Returns
+        -------
+        cell_pairs : [ (TypedEntity, TypedEntity) ]
+        """
+        index_to_cell = {}
+        for lit in state.literals:
+            if isinstance(lit, FLiteral) and lit.function.name == "position":
+                index_to_cell[int(lit.function.value) - 1] = lit.variables[0]
+        rail = getattr(self, "rail", None)
+        grid = None
+        if rail is not None and rail.grid.shape == (self.height, self.width):
+            grid = rail.grid
+        cell_pairs = []
+        for index, cell in sorted(index_to_cell.items()):
+            row, col = divmod(index, self.width)
+            for direction, (d_row, d_col) in enumerate(DIRECTION_OFFSETS):
+                next_row, next_col = row + d_row, col + d_col
+                if not (0 <= next_row < self.height and 0 <= next_col < self.width):
+                    continue
+                next_cell = index_to_cell.get(next_row * self.width + next_col)
+                if next_cell is None:
+                    continue
+                if grid is not None and \
+                        not int(grid[row, col]) & EXIT_MASKS[direction]:
+                    continue
+                cell_pairs.append((cell, next_cell))
+        return cell_pairs
 
     @property
     def observation_space(self):
@@ -577,6 +1055,9 @@ class PDDLFlatlandEnv(RailEnv):
     def get_state(self):
         return self._state
 
+    def seed(self, seed):
+        self._seed = seed
+        self.rng = np.random.RandomState(seed)
 
     def fix_problem_index(self, problem_idx):
         """
@@ -602,19 +1083,32 @@ class PDDLFlatlandEnv(RailEnv):
         debug_info : dict
             See self._get_debug_info()
         """
-        if not self._problem_index_fixed:
-            self._problem_idx = self.rng.choice(len(self.problems))
-        self._problem = self.problems[self._problem_idx]
+        if self.encoder is not None:
+            super(PDDLFlatlandEnv, self).reset()
+            self._problem = None
+            # BitsetStates share the static literals of the rail, so that
+            # steps take time proportional to the number of agents
+            initial_state = self.encoder.encode(self, compact=True)
+        else:
+            if not self._problem_index_fixed:
+                self._problem_idx = _draw_problem_index(self.problems, self.rng)
+            self._problem = self.problems[self._problem_idx]
+            initial_state = State(frozenset(self._problem.initial_state),
+                                  frozenset(self._problem.objects),
+                                  self._problem.goal)
+            if self.domain.functions:
+                initial_state = initial_state.with_fluents(NumericFluents.from_literals(
+                    initial_state.literals, base=self._problem.static_fluents))
 
-        initial_state = State(frozenset(self._problem.initial_state),
-                              frozenset(self._problem.objects),
-                              self._problem.goal)
         initial_state = self._handle_derived_literals(initial_state)
         self.set_state(initial_state)
+        self._episode_base = self._delta_state = initial_state
+        self._base_delta = (set(), set())
 
-        self._goal = self._problem.goal
+        self._goal = initial_state.goal
         debug_info = self._get_debug_info()
-        super(PDDLFlatlandEnv, self).reset()
+        if self.encoder is None:
+            super(PDDLFlatlandEnv, self).reset()
         return self.get_state(), debug_info
 
     def _get_debug_info(self):
@@ -622,7 +1116,7 @@ class PDDLFlatlandEnv(RailEnv):
         Contains the problem file and domain file
         for interaction with a planner.
         """
-        info = {'problem_file': self._problem.problem_fname,
+        info = {'problem_file': None if self._problem is None else self._problem.problem_fname,
                 'domain_file': self.domain.domain_fname}
         return info
 
@@ -636,9 +1130,13 @@ class PDDLFlatlandEnv(RailEnv):
         deterministic environments only. Once the operator
         is found, the ground effects are executed to update
         the state.
+        With encode_rail_env, the actions are instead decoded and taken
+        in the RailEnv, and the state is synchronized with the agents
+        that changed (see RailEnvEncoder.sync).
         Parameters
         ----------
-        action : Literal
+        action : Literal or [ Literal ]
+            A list of actions for several agents with encode_rail_env.
         Returns
         -------
         state : State
@@ -650,24 +1148,94 @@ class PDDLFlatlandEnv(RailEnv):
         debug_info : dict
             See self._get_debug_info.
         """
-        state, reward, done, debug_info = self.sample_transition(action)
+        if self.encoder is not None:
+            state, reward, done, debug_info, added, deleted = self._step_rail_env(action)
+        else:
+            state, reward, done, debug_info, added, deleted = self._sample_transition(action)
+        if isinstance(self._action_space, LiteralActionSpace):
+            self._action_space.update_applicable(self._state, state, added, deleted)
+        if self._delta_state is self._state:
+            self._update_base_delta(added, deleted)
+            self._delta_state = state
+        # Without the encoder, the RailEnv is not reset either and its
+        # agents do not take part in the episode
         self.set_state(state)
-        super(PDDLFlatlandEnv, self).setp()
         return state, reward, done, debug_info
 
-    def sample_transition(self, action):
-        state = self._get_successor_state(self._state, action, self.domain,
-                                          inference_mode=self._inference_mode,
-                                          raise_error_on_invalid_action=self._raise_error_on_invalid_action)
-        state = self._handle_derived_literals(state)
+    def write_problem(self, file_or_filepath):
+        """Write the current state as a PDDL problem, e.g. to replan with
+        an external planner. The first state of the episode is the base
+        of a ProblemWriter, so after a few steps mostly the literals that
+        changed since reset are formatted.
+        Parameters
+        ----------
+        file_or_filepath : file or str or int
+            See ProblemWriter.write.
+        """
+        if self._problem_writer_base is not self._episode_base:
+            self._problem_writer.set_base(self._episode_base.literals)
+            self._problem_writer_base = self._episode_base
+        # Unknown if the state was set directly
+        delta = self._base_delta if self._delta_state is self._state else None
+        self._problem_writer.write(file_or_filepath, self._state.objects, self._state.literals,
+                                   self._state.goal, delta=delta)
+
+    def _update_base_delta(self, added, deleted):
+        """Helper for step. See self.write_problem
+        """
+        base_added, base_deleted = self._base_delta
+        for lit in added:
+            if lit in base_deleted:
+                base_deleted.remove(lit)
+            else:
+                base_added.add(lit)
+        for lit in deleted:
+            if lit in base_added:
+                base_added.remove(lit)
+            else:
+                base_deleted.add(lit)
+
+    def _step_rail_env(self, action):
+        """Helper for step with encode_rail_env
+        """
+        actions = [action] if isinstance(action, Literal) else action
+        super(PDDLFlatlandEnv, self).step(self.encoder.decode_actions(actions))
+        state, added, deleted = self.encoder.sync(self, self._state)
+        state, derived_added, derived_deleted = self._update_derived_literals(
+            self._state, state, added, deleted)
 
         done = self._is_goal_reached(state)
 
         reward = self.extrinsic_reward(state, done)
         debug_info = self._get_debug_info()
 
+        return state, reward, done, debug_info, added | derived_added, deleted | derived_deleted
+
+    def sample_transition(self, action):
+        state, reward, done, debug_info, _, _ = self._sample_transition(action)
         return state, reward, done, debug_info
 
+    def _sample_transition(self, action):
+        """Like sample_transition, but also return the literals that were
+        added and deleted, including derived literals.
+        """
+        state, added, deleted = self._get_successor_state(
+            self._state, action, self.domain,
+            inference_mode=self._inference_mode,
+            raise_error_on_invalid_action=self._raise_error_on_invalid_action,
+            prolog_session=self._prolog_session,
+            return_delta=True)
+        state, derived_added, derived_deleted = self._update_derived_literals(
+            self._state, state, added, deleted)
+
+        done = self._is_goal_reached(state)
+
+        reward = self.extrinsic_reward(state, done)
+        debug_info = self._get_debug_info()
+
+        return (state, reward, done, debug_info, set(added) | derived_added,
+                set(deleted) | derived_deleted)
+
     def _get_successor_state(self, *args, **kwargs):
         """Separated out to allow for overrides in subclasses
         """
@@ -685,17 +1253,62 @@ class PDDLFlatlandEnv(RailEnv):
         """
         Check if the terminal condition is met, i.e., the goal is reached.
         """
-        return check_goal(state, self._goal)
+        return check_goal(state, self._goal, prolog_session=self._prolog_session)
 
     def _action_valid_test(self, state, action):
         _, assignment = _select_operator(state, action, self.domain,
-                                         inference_mode=self._inference_mode)
+                                         inference_mode=self._inference_mode,
+                                         prolog_session=self._prolog_session)
         return assignment is not None
 
     def render(self, *args, **kwargs):
         if self._render:
             return self._render(self._state.literals, *args, **kwargs)
 
+    def close(self):
+        if self._prolog_session is not None:
+            self._prolog_session.close()
+        if isinstance(self.problems, LazyProblems):
+            self.problems.close()
+        super(PDDLFlatlandEnv, self).close()
+
+    def _update_derived_literals(self, state, next_state, added, deleted):
+        """
+        Update the derived literals after a transition.
+        Parameters
+        ----------
+        state : State
+            The state before the transition, with derived literals.
+        next_state : State
+            The state after the transition, with outdated derived literals.
+        added : { Literal }
+            The base literals added by the transition.
+        deleted : { Literal }
+            The base literals deleted by the transition.
+        Returns
+        -------
+        next_state : State
+            With up to date derived literals.
+        derived_added : { Literal }
+        derived_deleted : { Literal }
+        """
+        evaluator = self.domain.derived_predicate_evaluator
+        if evaluator is not None and self._derived_model_state is state and \
+                (next_state.objects is state.objects or next_state.objects == state.objects):
+            derived_added, derived_deleted = evaluator.update(self._derived_model, added, deleted)
+            # Avoid rebuilding the literals (e.g. decoding a BitsetState)
+            # if no derived literal changed
+            if derived_added or derived_deleted:
+                next_state = next_state.with_literals(
+                    (next_state.literals - derived_deleted) | derived_added)
+            self._derived_model_state = next_state
+            return next_state, derived_added, derived_deleted
+        # Recompute from scratch
+        old_derived = {lit for lit in state.literals if lit.predicate.is_derived}
+        next_state = self._handle_derived_literals(next_state)
+        new_derived = {lit for lit in next_state.literals if lit.predicate.is_derived}
+        return next_state, new_derived - old_derived, old_derived - new_derived
+
     def _handle_derived_literals(self, state):
         # first remove any old derived literals since they're outdated
         to_remove = set()
@@ -703,6 +1316,12 @@ class PDDLFlatlandEnv(RailEnv):
             if lit.predicate.is_derived:
                 to_remove.add(lit)
         state = state.with_literals(state.literals - to_remove)
+        evaluator = self.domain.derived_predicate_evaluator
+        if evaluator is not None:
+            model = evaluator.create_model(state.literals, state.objects)
+            state = state.with_literals(state.literals | evaluator.derived_literals(model.db))
+            self._derived_model, self._derived_model_state = model, state
+            return state
         while True:  # loop, because derived predicates can be recursive
             new_derived_literals = set()
             for pred in self.domain.predicates.values():
@@ -713,7 +1332,8 @@ class PDDLFlatlandEnv(RailEnv):
                     type_to_parent_types=self.domain.type_to_parent_types,
                     constants=self.domain.constants,
                     mode="prolog",
-                    max_assignment_count=99999)
+                    max_assignment_count=99999,
+                    prolog_session=self._prolog_session)
                 for assignment in assignments:
                     objects = [assignment[param_type(param_name)]
                                for param_name, param_type in zip(pred.param_names, pred.var_types)]
@@ -0,0 +1,590 @@
+"""Bottom-up evaluation of derived predicates.
+
+The body of each DerivedPredicate is compiled once per domain into
+Datalog rules (one rule per disjunct of the body). The rules are
+stratified by negation and evaluated semi-naively: after the first
+round, each round only joins the facts that are new since the previous
+round, so recursive derived predicates cost time proportional to the
+number of new facts instead of recomputing everything on each round.
+
+Across steps, DatalogEvaluator.update maintains the derived facts of a
+state from the base literals added and deleted by an action, using
+delete-and-rederive (DRed) when no derived predicate is negated.
+"""
+from pddlflatland.structs import (Literal, LiteralConjunction, LiteralDisjunction,
+                                  Exists, TypedEntity)
+from collections import defaultdict
+import itertools
+
+
+class DatalogRule:
+    """A rule head :- pos_1, ..., pos_n, not neg_1, ..., not neg_m.
+
+    Variables are numbered; literals are stored as (predicate name,
+    args), where each arg is either an int variable slot or a constant
+    object. Variables that only occur in the head or in negative
+    literals are bound by enumerating the objects of their type.
+
+    Parameters
+    ----------
+    predicate : DerivedPredicate
+        The head predicate.
+    head_vars : [ TypedEntity ]
+    pos_literals : [ Literal ]
+    neg_literals : [ Literal ]
+        The positive versions of the negated body literals.
+    """
+
+    def __init__(self, predicate, head_vars, pos_literals, neg_literals):
+        self.predicate = predicate
+        self.variables = []
+        var_to_slot = {}
+
+        def compile_args(variables):
+            args = []
+            for v in variables:
+                if not _is_variable(v):
+                    args.append(v)
+                    continue
+                if v not in var_to_slot:
+                    var_to_slot[v] = len(self.variables)
+                    self.variables.append(v)
+                args.append(var_to_slot[v])
+            return tuple(args)
+
+        self.pos_literals = [(lit.predicate.name, compile_args(lit.variables))
+                             for lit in pos_literals]
+        self.neg_literals = [(lit.predicate.name, compile_args(lit.variables))
+                             for lit in neg_literals]
+        self.head = compile_args(head_vars)
+        # Slots that must be bound by enumerating objects of their type
+        bound_by_pos = {a for _, args in self.pos_literals for a in args if isinstance(a, int)}
+        self.free_slots = [i for i in range(len(self.variables)) if i not in bound_by_pos]
+        self._plans = {}
+
+    @property
+    def body_predicates(self):
+        return {name for name, _ in self.pos_literals}
+
+    @property
+    def negated_predicates(self):
+        return {name for name, _ in self.neg_literals}
+
+    def get_plan(self, seed=None, head_bound=False):
+        """Get (and cache) the join order for this rule.
+
+        Parameters
+        ----------
+        seed : (str, int) or None
+            ("pos", i) or ("neg", i) if that body literal is iterated
+            over an explicit set of seed tuples; it is placed first.
+        head_bound : bool
+            Whether the head variables are bound before the join.
+
+        Returns
+        -------
+        plan : [ (str, int) ]
+            Steps ("pos", i), ("neg", i) or ("type", slot).
+        """
+        key = (seed, head_bound)
+        if key in self._plans:
+            return self._plans[key]
+        bound = set()
+        if head_bound:
+            bound.update(a for a in self.head if isinstance(a, int))
+        plan = []
+        remaining_pos = set(range(len(self.pos_literals)))
+        remaining_neg = set(range(len(self.neg_literals)))
+        if seed is not None:
+            plan.append(seed)
+            kind, i = seed
+            literals = self.pos_literals if kind == "pos" else self.neg_literals
+            (remaining_pos if kind == "pos" else remaining_neg).discard(i)
+            bound.update(a for a in literals[i][1] if isinstance(a, int))
+        while remaining_pos or remaining_neg:
+            # Negative literals are checked as soon as they are fully bound
+            ready_neg = [i for i in sorted(remaining_neg)
+                         if all(a in bound for a in self.neg_literals[i][1]
+                                if isinstance(a, int))]
+            if ready_neg:
+                plan.append(("neg", ready_neg[0]))
+                remaining_neg.remove(ready_neg[0])
+                continue
+            if remaining_pos:
+                # Prefer the positive literal with the most bound arguments
+                def num_bound(i):
+                    args = self.pos_literals[i][1]
+                    return (sum(1 for a in args if not isinstance(a, int) or a in bound),
+                            -len(args))
+                i = max(sorted(remaining_pos), key=num_bound)
+                plan.append(("pos", i))
+                remaining_pos.remove(i)
+                bound.update(a for a in self.pos_literals[i][1] if isinstance(a, int))
+                continue
+            # Bind a variable of a remaining negative literal by type
+            slot = min(a for i in remaining_neg for a in self.neg_literals[i][1]
+                       if isinstance(a, int) and a not in bound)
+            plan.append(("type", slot))
+            bound.add(slot)
+        for slot in self.free_slots:
+            if slot not in bound:
+                plan.append(("type", slot))
+                bound.add(slot)
+        self._plans[key] = plan
+        return plan
+
+
+class FactDatabase:
+    """Sets of ground tuples per predicate name, with hash indexes on
+    argument positions that are built on demand and then maintained
+    incrementally.
+    """
+
+    def __init__(self):
+        self.facts = defaultdict(set)
+        self._indexes = defaultdict(dict)  # pred name -> positions -> key -> set
+
+    def __contains__(self, fact):
+        name, args = fact
+        return args in self.facts[name]
+
+    def add(self, name, args):
+        facts = self.facts[name]
+        if args in facts:
+            return False
+        facts.add(args)
+        for positions, index in self._indexes[name].items():
+            key = tuple(args[p] for p in positions)
+            index.setdefault(key, set()).add(args)
+        return True
+
+    def remove(self, name, args):
+        facts = self.facts[name]
+        if args not in facts:
+            return False
+        facts.remove(args)
+        for positions, index in self._indexes[name].items():
+            key = tuple(args[p] for p in positions)
+            index[key].discard(args)
+        return True
+
+    def lookup(self, name, positions, key):
+        """All tuples of a predicate whose args at positions equal key.
+        """
+        if not positions:
+            return self.facts[name]
+        indexes = self._indexes[name]
+        if positions not in indexes:
+            index = {}
+            for args in self.facts[name]:
+                index.setdefault(tuple(args[p] for p in positions), set()).add(args)
+            indexes[positions] = index
+        return indexes[positions].get(key, ())
+
+
+class DatalogModel:
+    """The facts of one state: base facts plus the derived facts that
+    follow from them. Kept up to date by DatalogEvaluator.update.
+
+    Parameters
+    ----------
+    db : FactDatabase
+    objects : frozenset
+    type_to_objs : { Type : [ TypedEntity ] }
+    """
+
+    def __init__(self, db, objects, type_to_objs):
+        self.db = db
+        self.objects = objects
+        self.type_to_objs = type_to_objs
+
+
+class DatalogEvaluator:
+    """Evaluates the derived predicates of a domain bottom-up.
+
+    Parameters
+    ----------
+    domain : PDDLDomain
+
+    Raises
+    ------
+    NotImplementedError
+        If some derived predicate body cannot be compiled into
+        stratified Datalog rules (e.g. it contains a ForAll).
+    """
+
+    def __init__(self, domain):
+        self.domain = domain
+        self._type_to_parent_types = domain.type_to_parent_types
+        self.derived_predicates = {p.name: p for p in domain.predicates.values()
+                                   if p.is_derived}
+        self.rules = []
+        for pred in self.derived_predicates.values():
+            head_vars = [param_type(param_name) for param_name, param_type
+                         in zip(pred.param_names, pred.var_types)]
+            for conjunct in _to_dnf(pred.body, itertools.count()):
+                pos_literals = [lit for lit in conjunct if not lit.is_negative]
+                neg_literals = [lit.positive for lit in conjunct if lit.is_negative]
+                self.rules.append(DatalogRule(pred, head_vars, pos_literals, neg_literals))
+        self.strata = self._stratify()
+
+    def _stratify(self):
+        """Group rules into strata so that negated derived predicates are
+        fully computed before they are used.
+        """
+        stratum = {name: 0 for name in self.derived_predicates}
+        for _ in range(len(stratum) + 1):
+            changed = False
+            for rule in self.rules:
+                head = rule.predicate.name
+                level = stratum[head]
+                for name in rule.body_predicates & stratum.keys():
+                    level = max(level, stratum[name])
+                for name in rule.negated_predicates & stratum.keys():
+                    level = max(level, stratum[name] + 1)
+                if level != stratum[head]:
+                    stratum[head] = level
+                    changed = True
+            if not changed:
+                break
+        else:
+            raise NotImplementedError("Derived predicates are not stratified")
+        strata = defaultdict(list)
+        for rule in self.rules:
+            strata[stratum[rule.predicate.name]].append(rule)
+        return [strata[level] for level in sorted(strata)]
+
+    def evaluate(self, literals, objects):
+        """Compute all derived literals that hold given the base literals.
+
+        Parameters
+        ----------
+        literals : { Literal }
+            Ground base literals; derived literals are ignored.
+        objects : { TypedEntity }
+
+        Returns
+        -------
+        derived_literals : { Literal }
+        """
+        return self.derived_literals(self.create_model(literals, objects).db)
+
+    def create_model(self, literals, objects):
+        """Evaluate the derived predicates from scratch.
+
+        Returns
+        -------
+        model : DatalogModel
+            Can be passed to self.update to maintain the derived
+            literals incrementally.
+        """
+        model = DatalogModel(self.create_database(literals), objects,
+                             self._organize_objects(objects))
+        for rules in self.strata:
+            self._evaluate_stratum(rules, model.db, model.type_to_objs)
+        return model
+
+    def update(self, model, added, deleted):
+        """Update a model after base literals were added and deleted.
+
+        If no derived predicate is negated, this uses delete-and-rederive
+        so that the cost scales with the size of the change. Otherwise the
+        derived predicates are recomputed and diffed.
+
+        Parameters
+        ----------
+        model : DatalogModel
+            Modified in place.
+        added : { Literal }
+            Base literals that were false and are now true.
+        deleted : { Literal }
+            Base literals that were true and are now false.
+
+        Returns
+        -------
+        derived_added : { Literal }
+        derived_deleted : { Literal }
+        """
+        added = self._to_facts(lit for lit in added if lit not in deleted)
+        deleted = self._to_facts(lit for lit in deleted)
+        if self.is_incremental:
+            derived_added, derived_deleted = self._delete_and_rederive(model, added, deleted)
+        else:
+            derived_added, derived_deleted = self._recompute(model, added, deleted)
+        return (self._to_literals(derived_added), self._to_literals(derived_deleted))
+
+    @property
+    def is_incremental(self):
+        """Whether self.update can use delete-and-rederive.
+        """
+        return not any(rule.negated_predicates & self.derived_predicates.keys()
+                       for rule in self.rules)
+
+    def _delete_and_rederive(self, model, added, deleted):
+        db, type_to_objs = model.db, model.type_to_objs
+        # Over-delete: everything with a derivation in the old database that
+        # uses a deleted fact, or negates an added fact
+        overdeleted = defaultdict(set)
+        frontier = deleted
+        neg_seeds = added
+        while frontier or neg_seeds:
+            new_frontier = defaultdict(set)
+            for rule in self.rules:
+                head = rule.predicate.name
+                seeds = [(("pos", i), frontier.get(name))
+                         for i, (name, _) in enumerate(rule.pos_literals)]
+                seeds += [(("neg", i), neg_seeds.get(name))
+                          for i, (name, _) in enumerate(rule.neg_literals)]
+                for seed, seed_tuples in seeds:
+                    if not seed_tuples:
+                        continue
+                    for args in self.join(rule, db, type_to_objs, seed=seed,
+                                          seed_tuples=seed_tuples):
+                        if args not in overdeleted[head]:
+                            overdeleted[head].add(args)
+                            new_frontier[head].add(args)
+            frontier, neg_seeds = new_frontier, {}
+        # Apply the changes to the base and over-deleted facts
+        for name, facts in deleted.items():
+            for args in facts:
+                db.remove(name, args)
+        for name, facts in added.items():
+            for args in facts:
+                db.add(name, args)
+        for name, facts in overdeleted.items():
+            for args in facts:
+                db.remove(name, args)
+        # Rederive over-deleted facts that still have a derivation
+        delta = defaultdict(set)
+        for rule in self.rules:
+            head = rule.predicate.name
+            for args in list(overdeleted.get(head, ())):
+                if args in delta[head]:
+                    continue
+                for _ in self.join(rule, db, type_to_objs, head=args):
+                    db.add(head, args)
+                    delta[head].add(args)
+                    break
+        # Insert: everything with a derivation that uses an added fact, or
+        # negates a deleted fact, then propagate
+        for rule in self.rules:
+            head = rule.predicate.name
+            seeds = [(("pos", i), added.get(name))
+                     for i, (name, _) in enumerate(rule.pos_literals)]
+            seeds += [(("neg", i), deleted.get(name))
+                      for i, (name, _) in enumerate(rule.neg_literals)]
+            for seed, seed_tuples in seeds:
+                if not seed_tuples:
+                    continue
+                for args in self.join(rule, db, type_to_objs, seed=seed,
+                                      seed_tuples=seed_tuples):
+                    if db.add(head, args):
+                        delta[head].add(args)
+        inserted = self._evaluate_stratum(self.rules, db, type_to_objs, delta=delta)
+        derived_added = {(name, args) for name, facts in inserted.items()
+                         for args in facts if args not in overdeleted.get(name, ())}
+        derived_deleted = {(name, args) for name, facts in overdeleted.items()
+                           for args in facts if args not in db.facts[name]}
+        return derived_added, derived_deleted
+
+    def _recompute(self, model, added, deleted):
+        db = model.db
+        old_derived = {(name, args) for name in self.derived_predicates
+                       for args in db.facts[name]}
+        for name, args in old_derived:
+            db.remove(name, args)
+        for name, facts in deleted.items():
+            for args in facts:
+                db.remove(name, args)
+        for name, facts in added.items():
+            for args in facts:
+                db.add(name, args)
+        for rules in self.strata:
+            self._evaluate_stratum(rules, db, model.type_to_objs)
+        new_derived = {(name, args) for name in self.derived_predicates
+                       for args in db.facts[name]}
+        return new_derived - old_derived, old_derived - new_derived
+
+    def _to_facts(self, literals):
+        facts = defaultdict(set)
+        for lit in literals:
+            if not isinstance(lit, Literal) or lit.predicate.is_derived:
+                continue
+            facts[lit.predicate.name].add(tuple(lit.variables))
+        return facts
+
+    def _to_literals(self, facts):
+        return {self.derived_predicates[name](*args) for name, args in facts}
+
+    def create_database(self, literals):
+        db = FactDatabase()
+        for name, facts in self._to_facts(literals).items():
+            for args in facts:
+                db.add(name, args)
+        return db
+
+    def derived_literals(self, db):
+        derived_literals = set()
+        for name, pred in self.derived_predicates.items():
+            for args in db.facts[name]:
+                derived_literals.add(pred(*args))
+        return derived_literals
+
+    def _organize_objects(self, objects):
+        type_to_objs = defaultdict(list)
+        for obj in sorted(objects):
+            for t in self._type_to_parent_types.get(obj.var_type, {obj.var_type}):
+                type_to_objs[t].append(obj)
+        return type_to_objs
+
+    def _evaluate_stratum(self, rules, db, type_to_objs, delta=None):
+        """Semi-naive fixpoint over the rules of one stratum.
+
+        Parameters
+        ----------
+        delta : { str : { tuple } } or None
+            Facts already added to db that have not been joined yet. If
+            None, the first round evaluates every rule on all of db.
+
+        Returns
+        -------
+        inserted : { str : { tuple } }
+            All facts added to db, including the initial delta.
+        """
+        heads = {rule.predicate.name for rule in rules}
+        if delta is None:
+            delta = defaultdict(set)
+            for rule in rules:
+                for args in self.join(rule, db, type_to_objs):
+                    if db.add(rule.predicate.name, args):
+                        delta[rule.predicate.name].add(args)
+        inserted = defaultdict(set)
+        while any(delta.values()):
+            for name, facts in delta.items():
+                inserted[name].update(facts)
+            new_delta = defaultdict(set)
+            for rule in rules:
+                for i, (name, _) in enumerate(rule.pos_literals):
+                    if name not in heads or not delta.get(name):
+                        continue
+                    for args in self.join(rule, db, type_to_objs, seed=("pos", i),
+                                          seed_tuples=delta[name]):
+                        if db.add(rule.predicate.name, args):
+                            new_delta[rule.predicate.name].add(args)
+            delta = new_delta
+        return inserted
+
+    def join(self, rule, db, type_to_objs, seed=None, seed_tuples=None, head=None):
+        """Yield the head tuples of all groundings of a rule whose body
+        holds in db.
+
+        Parameters
+        ----------
+        seed : (str, int) or None
+            Body literal that ranges over seed_tuples instead of db. A
+            negative seed literal is not checked against db.
+        head : tuple or None
+            If given, only groundings with this head are considered.
+        """
+        plan = rule.get_plan(seed=seed, head_bound=head is not None)
+        binding = [None] * len(rule.variables)
+        if head is not None:
+            for a, obj in zip(rule.head, head):
+                if isinstance(a, int):
+                    if binding[a] is not None and binding[a] != obj:
+                        return
+                    if not self._has_type(obj, rule.variables[a]):
+                        return
+                    binding[a] = obj
+                elif a != obj:
+                    return
+        yield from self._join(rule, plan, 0, binding, db, type_to_objs, seed_tuples)
+
+    def _join(self, rule, plan, step_idx, binding, db, type_to_objs, seed_tuples):
+        if step_idx == len(plan):
+            yield tuple(binding[a] if isinstance(a, int) else a for a in rule.head)
+            return
+        kind, i = plan[step_idx]
+        if kind == "type":
+            for obj in type_to_objs[rule.variables[i].var_type]:
+                binding[i] = obj
+                yield from self._join(rule, plan, step_idx + 1, binding, db,
+                                      type_to_objs, seed_tuples)
+            binding[i] = None
+            return
+        name, args = (rule.pos_literals if kind == "pos" else rule.neg_literals)[i]
+        is_seed = step_idx == 0 and seed_tuples is not None
+        if kind == "neg" and not is_seed:
+            ground = tuple(binding[a] if isinstance(a, int) else a for a in args)
+            if ground not in db.facts[name]:
+                yield from self._join(rule, plan, step_idx + 1, binding, db,
+                                      type_to_objs, seed_tuples)
+            return
+        if is_seed:
+            candidates = seed_tuples
+        else:
+            positions, key = [], []
+            for p, a in enumerate(args):
+                if not isinstance(a, int):
+                    positions.append(p)
+                    key.append(a)
+                elif binding[a] is not None:
+                    positions.append(p)
+                    key.append(binding[a])
+            candidates = db.lookup(name, tuple(positions), tuple(key))
+        for candidate in list(candidates):
+            newly_bound = []
+            consistent = True
+            for a, obj in zip(args, candidate):
+                if not isinstance(a, int):
+                    if a != obj:
+                        consistent = False
+                        break
+                elif binding[a] is None:
+                    if not self._has_type(obj, rule.variables[a]):
+                        consistent = False
+                        break
+                    binding[a] = obj
+                    newly_bound.append(a)
+                elif binding[a] != obj:
+                    consistent = False
+                    break
+            if consistent:
+                yield from self._join(rule, plan, step_idx + 1, binding, db,
+                                      type_to_objs, seed_tuples)
+            for a in newly_bound:
+                binding[a] = None
+
+    def _has_type(self, obj, variable):
+        return variable.var_type in self._type_to_parent_types.get(obj.var_type, {obj.var_type})
+
+
+def _is_variable(v):
+    return v.startswith("?")
+
+
+def _to_dnf(cond, counter, renaming=None):
+    """Convert a derived predicate body into a list of conjunctions
+    (lists of possibly negative Literals). Existentially quantified
+    variables are renamed apart.
+    """
+    renaming = renaming or {}
+    if isinstance(cond, Literal):
+        if cond.negated_as_failure or cond.is_anti:
+            raise NotImplementedError("Unsupported literal in derived predicate: {}".format(cond))
+        variables = [renaming.get(v, v) for v in cond.variables]
+        return [[cond.predicate(*variables)]]
+    if isinstance(cond, LiteralConjunction):
+        conjunctions = [[]]
+        for sub_cond in cond.literals:
+            sub_dnf = _to_dnf(sub_cond, counter, renaming)
+            conjunctions = [c1 + c2 for c1 in conjunctions for c2 in sub_dnf]
+        return conjunctions
+    if isinstance(cond, LiteralDisjunction):
+        return [c for sub_cond in cond.literals for c in _to_dnf(sub_cond, counter, renaming)]
+    if isinstance(cond, Exists):
+        renaming = dict(renaming)
+        for v in cond.variables:
+            renaming[v] = TypedEntity("{}-{}".format(v.name, next(counter)), v.var_type)
+        return _to_dnf(cond.body, counter, renaming)
+    raise NotImplementedError("Unsupported construct in derived predicate: {}".format(cond))
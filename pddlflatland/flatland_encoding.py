@@ -0,0 +1,333 @@
+"""Encode Flatland RailEnvs as PDDL states of the flatland domain.
+
+The encoder builds the State of a RailEnv straight from its rail grid and
+agents, so maps produced by a rail generator can be used without writing
+and parsing a PDDL problem file. See pddl/flatland.pddl for the domain:
+
+- cells are numbered row by row from 1 by the position fluent;
+- the transition fluent of a cell is one of the codes in
+  TRANSITION_CODES, each of which allows one turn (or going straight)
+  for one direction of travel;
+- directions are 0, 1, 2, 3 for north, east, south, west, as in Flatland.
+
+Since the domain gives a cell a single transition code, cells with
+several transitions (curves travelled both ways, switches, crossings)
+are encoded with the transition of the agent on them, or else the first
+allowed one in TRANSITION_CODES order.
+"""
+from pddlflatland.structs import State, BitsetState, AtomTable, LiteralConjunction, FLiteral
+from pddlflatland.numeric import NumericFluents, fluent_literal
+from flatland.envs.rail_env import RailEnvActions
+
+import numpy as np
+
+
+# Row and column offsets of the Flatland directions N, E, S, W
+DIRECTION_OFFSETS = ((-1, 0), (0, 1), (1, 0), (0, -1))
+# Bits of a Flatland cell transition that allow leaving the cell in each
+# direction, for any direction the agent is facing
+EXIT_MASKS = tuple(sum(1 << ((3 - orientation) * 4 + 3 - direction)
+                       for orientation in range(4))
+                   for direction in range(4))
+# (direction faced, exit direction) -> transition code of the domain, in
+# order of preference: straight, left, right
+TRANSITION_CODES = {
+    (0, 0): 1, (2, 2): 1, (1, 1): 2, (3, 3): 2,
+    (0, 3): 7, (1, 0): 8, (2, 1): 9, (3, 2): 10,
+    (2, 3): 11, (1, 2): 12, (0, 1): 13, (3, 0): 14,
+}
+# Values of the status of Flatland agents (RailAgentStatus)
+DONE, DONE_REMOVED = 2, 3
+# Operator name -> RailEnvActions
+ACTIONS = {
+    "move-forward": RailEnvActions.MOVE_FORWARD,
+    "move-left": RailEnvActions.MOVE_LEFT,
+    "move-right": RailEnvActions.MOVE_RIGHT,
+    "stop": RailEnvActions.STOP_MOVING,
+}
+
+
+def encode_transitions(grid):
+    """Get the transition code of every cell of a rail grid.
+
+    Parameters
+    ----------
+    grid : np.ndarray
+        (height, width) array of 16 bit Flatland cell transitions.
+
+    Returns
+    -------
+    codes : np.ndarray
+        (height, width) int array; 0 where there is no rail.
+    """
+    grid = np.asarray(grid, dtype=np.int64)
+    codes = np.zeros(grid.shape, dtype=np.int64)
+    # Write the least preferred codes first
+    for (orientation, direction), code in reversed(list(TRANSITION_CODES.items())):
+        bit = (grid >> ((3 - orientation) * 4 + 3 - direction)) & 1
+        codes = np.where(bit, code, codes)
+    return codes
+
+
+def get_transition_code(cell_transition, orientation):
+    """Get the transition code of a cell for an agent facing orientation,
+    or None if the agent cannot leave the cell.
+    """
+    bits = int(cell_transition) >> ((3 - orientation) * 4)
+    for (code_orientation, direction), code in TRANSITION_CODES.items():
+        if code_orientation == orientation and (bits >> (3 - direction)) & 1:
+            return code
+    return None
+
+
+class RailEnvEncoder:
+    """Encodes RailEnvs as States of a flatland PDDL domain and decodes
+    PDDL actions as RailEnvActions.
+
+    After a RailEnv has been encoded, self.sync updates its state from
+    the agents that changed, since the rail and therefore the position
+    fluents and rail dimensions (self.static_literals) stay the same.
+
+    Parameters
+    ----------
+    domain : PDDLDomain
+        The flatland domain, see pddl/flatland.pddl.
+    """
+
+    def __init__(self, domain):
+        self.domain = domain
+        self.railway_type = domain.types["railway"]
+        self.agent_type = domain.types["agent"]
+        self.cell_type = domain.types["cell"]
+        # Set by self.encode
+        self.railway = None
+        self.agent_to_handle = {}
+        self.handle_to_agent = {}
+        self.static_literals = frozenset()
+        # Shared by the BitsetStates of the encoded RailEnv
+        self.table = None
+        # Shared by the NumericFluents of the encoded RailEnv
+        self.fluent_table = None
+        self._grid = None
+        self._codes = None
+        # Agent handle -> (position, direction, status, moving)
+        self._agent_info = {}
+        # Position -> handles of the agents there
+        self._position_to_handles = {}
+
+    def cell(self, row, col):
+        """Get the cell object of a grid position.
+        """
+        return self.cell_type("c{}_{}".format(row, col))
+
+    def encode(self, rail_env, compact=False):
+        """Encode the rail and agents of a RailEnv.
+
+        Parameters
+        ----------
+        rail_env : RailEnv
+            A RailEnv whose rail and agents have been generated.
+        compact : bool
+            If True, return a BitsetState over self.table.
+
+        Returns
+        -------
+        state : State or BitsetState
+            The goal is for every agent to be at its target. The values of
+            the function literals are also in state.fluents.
+        """
+        self._grid = np.asarray(rail_env.rail.grid)
+        height, width = self._grid.shape
+        self._codes = encode_transitions(self._grid)
+
+        self.railway = self.railway_type("rail")
+        objects = {self.railway}
+        static_literals = {self._fluent("height", height, self.railway),
+                           self._fluent("weight", width, self.railway)}
+        at = self.domain.predicates["at"]
+        goal = []
+        self.agent_to_handle, self.handle_to_agent = {}, {}
+        self._agent_info, self._position_to_handles = {}, {}
+        for agent in rail_env.agents:
+            obj = self.agent_type("agent{}".format(agent.handle))
+            self.agent_to_handle[obj] = agent.handle
+            self.handle_to_agent[agent.handle] = obj
+            objects.add(obj)
+            info = self._get_agent_info(agent)
+            self._agent_info[agent.handle] = info
+            if _occupies(info):
+                self._position_to_handles.setdefault(info[0], []).append(agent.handle)
+            if agent.target is not None:
+                goal.append(at(obj, self.cell(*agent.target)))
+
+        # One vectorized pass over the rail cells
+        available = self.domain.predicates["available"]
+        dynamic_literals = set()
+        rows, cols = np.nonzero(self._grid)
+        positions = rows * width + cols + 1
+        for row, col, position, code in zip(rows.tolist(), cols.tolist(), positions.tolist(),
+                                            self._codes[rows, cols].tolist()):
+            cell = self.cell(row, col)
+            objects.add(cell)
+            static_literals.add(self._fluent("position", position, cell))
+            if (row, col) in self._position_to_handles:
+                dynamic_literals |= self._get_cell_literals((row, col))
+            else:
+                dynamic_literals.add(self._fluent("transition", code, cell))
+                dynamic_literals.add(available(cell))
+        for handle, info in self._agent_info.items():
+            dynamic_literals |= self._get_agent_literals(handle, info)
+
+        self.static_literals = frozenset(static_literals)
+        literals = self.static_literals | dynamic_literals
+        fluents = NumericFluents.from_literals(literals)
+        self.fluent_table = fluents.table
+        state = State(literals, frozenset(objects), LiteralConjunction(goal), fluents)
+        self.table = AtomTable(sorted(state.literals))
+        if compact:
+            return BitsetState.from_state(state, self.table)
+        return state
+
+    def sync(self, rail_env, state):
+        """Update a state after the agents of the RailEnv moved.
+
+        Only the agents whose position, direction, status or moving flag
+        changed and the cells they left or entered are visited, so this
+        takes time proportional to the number of agents, not the grid.
+
+        Parameters
+        ----------
+        rail_env : RailEnv
+            The RailEnv last encoded or synced.
+        state : State or BitsetState
+            The state of the RailEnv when it was last encoded or synced.
+
+        Returns
+        -------
+        next_state : State or BitsetState
+        added : { Literal }
+        deleted : { Literal }
+        """
+        changes = []
+        for agent in rail_env.agents:
+            info = self._get_agent_info(agent)
+            if info != self._agent_info[agent.handle]:
+                changes.append((agent.handle, self._agent_info[agent.handle], info))
+        if not changes:
+            return state, set(), set()
+
+        positions = set()
+        for _, old_info, info in changes:
+            positions.update(p for p in (old_info[0], info[0]) if p is not None)
+        before, after = set(), set()
+        for handle, old_info, _ in changes:
+            before |= self._get_agent_literals(handle, old_info)
+        for position in positions:
+            before |= self._get_cell_literals(position)
+        for handle, old_info, info in changes:
+            self._agent_info[handle] = info
+            if _occupies(old_info):
+                handles = self._position_to_handles[old_info[0]]
+                handles.remove(handle)
+                if not handles:
+                    del self._position_to_handles[old_info[0]]
+            if _occupies(info):
+                self._position_to_handles.setdefault(info[0], []).append(handle)
+            after |= self._get_agent_literals(handle, info)
+        for position in positions:
+            after |= self._get_cell_literals(position)
+
+        added, deleted = after - before, before - after
+        if isinstance(state, BitsetState):
+            next_state = state.apply(self.table.encode(added), self.table.encode(deleted))
+        else:
+            next_state = state.with_literals((state.literals - deleted) | added)
+        if state.fluents is not None:
+            next_state = next_state.with_fluents(state.fluents.assign({
+                (lit.function.name, tuple(lit.variables)): float(lit.function.value)
+                for lit in added if isinstance(lit, FLiteral)}))
+        return next_state, added, deleted
+
+    def _get_agent_literals(self, handle, info):
+        """Helper for encode and sync
+        """
+        obj = self.handle_to_agent[handle]
+        position, direction, status, moving = info
+        literals = {self._fluent("direction", direction, obj),
+                    self._fluent("status", status, obj)}
+        if moving:
+            literals.add(self.domain.predicates["moving"](obj))
+        if position is not None:
+            literals.add(self.domain.predicates["at"](obj, self.cell(*position)))
+        return literals
+
+    def _get_cell_literals(self, position):
+        """Helper for encode and sync. The transition code of an occupied
+        cell is the one of the agent there with the lowest handle.
+        """
+        row, col = position
+        cell = self.cell(row, col)
+        code = int(self._codes[row, col])
+        handles = self._position_to_handles.get(position)
+        if handles:
+            agent_code = get_transition_code(self._grid[row, col],
+                                             self._agent_info[min(handles)][1])
+            if agent_code is not None:
+                code = agent_code
+            return {self._fluent("transition", code, cell)}
+        return {self._fluent("transition", code, cell),
+                self.domain.predicates["available"](cell)}
+
+    def decode_action(self, action):
+        """Decode a ground PDDL action.
+
+        Parameters
+        ----------
+        action : Literal
+
+        Returns
+        -------
+        handle : int
+            The handle of the agent taking the action.
+        rail_env_action : RailEnvActions
+        """
+        rail_env_action = ACTIONS[action.predicate.name]
+        for obj in action.variables:
+            if obj.var_type == self.agent_type:
+                return self.agent_to_handle[obj], rail_env_action
+        raise ValueError("Action {} has no agent".format(action))
+
+    def decode_actions(self, actions):
+        """Decode ground PDDL actions into the action dict of RailEnv.step.
+        """
+        return dict(self.decode_action(action) for action in actions)
+
+    def _fluent(self, function_name, value, *objects):
+        """Helper for encode and sync
+        """
+        return fluent_literal(self.domain.functions[function_name], objects, value)
+
+    @staticmethod
+    def _get_agent_info(agent):
+        """Get (position, direction, status, moving) of an agent. Agents
+        that have not departed yet are at their initial position, agents
+        that are done and removed (see _occupies) at their target, so that
+        the goal holds once all agents have arrived.
+        """
+        position, direction = agent.position, agent.direction
+        if position is None:
+            if int(agent.status) < DONE:
+                position, direction = agent.initial_position, agent.initial_direction
+            else:
+                position = agent.target
+        if position is not None:
+            position = tuple(int(x) for x in position)
+        return position, int(direction), int(agent.status), bool(agent.moving)
+
+
+def _occupies(info):
+    """Helper for RailEnvEncoder. Whether an agent with (position,
+    direction, status, moving) info makes its cell unavailable. Agents
+    removed at their target free the cell, as in the RailEnv.
+    """
+    return info[0] is not None and info[2] != DONE_REMOVED
@@ -0,0 +1,317 @@
+"""Grounded operators for fast successor generation.
+
+Once the objects of a problem are known, every ground action literal
+corresponds to a fixed set of ground operators. Each ground operator
+carries its ground positive / negative preconditions and add / delete
+effects, so checking applicability and executing an action becomes a
+dictionary lookup plus a few set operations instead of a CSP or Prolog
+proof per step.
+
+Numeric preconditions are compiled once per operator (see
+numeric.get_split_preconds) and checked against state.fluents, and
+When / Assign effects are applied with the assignment of the ground
+operator. Operators whose preconditions or effects cannot be grounded
+this way (disjunctions of literals, quantifiers, ...) are reported as
+not groundable so that callers can fall back to the lifted inference
+modes.
+"""
+from pddlflatland.structs import (Literal, LiteralConjunction, ProbabilisticEffect, When, Assign,
+                                  ground_literal)
+from pddlflatland.numeric import NumericFluents, get_split_preconds
+from collections import namedtuple, defaultdict
+import itertools
+
+
+class GroundOperator(namedtuple("GroundOperator", ["operator", "assignment",
+                                                   "pos_preconds", "neg_preconds",
+                                                   "add_effects", "delete_effects",
+                                                   "lifted_effects", "numeric_preconds"],
+                                    defaults=(None,))):
+    """An operator together with an assignment of all of its variables.
+
+    add_effects and delete_effects are None when the operator has
+    stochastic or conditional effects; lifted_effects must then be
+    sampled and grounded with the assignment at execution time.
+    numeric_preconds is the CompiledNumericCondition of the operator,
+    if any, which must also hold for the assignment.
+    """
+    __slots__ = ()
+
+    def is_applicable(self, literals):
+        """Check the ground preconditions against a set of ground literals.
+        """
+        if not self.pos_preconds.issubset(literals):
+            return False
+        return self.neg_preconds.isdisjoint(literals)
+
+    def numeric_preconds_hold(self, fluents):
+        """Check the numeric preconditions against NumericFluents.
+        """
+        if self.numeric_preconds is None:
+            return True
+        return bool(self.numeric_preconds(fluents, self.assignment)[0])
+
+    @property
+    def is_deterministic(self):
+        return self.add_effects is not None
+
+    def apply(self, literals):
+        """Return the literals after executing the deterministic ground effects.
+        """
+        assert self.is_deterministic
+        return (literals - self.delete_effects) | self.add_effects
+
+
+class GroundOperatorTable:
+    """Lazily grounds the operators of one domain, per ground action literal.
+
+    Ground operators are computed the first time an action literal is looked
+    up and are cached until the set of objects changes.
+
+    Parameters
+    ----------
+    domain : PDDLDomain
+    """
+
+    def __init__(self, domain):
+        self.domain = domain
+        self._type_to_parent_types = domain.type_to_parent_types
+        self._objects = None
+        self._type_to_objs = None
+        self._action_to_ground_operators = {}
+        self._groundable = {}
+        # For BitsetStates, see self.select_bitset
+        self._atom_table = None
+        self._action_to_masks = {}
+
+    def update_objects(self, objects):
+        """Reset the cached groundings if the objects have changed.
+        """
+        if objects == self._objects:
+            return
+        self._objects = objects
+        self._type_to_objs = defaultdict(list)
+        for obj in sorted(objects):
+            for t in self._type_to_parent_types.get(obj.var_type, {obj.var_type}):
+                self._type_to_objs[t].append(obj)
+        self._action_to_ground_operators = {}
+        self._action_to_masks = {}
+
+    def is_groundable(self, operator):
+        """Whether the preconditions and effects of an operator can be
+        represented as sets of ground literals.
+        """
+        if operator not in self._groundable:
+            self._groundable[operator] = (
+                self._get_lifted_preconds(operator) is not None and
+                self._get_lifted_effects(operator) is not None)
+        return self._groundable[operator]
+
+    def get_ground_operators(self, action, objects):
+        """Get all ground operators that may be selected by an action.
+
+        Parameters
+        ----------
+        action : Literal
+        objects : frozenset
+            The objects of the current state.
+
+        Returns
+        -------
+        ground_operators : [ GroundOperator ] or None
+            None if some candidate operator cannot be grounded, in
+            which case lifted inference must be used instead.
+        """
+        self.update_objects(objects)
+        try:
+            return self._action_to_ground_operators[action]
+        except KeyError:
+            pass
+        candidates = self._get_candidate_operators(action)
+        if not all(self.is_groundable(op) for op in candidates):
+            ground_operators = None
+        else:
+            ground_operators = []
+            for operator in candidates:
+                ground_operators.extend(self._ground_operator(operator, action))
+        self._action_to_ground_operators[action] = ground_operators
+        return ground_operators
+
+    def select(self, state, action, require_unique_assignment=True):
+        """Find the ground operator whose preconditions hold in the state.
+
+        Returns
+        -------
+        ground_operator : GroundOperator or None
+            None if the action is not applicable.
+        """
+        ground_operators = self.get_ground_operators(action, state.objects)
+        assert ground_operators is not None, "Action cannot be grounded"
+        selected = None
+        # Only built for ground operators with numeric preconditions
+        fluents = None
+        for ground_operator in ground_operators:
+            if not ground_operator.is_applicable(state.literals):
+                continue
+            if ground_operator.numeric_preconds is not None:
+                if fluents is None:
+                    fluents = _get_fluents(state)
+                if not ground_operator.numeric_preconds_hold(fluents):
+                    continue
+            if not require_unique_assignment:
+                return ground_operator
+            assert selected is None, "Nondeterministic envs not supported"
+            selected = ground_operator
+        return selected
+
+    def select_bitset(self, state, action, require_unique_assignment=True):
+        """Like select, but for a BitsetState. Preconditions are checked
+        with bit masks over state.table.
+
+        Returns
+        -------
+        ground_operator : GroundOperator or None
+        masks : (int, int, int, int) or None
+            Positive precondition, negative precondition, add and
+            delete masks of the ground operator.
+        """
+        ground_operators = self.get_ground_operators(action, state.objects)
+        assert ground_operators is not None, "Action cannot be grounded"
+        if state.table is not self._atom_table:
+            self._atom_table = state.table
+            self._action_to_masks = {}
+        try:
+            all_masks = self._action_to_masks[action]
+        except KeyError:
+            encode = self._atom_table.encode
+            all_masks = []
+            for ground_operator in ground_operators:
+                if ground_operator.is_deterministic:
+                    effect_masks = (encode(ground_operator.add_effects),
+                                    encode(ground_operator.delete_effects))
+                else:
+                    effect_masks = (None, None)
+                all_masks.append((encode(ground_operator.pos_preconds),
+                                  encode(ground_operator.neg_preconds)) + effect_masks)
+            self._action_to_masks[action] = all_masks
+        selected = None, None
+        # Only built for ground operators with numeric preconditions
+        fluents = None
+        for ground_operator, masks in zip(ground_operators, all_masks):
+            if not state.holds(masks[0], masks[1]):
+                continue
+            if ground_operator.numeric_preconds is not None:
+                if fluents is None:
+                    fluents = _get_fluents(state)
+                if not ground_operator.numeric_preconds_hold(fluents):
+                    continue
+            if not require_unique_assignment:
+                return ground_operator, masks
+            assert selected[0] is None, "Nondeterministic envs not supported"
+            selected = ground_operator, masks
+        return selected
+
+    def _get_candidate_operators(self, action):
+        """Helper for get_ground_operators
+        """
+        return self.domain.get_action_operators(action.predicate)
+
+    def _ground_operator(self, operator, action):
+        """Yield the ground operators of operator that are selected by action.
+        """
+        conds = self._get_lifted_preconds(operator)
+        if self.domain.operators_as_actions:
+            action_variables = operator.params
+        else:
+            action_literal = None
+            for lit in conds:
+                if lit.predicate == action.predicate:
+                    action_literal = lit
+                    break
+            action_variables = action_literal.variables
+        if len(action_variables) != len(action.variables):
+            return
+        # Bind the action variables
+        base_assignment = {c: c for c in (self.domain.constants or [])}
+        for var, obj in zip(action_variables, action.variables):
+            if not self._type_is_of_type(obj.var_type, var.var_type):
+                return
+            if base_assignment.get(var, obj) != obj:
+                return
+            base_assignment[var] = obj
+        # Enumerate the remaining variables
+        numeric_preconds = get_split_preconds(operator)[1]
+        numeric_variables = numeric_preconds.variables if numeric_preconds is not None else []
+        free_variables = []
+        for var in list(operator.params) + [v for lit in conds for v in lit.variables] + \
+                numeric_variables:
+            if var not in base_assignment and var not in free_variables:
+                free_variables.append(var)
+        choices = [self._type_to_objs[v.var_type] for v in free_variables]
+        lifted_effects = self._get_lifted_effects(operator)
+        for choice in itertools.product(*choices):
+            assignment = dict(base_assignment)
+            assignment.update(zip(free_variables, choice))
+            pos_preconds, neg_preconds = set(), set()
+            for lit in conds:
+                ground_lit = ground_literal(lit, assignment)
+                if ground_lit.is_negative:
+                    neg_preconds.add(ground_lit.positive)
+                elif ground_lit != action:
+                    # The action literal always holds when taking the action
+                    pos_preconds.add(ground_lit)
+            if any(isinstance(eff, (ProbabilisticEffect, When, Assign)) for eff in lifted_effects):
+                add_effects, delete_effects = None, None
+            else:
+                add_effects, delete_effects = set(), set()
+                for eff in lifted_effects:
+                    ground_eff = ground_literal(eff, assignment)
+                    if ground_eff.is_anti:
+                        delete_effects.add(ground_eff.inverted_anti)
+                    else:
+                        add_effects.add(ground_eff)
+                add_effects = frozenset(add_effects)
+                delete_effects = frozenset(delete_effects)
+            yield GroundOperator(operator, assignment, frozenset(pos_preconds),
+                                 frozenset(neg_preconds), add_effects,
+                                 delete_effects, lifted_effects, numeric_preconds)
+
+    def _type_is_of_type(self, type1, type2):
+        return type2 in self._type_to_parent_types.get(type1, {type1})
+
+    @staticmethod
+    def _get_lifted_preconds(operator):
+        """Return the literal preconditions as a list of Literals, or None
+        if the other preconditions cannot be compiled as numeric
+        conditions, see numeric.get_split_preconds.
+        """
+        return get_split_preconds(operator)[0]
+
+    @staticmethod
+    def _get_lifted_effects(operator):
+        """Return the effects as a list of Literals, ProbabilisticEffects,
+        Whens and Assigns, or None if they contain other constructs.
+        """
+        if isinstance(operator.effects, Literal):
+            effects = [operator.effects]
+        elif isinstance(operator.effects, LiteralConjunction):
+            effects = operator.effects.literals
+        else:
+            return None
+        for eff in effects:
+            if isinstance(eff, (Literal, When, Assign)):
+                continue
+            if isinstance(eff, ProbabilisticEffect) and all(
+                    isinstance(lit, (Literal, LiteralConjunction)) or lit == "NOCHANGE"
+                    for lit in eff.literals):
+                continue
+            return None
+        return effects
+
+
+def _get_fluents(state):
+    """Helper for GroundOperatorTable
+    """
+    if state.fluents is None:
+        return NumericFluents.from_literals(state.literals)
+    return state.fluents
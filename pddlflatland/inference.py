@@ -3,13 +3,17 @@
 
 from collections import defaultdict
 from pddlflatland.prolog_interface import PrologInterface
-from pddlflatland.structs import Literal, LiteralConjunction
+from pddlflatland.structs import Literal, LiteralConjunction, BitsetState
 
 
 def find_satisfying_assignments(kb, conds, variable_sort_fn=None, verbose=False,
                                 max_assignment_count=2, type_to_parent_types=None,
                                 allow_redundant_variables=True, constants=None,
-                                mode="csp"):
+                                mode="csp", prolog_session=None, query_plan=None):
+    if query_plan is not None:
+        # Compiled from conds, see QueryPlan
+        return query_plan.execute(kb, max_assignment_count=max_assignment_count,
+                                  allow_redundant_variables=allow_redundant_variables)
     if mode == "csp":
         return ProofSearchTree(kb,
                                allow_redundant_variables=allow_redundant_variables,
@@ -25,11 +29,16 @@ def find_satisfying_assignments(kb, conds, variable_sort_fn=None, verbose=False,
     prolog_interface = PrologInterface(kb, conds,
                                        max_assignment_count=max_assignment_count,
                                        allow_redundant_variables=allow_redundant_variables,
-                                       constants=constants)
+                                       constants=constants,
+                                       session=prolog_session)
     return prolog_interface.run()
 
 
-def check_goal(state, goal):
+def check_goal(state, goal, prolog_session=None):
+    if isinstance(state, BitsetState):
+        masks = state.table.get_condition_masks(goal)
+        if masks is not None:
+            return state.holds(*masks)
     if isinstance(goal, Literal):
         if goal.is_negative and goal.positive in state.literals:
             return False
@@ -40,7 +49,8 @@ def check_goal(state, goal):
         return all(check_goal(state, lit) for lit in goal.literals)
     prolog_interface = PrologInterface(state.literals, goal,
                                        max_assignment_count=2,
-                                       allow_redundant_variables=True)
+                                       allow_redundant_variables=True,
+                                       session=prolog_session)
     assignments = prolog_interface.run()
     return len(assignments) > 0
 
@@ -63,6 +73,8 @@ class ProofSearchTree(object):
 
     def initialize_kb(self, knowledge_base):
         self.all_atoms = set()
+        # predicate to (argument position, atom) to literals, see get_kb_literals
+        self._kb_index = {}
         d = defaultdict(list)  # predicate to literals
         for literal in knowledge_base:
             d[literal.predicate].append(literal)
@@ -70,6 +82,39 @@ class ProofSearchTree(object):
                 self.all_atoms.add(atom)
         return d
 
+    def get_kb_literals(self, predicate, bound_args):
+        """Get the KB literals of a predicate whose arguments at some
+        positions are bound to given atoms.
+
+        Parameters
+        ----------
+        predicate : Predicate
+        bound_args : [ (int, TypedEntity) ]
+            Pairs of argument position and atom.
+
+        Returns
+        -------
+        literals : [ Literal ] or { Literal }
+        """
+        if not bound_args:
+            return self.knowledge_base[predicate]
+        try:
+            index = self._kb_index[predicate]
+        except KeyError:
+            # Indexed lazily, since only few predicates are usually queried
+            index = defaultdict(set)
+            for kb_literal in self.knowledge_base[predicate]:
+                for i, atom in enumerate(kb_literal.variables):
+                    index[(i, atom)].add(kb_literal)
+            self._kb_index[predicate] = index
+        candidate_sets = []
+        for key in bound_args:
+            if key not in index:
+                return ()
+            candidate_sets.append(index[key])
+        candidate_sets.sort(key=len)
+        return candidate_sets[0].intersection(*candidate_sets[1:])
+
     def prove(self, goal_literal, verbose=False, commit_if_true=False, max_assignment_count=1,
               variable_sort_fn=None):
         if not isinstance(goal_literal, list):
@@ -126,11 +171,19 @@ class ProofSearchTree(object):
             for child in self.get_children(node, variables, goal_literals, verbose=verbose):
                 if verbose:
                     print(' child:', child['variable_assignments'])
-                # Forward checking.
-                if any(not self.get_possible_assignments(
+                # Forward checking. The candidate sets are kept in the child
+                # so that they are not recomputed by get_children.
+                possible_assignments = child['possible_assignments']
+                consistent = True
+                for var in variables:
+                    if var in child["variable_assignments"]:
+                        continue
+                    possible_assignments[var] = self.get_possible_assignments(
                         var, child["variable_assignments"], goal_literals)
-                       for var in variables
-                       if var not in child["variable_assignments"]):
+                    if not possible_assignments[var]:
+                        consistent = False
+                        break
+                if not consistent:
                     continue
                 self.queue.append(child)
 
@@ -155,9 +208,12 @@ class ProofSearchTree(object):
         if next_variable is None:
             return
 
-        for possible_assignment in self.get_possible_assignments(next_variable,
+        possible_assignments = node.get('possible_assignments', {}).get(next_variable)
+        if possible_assignments is None:
+            possible_assignments = self.get_possible_assignments(next_variable,
                                                                  node['variable_assignments'], goal_literals,
-                                                                 verbose=verbose):
+                                                                 verbose=verbose)
+        for possible_assignment in possible_assignments:
             yield self.create_child_node(next_variable, possible_assignment, node, goal_literals)
 
     def get_possible_assignments(self, variable, established_assignments, goal_literals, verbose=False):
@@ -178,37 +234,29 @@ class ProofSearchTree(object):
             possible_atoms = set()
             inevitable_atoms = set()
 
-            for kb_literal in self.knowledge_base[goal_literal.predicate.positive]:
-
-                literal_may_hold = True  # depending on other vars, which are not yet bound
-                literal_definitely_holds = True  # if all vars are bound
-                variable_atom = None
-
-                for v, atom in zip(goal_literal.variables, kb_literal.variables):
-                    if v == variable:
-                        if not (self.allow_redundant_variables) and \
-                                (atom in already_assigned_atoms):
-                            literal_may_hold = False
-                            literal_definitely_holds = False
-                            break
-                        elif not self.type_is_of_type(atom.var_type, v.var_type):
-                            literal_may_hold = False
-                            literal_definitely_holds = False
-                            break
-                        else:
-                            variable_atom = atom
-                    elif v in established_assignments and established_assignments[v] != atom:
-                        literal_may_hold = False
-                        literal_definitely_holds = False
-                        break
-                    elif v not in established_assignments:
-                        literal_definitely_holds = False
+            # Only KB literals that agree with the bound variables may hold
+            bound_args = []
+            variable_position = None
+            literal_definitely_holds = True  # if all other vars are bound
+            for i, v in enumerate(goal_literal.variables):
+                if v == variable:
+                    variable_position = i
+                elif v in established_assignments:
+                    bound_args.append((i, established_assignments[v]))
+                else:
+                    literal_definitely_holds = False
 
-                if literal_may_hold:
-                    possible_atoms.add(variable_atom)
+            for kb_literal in self.get_kb_literals(goal_literal.predicate.positive, bound_args):
+                atom = kb_literal.variables[variable_position]
+                if not (self.allow_redundant_variables) and \
+                        (atom in already_assigned_atoms):
+                    continue
+                if not self.type_is_of_type(atom.var_type, variable.var_type):
+                    continue
+                possible_atoms.add(atom)
 
-                if literal_definitely_holds:
-                    inevitable_atoms.add(variable_atom)
+            if literal_definitely_holds:
+                inevitable_atoms = possible_atoms
 
             if goal_literal.is_negative:
                 if verbose:
@@ -256,4 +304,205 @@ class ProofSearchTree(object):
     def create_child_node(self, variable, assignment, parent_node, goal_literals):
         variable_assignments = parent_node['variable_assignments'].copy()
         variable_assignments[variable] = assignment
-        return {'variable_assignments': variable_assignments}
+        return {'variable_assignments': variable_assignments,
+                'possible_assignments': {}}
+
+
+class QueryPlan(object):
+    """A conjunction of literals compiled into a fixed join order.
+
+    Compiling once and executing many times avoids re-deriving the variable
+    order and re-walking the conditions on every query. Variables are numbered
+    slots; each literal is stored as (predicate name, args), where each arg is
+    either an int slot or a constant object, like in pddlflatland.datalog.
+
+    The join order is chosen greedily: literals whose arguments are all
+    bound are checked as early as possible, and otherwise the next literal
+    is one that shares a bound variable with the literals before it, with
+    the fewest facts according to predicate_counts. Variables that only
+    occur in negative literals are bound by enumerating the atoms of their
+    type in the knowledge base.
+
+    Parameters
+    ----------
+    conds : [ Literal ]
+    constants : [ TypedEntity ] or None
+    type_to_parent_types : { Type : { Type } } or None
+    predicate_counts : { str : int } or None
+        Number of facts per predicate name, used as selectivity estimate.
+    """
+
+    def __init__(self, conds, constants=None, type_to_parent_types=None,
+                 predicate_counts=None):
+        self.constants = list(constants or [])
+        constant_set = set(self.constants)
+        self.variables = []
+        var_to_slot = {}
+
+        def compile_args(variables):
+            assert len(variables) == len(set(variables)), \
+                "Duplicate variables in predicates not supported."
+            args = []
+            for v in variables:
+                if v in constant_set:
+                    args.append(v)
+                    continue
+                if v not in var_to_slot:
+                    var_to_slot[v] = len(self.variables)
+                    self.variables.append(v)
+                args.append(var_to_slot[v])
+            return tuple(args)
+
+        pos_literals, neg_literals = [], []
+        for lit in conds:
+            if lit.is_negative:
+                neg_literals.append((lit.predicate.name, compile_args(lit.variables)))
+            else:
+                pos_literals.append((lit.predicate.name, compile_args(lit.variables)))
+        self.predicate_names = {name for name, _ in pos_literals + neg_literals}
+
+        # Object types that may be assigned to each slot
+        self._slot_types = []
+        for v in self.variables:
+            if type_to_parent_types is None:
+                self._slot_types.append({v.var_type})
+            else:
+                self._slot_types.append({t for t, parents in type_to_parent_types.items()
+                                         if v.var_type in parents})
+
+        self.steps = self._create_steps(pos_literals, neg_literals, predicate_counts or {})
+        self._has_type_steps = any(step[0] == "type" for step in self.steps)
+
+    def _create_steps(self, pos_literals, neg_literals, predicate_counts):
+        """Order the literals into steps ("check", name, args, is_negative),
+        ("join", name, args, bound positions, new positions) and
+        ("type", slot).
+        """
+        steps = []
+        bound = set()
+
+        def is_bound(a):
+            return not isinstance(a, int) or a in bound
+
+        remaining_pos = list(range(len(pos_literals)))
+        remaining_neg = list(range(len(neg_literals)))
+        while remaining_pos or remaining_neg:
+            ready_pos = [i for i in remaining_pos if all(map(is_bound, pos_literals[i][1]))]
+            ready_neg = [i for i in remaining_neg if all(map(is_bound, neg_literals[i][1]))]
+            if ready_pos or ready_neg:
+                for i in ready_pos:
+                    steps.append(("check",) + pos_literals[i] + (False,))
+                    remaining_pos.remove(i)
+                for i in ready_neg:
+                    steps.append(("check",) + neg_literals[i] + (True,))
+                    remaining_neg.remove(i)
+                continue
+            if remaining_pos:
+                def selectivity(i):
+                    name, args = pos_literals[i]
+                    num_bound = sum(1 for a in args if is_bound(a))
+                    return (num_bound == 0, predicate_counts.get(name, 0), -num_bound)
+                i = min(remaining_pos, key=selectivity)
+                remaining_pos.remove(i)
+                name, args = pos_literals[i]
+                bound_positions = tuple(j for j, a in enumerate(args) if is_bound(a))
+                new_positions = tuple(j for j, a in enumerate(args) if not is_bound(a))
+                steps.append(("join", name, args, bound_positions, new_positions))
+                bound.update(args[j] for j in new_positions)
+                continue
+            # Bind a variable of a remaining negative literal by type
+            slot = min(a for i in remaining_neg for a in neg_literals[i][1]
+                       if not is_bound(a))
+            steps.append(("type", slot))
+            bound.add(slot)
+        return steps
+
+    def execute(self, knowledge_base, max_assignment_count=1,
+                allow_redundant_variables=True):
+        """Find assignments of the variables that satisfy the conditions.
+
+        Parameters
+        ----------
+        knowledge_base : { Literal }
+        max_assignment_count : int
+        allow_redundant_variables : bool
+
+        Returns
+        -------
+        assignments : [ { TypedEntity : TypedEntity } ]
+            Like find_satisfying_assignments, including the constants.
+        """
+        facts = defaultdict(list)  # predicate name to argument tuples
+        all_atoms = set() if self._has_type_steps else None
+        for literal in knowledge_base:
+            if literal.predicate.name in self.predicate_names:
+                facts[literal.predicate.name].append(tuple(literal.variables))
+            if all_atoms is not None:
+                all_atoms.update(literal.variables)
+        if all_atoms is not None:
+            all_atoms = sorted(all_atoms)
+        fact_sets = {}
+        # Step index to bound argument values to new argument values
+        indexes = {}
+        slots = [None] * len(self.variables)
+        assignments = []
+
+        def get_args(args):
+            return tuple(slots[a] if isinstance(a, int) else a for a in args)
+
+        def can_assign(slot, obj):
+            if obj.var_type not in self._slot_types[slot]:
+                return False
+            if allow_redundant_variables:
+                return True
+            return obj not in self.constants and obj not in slots
+
+        def search(step_idx):
+            if step_idx == len(self.steps):
+                assignment = {c: c for c in self.constants}
+                assignment.update(zip(self.variables, slots))
+                assignments.append(assignment)
+                return len(assignments) >= max_assignment_count
+            step = self.steps[step_idx]
+            if step[0] == "check":
+                _, name, args, is_negative = step
+                if name not in fact_sets:
+                    fact_sets[name] = set(facts[name])
+                if (get_args(args) in fact_sets[name]) == is_negative:
+                    return False
+                return search(step_idx + 1)
+            if step[0] == "type":
+                slot = step[1]
+                for obj in all_atoms:
+                    if not can_assign(slot, obj):
+                        continue
+                    slots[slot] = obj
+                    if search(step_idx + 1):
+                        return True
+                slots[slot] = None
+                return False
+            _, name, args, bound_positions, new_positions = step
+            if step_idx not in indexes:
+                index = defaultdict(list)
+                for fact in facts[name]:
+                    index[tuple(fact[j] for j in bound_positions)].append(
+                        tuple(fact[j] for j in new_positions))
+                indexes[step_idx] = index
+            key = tuple(slots[args[j]] if isinstance(args[j], int) else args[j]
+                        for j in bound_positions)
+            new_slots = [args[j] for j in new_positions]
+            for values in indexes[step_idx].get(key, ()):
+                consistent = True
+                for slot, obj in zip(new_slots, values):
+                    if not can_assign(slot, obj):
+                        consistent = False
+                        break
+                    slots[slot] = obj
+                if consistent and search(step_idx + 1):
+                    return True
+                for slot in new_slots:
+                    slots[slot] = None
+            return False
+
+        search(0)
+        return assignments
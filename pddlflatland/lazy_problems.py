@@ -0,0 +1,245 @@
+"""Problems of a PDDL problem directory, parsed on first access.
+
+With PDDLEnv.load_pddl(lazy=True), constructing an env only lists the
+problem files, and reset parses the problem it picks. Parsed problems are
+kept in an LRU, and the problems after the last one accessed can be
+parsed ahead by a process pool.
+
+Problems parsed by the pool, or kept in the pddl_cache, are pickled with
+the types, predicates and functions of the domain replaced by their
+names. When they are loaded, they share those of the domain of the env,
+as problems parsed in this process do.
+"""
+from pddlflatland.parser import PDDLDomainParser, PDDLProblemParser
+from pddlflatland import pddl_cache
+
+from collections import OrderedDict, deque
+from collections.abc import Sequence
+from concurrent.futures import ProcessPoolExecutor
+
+import functools
+import io
+import os
+import pickle
+
+
+def parse_domain(domain_file, operators_as_actions=False):
+    """Parse a domain file as PDDLEnv.load_pddl does.
+    """
+    return PDDLDomainParser(domain_file,
+                            expect_action_preds=(not operators_as_actions),
+                            operators_as_actions=operators_as_actions)
+
+
+def parse_problem(problem_file, domain, streaming=False):
+    """Parse a problem file of a domain as PDDLEnv.load_pddl does.
+    """
+    return PDDLProblemParser(problem_file, domain.domain_name, domain.types, domain.predicates,
+                             domain.functions, domain.actions, streaming=streaming)
+
+
+def dumps_problem(problem, domain):
+    """Pickle a problem without the types, predicates and functions of
+    its domain, see loads_problem.
+
+    Returns
+    -------
+    data : bytes
+    """
+    ids = {id(obj): key for key, obj in _get_domain_objects(domain).items()}
+    f = io.BytesIO()
+    pickler = pickle.Pickler(f, protocol=pickle.HIGHEST_PROTOCOL)
+    pickler.persistent_id = lambda obj: ids.get(id(obj))
+    pickler.dump(problem)
+    return f.getvalue()
+
+
+def loads_problem(data, domain):
+    """Unpickle a problem pickled by dumps_problem, with the types,
+    predicates and functions of domain.
+    """
+    objects = _get_domain_objects(domain)
+    unpickler = pickle.Unpickler(io.BytesIO(data))
+    unpickler.persistent_load = objects.__getitem__
+    return unpickler.load()
+
+
+def _get_domain_objects(domain):
+    """Helper for dumps_problem and loads_problem
+    """
+    objects = {("types",): domain.types,
+               ("predicates",): domain.predicates,
+               ("actions",): domain.actions}
+    for name, t in domain.types.items():
+        objects["type", name] = t
+    for name, predicate in domain.predicates.items():
+        objects["predicate", name] = predicate
+    if domain.functions is not None:
+        objects["functions",] = domain.functions
+        for name, function in domain.functions.items():
+            objects["function", name] = function
+    return objects
+
+
+@functools.lru_cache(maxsize=None)
+def _get_worker_domain(domain_file, operators_as_actions):
+    """Helper for _load_problem_data
+    """
+    return parse_domain(domain_file, operators_as_actions)
+
+
+def _load_problem_data(domain_file, problem_file, operators_as_actions, streaming, cache_dir):
+    """Helper for LazyProblems, run by the workers of its process pool
+    """
+    if cache_dir is not None:
+        key = pddl_cache.get_cache_key(domain_file, [problem_file],
+                                       operators_as_actions=operators_as_actions,
+                                       streaming=streaming, lazy=True)
+        data = pddl_cache.load(key, cache_dir=cache_dir)
+        if data is not None:
+            return data
+    domain = _get_worker_domain(domain_file, operators_as_actions)
+    data = dumps_problem(parse_problem(problem_file, domain, streaming=streaming), domain)
+    if cache_dir is not None:
+        pddl_cache.save(key, data, cache_dir=cache_dir)
+    return data
+
+
+class LazyProblems(Sequence):
+    """A sequence of the problems of a domain that parses each problem
+    when it is first accessed.
+
+    Parameters
+    ----------
+    domain : PDDLDomainParser
+    domain_file : str
+    problem_files : [ str ]
+    operators_as_actions : bool
+        How domain was parsed, see parse_domain.
+    streaming : bool
+        See PDDLProblemParser.
+    cache_dir : str or None
+        Directory of the pddl_cache, where parsed problems are kept one
+        per entry. If None, problems are always parsed.
+    max_parsed : int
+        Number of parsed problems kept in memory. The least recently
+        accessed are dropped first.
+    prefetch : int
+        Number of problems to parse ahead in a ProcessPoolExecutor: those
+        following the one accessed, or those of the next draws, see
+        self.draw. If 0, problems are only parsed in this process, when
+        they are accessed.
+    """
+
+    def __init__(self, domain, domain_file, problem_files, operators_as_actions=False,
+                 streaming=False, cache_dir=None, max_parsed=128, prefetch=0):
+        self.domain = domain
+        self.domain_file = domain_file
+        self.problem_files = list(problem_files)
+        self.operators_as_actions = operators_as_actions
+        self.streaming = streaming
+        self.cache_dir = cache_dir
+        self.max_parsed = max_parsed
+        self.prefetch = prefetch
+        # Problem index -> PDDLProblemParser, least recently used first
+        self._parsed = OrderedDict()
+        # Problem index -> Future of the data of _load_problem_data
+        self._futures = {}
+        # Built lazily, see self._prefetch
+        self._executor = None
+        # Indices drawn ahead from self._draw_rng, see self.draw
+        self._drawn = deque()
+        self._draw_rng = None
+
+    def __len__(self):
+        return len(self.problem_files)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        # Also checks the bounds and handles negative indices
+        idx = range(len(self))[idx]
+        problem = self._parsed.get(idx)
+        if problem is None:
+            problem = self._load(idx)
+            self._parsed[idx] = problem
+            if len(self._parsed) > self.max_parsed:
+                self._parsed.popitem(last=False)
+        else:
+            self._parsed.move_to_end(idx)
+        if self.prefetch > 0:
+            if self._draw_rng is not None:
+                self._prefetch(self._drawn)
+            else:
+                self._prefetch([(idx + offset) % len(self)
+                                for offset in range(1, min(self.prefetch, len(self) - 1) + 1)])
+        return problem
+
+    def draw(self, rng):
+        """Draw the index of a problem uniformly at random.
+
+        The indices of the next self.prefetch draws are drawn ahead, so
+        that their problems are the ones parsed ahead. They are drawn in
+        order from rng, so the indices are those of rng.choice(len(self)),
+        as long as rng is only used by this method.
+
+        Parameters
+        ----------
+        rng : np.random.RandomState
+
+        Returns
+        -------
+        idx : int
+        """
+        if rng is not self._draw_rng:
+            self._draw_rng = rng
+            self._drawn.clear()
+        while len(self._drawn) <= self.prefetch:
+            self._drawn.append(rng.choice(len(self)))
+        return self._drawn.popleft()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_futures"] = {}
+        state["_executor"] = None
+        return state
+
+    def close(self):
+        """Shut down the process pool, if any.
+        """
+        if self._executor is not None:
+            for future in self._futures.values():
+                future.cancel()
+            self._futures = {}
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def _load(self, idx):
+        """Helper for __getitem__
+        """
+        future = self._futures.pop(idx, None)
+        if future is not None:
+            return loads_problem(future.result(), self.domain)
+        problem_file = self.problem_files[idx]
+        if self.cache_dir is None:
+            return parse_problem(problem_file, self.domain, streaming=self.streaming)
+        data = _load_problem_data(self.domain_file, problem_file, self.operators_as_actions,
+                                  self.streaming, self.cache_dir)
+        return loads_problem(data, self.domain)
+
+    def _prefetch(self, indices):
+        """Helper for __getitem__
+        """
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=max(1, min(self.prefetch, os.cpu_count() or 1)))
+        # Only the problems of indices are kept parsing, so that there are
+        # at most self.prefetch futures
+        for idx in set(self._futures) - set(indices):
+            self._futures.pop(idx).cancel()
+        for next_idx in indices:
+            if next_idx in self._parsed or next_idx in self._futures:
+                continue
+            self._futures[next_idx] = self._executor.submit(
+                _load_problem_data, self.domain_file, self.problem_files[next_idx],
+                self.operators_as_actions, self.streaming, self.cache_dir)
@@ -0,0 +1,523 @@
+"""Numeric state: the values of ground function terms in a NumPy array.
+
+A FluentTable interns ground function terms like position(c1_2) as
+indices of the values array of NumericFluents, which is attached to
+States as state.fluents. Numeric conditions are compiled once into
+functions that evaluate them with NumPy for many assignments of their
+variables at the same time, e.g. for every candidate cell of an action.
+"""
+from pddlflatland.structs import (Literal, FLiteral, NumericOperation, NumericCondition,
+                                  LiteralConjunction, LiteralDisjunction, When, Assign,
+                                  Equation, ground_literal)
+
+from collections import OrderedDict
+import copy
+import functools
+import numpy as np
+
+
+COMPARATORS = {
+    "=": np.equal,
+    "<": np.less,
+    ">": np.greater,
+    "<=": np.less_equal,
+    ">=": np.greater_equal,
+}
+OPERATIONS = {
+    "+": np.add,
+    "-": np.subtract,
+    "*": np.multiply,
+    "/": np.true_divide,
+}
+
+
+class FluentTable:
+    """Interns ground function terms, i.e. (function name, objects), as
+    indices. Ids are never reused, so a table can be shared by the
+    NumericFluents of all states of a problem.
+    """
+
+    def __init__(self, terms=()):
+        self._term_to_id = {}
+        self._terms = []
+        for name, objects in terms:
+            self.intern(name, objects)
+
+    def __len__(self):
+        return len(self._terms)
+
+    def intern(self, name, objects):
+        """Get the id of a term, adding it to the table if it is new.
+        """
+        term = (name, tuple(objects))
+        idx = self._term_to_id.get(term)
+        if idx is None:
+            idx = self._term_to_id[term] = len(self._terms)
+            self._terms.append(term)
+        return idx
+
+    def get_id(self, name, objects):
+        """Get the id of a term, or -1 if it is not in the table.
+        """
+        return self._term_to_id.get((name, tuple(objects)), -1)
+
+    def term(self, idx):
+        return self._terms[idx]
+
+
+class NumericFluents:
+    """The values of the ground function terms of a state.
+
+    NumericFluents are immutable; self.assign returns new ones.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        Float array indexed by term id; NaN for undefined terms.
+    table : FluentTable
+    """
+    __slots__ = ("values", "table")
+
+    def __init__(self, values, table):
+        self.values = values
+        self.table = table
+
+    @classmethod
+    def from_literals(cls, literals, table=None, base=None):
+        """Collect the values of the ground FLiterals among literals, as
+        parsed from (= (function objects) value) in a problem.
+
+        If base NumericFluents are given, e.g. the static_fluents of a
+        problem, its values are kept and its table is used.
+        """
+        if base is not None:
+            table = base.table
+        if table is None:
+            table = FluentTable()
+        ids, values = [], []
+        for lit in sorted(lit for lit in literals if isinstance(lit, FLiteral)):
+            try:
+                value = float(lit.function.value)
+            except (TypeError, ValueError):
+                continue
+            ids.append(table.intern(lit.function.name, lit.variables))
+            values.append(value)
+        array = np.full(len(table), np.nan)
+        if base is not None:
+            array[:len(base)] = base.values
+        array[ids] = values
+        return cls(array, table)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __eq__(self, other):
+        if not isinstance(other, NumericFluents):
+            return False
+        if self.table is other.table:
+            return np.array_equal(self.values, other.values, equal_nan=True)
+        return self.to_dict() == other.to_dict()
+
+    def __hash__(self):
+        return hash(frozenset(self.to_dict().items()))
+
+    def __repr__(self):
+        return "NumericFluents({})".format(", ".join(
+            "{}({})={:g}".format(name, ",".join(objects), value)
+            for (name, objects), value in self.to_dict().items()))
+
+    def to_dict(self):
+        """Get the values of the defined terms as {(name, objects): value}.
+        """
+        return {self.table.term(idx): value for idx, value in enumerate(self.values.tolist())
+                if not np.isnan(value)}
+
+    def get(self, name, objects):
+        """Get the value of a term, or NaN if it is undefined.
+        """
+        idx = self.table.get_id(name, objects)
+        if idx < 0 or idx >= len(self.values):
+            return np.nan
+        return float(self.values[idx])
+
+    def assign(self, updates):
+        """Return new NumericFluents with updated values.
+
+        Parameters
+        ----------
+        updates : { (str, (TypedEntity, ...)) : float }
+            Values of (function name, objects) terms.
+        """
+        ids = [self.table.intern(name, objects) for name, objects in updates]
+        values = self.values
+        if len(self.table) > len(values):
+            values = np.concatenate([values, np.full(len(self.table) - len(values), np.nan)])
+        else:
+            values = values.copy()
+        values[ids] = list(updates.values())
+        return NumericFluents(values, self.table)
+
+
+def compile_numeric_expression(expression):
+    """Compile a numeric expression, see CompiledNumericExpression.
+    """
+    return CompiledNumericExpression(expression)
+
+
+def compile_numeric_condition(condition):
+    """Compile a numeric condition, see CompiledNumericCondition.
+    """
+    return CompiledNumericCondition(condition)
+
+
+class CompiledNumericExpression:
+    """A numeric expression compiled into NumPy operations.
+
+    Parameters
+    ----------
+    expression : float or FLiteral or NumericOperation
+        FLiterals are function terms; their values are ignored.
+
+    Attributes
+    ----------
+    variables : [ TypedEntity ]
+        The variables of the function terms in the expression.
+    terms : [ (str, (TypedEntity, ...)) ]
+        The (function name, variables) of the function terms.
+    """
+
+    def __init__(self, expression):
+        self.variables = []
+        self.terms = []
+        self._evaluate = self._compile(expression)
+
+    def __call__(self, fluents, assignment):
+        """Evaluate the expression.
+
+        Parameters
+        ----------
+        fluents : NumericFluents
+        assignment : { TypedEntity : TypedEntity or [ TypedEntity ] }
+            The object or the N candidate objects of each variable.
+            Variables without a value are taken to be objects.
+
+        Returns
+        -------
+        values : np.ndarray
+            (N,) array, or (1,) if no candidates were given.
+        """
+        size = 1
+        for objects in assignment.values():
+            if not isinstance(objects, str):
+                size = len(objects)
+                break
+        # Undefined terms index the NaN at the end
+        values = np.append(fluents.values, np.nan)
+        context = (values, fluents.table, assignment, size, {})
+        return np.broadcast_to(self._evaluate(context), (size,))
+
+    def _compile(self, expression):
+        """Helper for __init__
+        """
+        return self._compile_expression(expression)
+
+    def _compile_expression(self, expression):
+        """Helper for _compile
+        """
+        if isinstance(expression, (int, float)):
+            value = np.float64(expression)
+            return lambda context: value
+        if isinstance(expression, NumericOperation):
+            operation = OPERATIONS[expression.operator]
+            arguments = [self._compile_expression(arg) for arg in expression.arguments]
+            if len(arguments) == 1 and expression.operator == "-":
+                return lambda context: np.negative(arguments[0](context))
+            return lambda context: functools.reduce(operation, [f(context) for f in arguments])
+        if isinstance(expression, FLiteral):
+            name, variables = expression.function.name, tuple(expression.variables)
+            for var in variables:
+                if var not in self.variables:
+                    self.variables.append(var)
+            if (name, variables) not in self.terms:
+                self.terms.append((name, variables))
+            return lambda context: context[0][_get_term_ids(context, name, variables)]
+        raise NotImplementedError("Cannot compile numeric expression {}".format(expression))
+
+
+class CompiledNumericCondition(CompiledNumericExpression):
+    """A numeric condition compiled into NumPy operations.
+
+    Supported conditions are FLiterals holding a value, as parsed from
+    (= (function ?v) 1), NumericConditions, and conjunctions and disjunctions
+    of those. Calling it returns a bool array, see
+    CompiledNumericExpression.__call__.
+
+    Parameters
+    ----------
+    condition : FLiteral or NumericCondition or LiteralConjunction
+        or LiteralDisjunction
+    """
+
+    def _compile(self, condition):
+        """Helper for __init__
+        """
+        if isinstance(condition, LiteralConjunction):
+            evaluates = [self._compile(lit) for lit in condition.literals]
+            return lambda context: functools.reduce(np.logical_and, [f(context) for f in evaluates])
+        if isinstance(condition, LiteralDisjunction):
+            evaluates = [self._compile(lit) for lit in condition.literals]
+            return lambda context: functools.reduce(np.logical_or, [f(context) for f in evaluates])
+        if isinstance(condition, NumericCondition):
+            comparator = COMPARATORS[condition.comparator]
+            left = self._compile_expression(condition.left)
+            right = self._compile_expression(condition.right)
+            return lambda context: comparator(left(context), right(context))
+        if isinstance(condition, FLiteral):
+            form = condition.function.form
+            comparator = COMPARATORS[getattr(form, "form", form)]
+            left = self._compile_expression(condition)
+            value = condition.function.value
+            if isinstance(value, FLiteral):
+                right = self._compile_expression(value)
+            else:
+                right = self._compile_expression(float(value))
+            return lambda context: comparator(left(context), right(context))
+        raise NotImplementedError("Cannot compile numeric condition {}".format(condition))
+
+
+def get_split_preconds(operator):
+    """Split the preconditions of an operator into literals and one
+    compiled numeric condition, so that the literals can be matched
+    without Prolog and the numeric conditions checked with state.fluents.
+    Computed once per operator, see operator.split_preconds.
+
+    Returns
+    -------
+    literals : [ Literal ] or None
+        None if the preconditions are not a conjunction of literals and
+        numeric conditions that can be compiled (e.g. a disjunction of
+        literals).
+    numeric_condition : CompiledNumericCondition or None
+        None if there are no numeric conditions.
+    """
+    if operator.split_preconds is None:
+        preconds = operator.preconds
+        conds = preconds.literals if isinstance(preconds, LiteralConjunction) else [preconds]
+        literals = [lit for lit in conds if isinstance(lit, Literal)]
+        numeric_conds = [lit for lit in conds if not isinstance(lit, Literal)]
+        numeric_condition = None
+        if numeric_conds:
+            try:
+                numeric_condition = CompiledNumericCondition(
+                    numeric_conds[0] if len(numeric_conds) == 1
+                    else LiteralConjunction(numeric_conds))
+            except NotImplementedError:
+                literals = None
+        operator.split_preconds = (literals, numeric_condition)
+    return operator.split_preconds
+
+
+def _get_term_ids(context, name, variables):
+    """Helper for CompiledNumericExpression. Ids of the terms for each
+    assignment, with undefined terms at -1.
+    """
+    values, table, assignment, size, cache = context
+    key = (name, variables)
+    if key not in cache:
+        columns = [assignment.get(var, var) for var in variables]
+        if all(isinstance(objects, str) for objects in columns):
+            ids = np.array(table.get_id(name, columns))
+        else:
+            columns = [[objects] * size if isinstance(objects, str) else objects
+                       for objects in columns]
+            ids = np.fromiter((table.get_id(name, objects) for objects in zip(*columns)),
+                              dtype=np.int64, count=size)
+        cache[key] = np.where((ids < 0) | (ids >= len(values) - 1), len(values) - 1, ids)
+    return cache[key]
+
+
+def fluent_literal(function, objects, value):
+    """Create a ground function literal with a value, like the parser
+    does for (= (function objects) value).
+    """
+    literal = function(*objects)
+    literal.function = copy.copy(literal.function)
+    literal.function.form = Equation()
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    literal.function.value = str(value)
+    return literal
+
+
+class ConditionalEffects:
+    """The When and Assign effects of an operator, compiled once.
+
+    All When conditions are evaluated against the state before the
+    effects. The When branches they trigger only depend on the values of
+    the function terms that the numeric conditions read and on the truth
+    of the literal conditions, so they are cached by those: for the
+    flatland domain, the new direction of an agent is a dict lookup by
+    its old direction.
+
+    Parameters
+    ----------
+    effects : [ When or Assign ]
+    max_cached : int
+        Number of condition contexts whose triggered branches are kept.
+        The least recently used are dropped first, so that conditions
+        on values that keep changing (e.g. a fuel level) do not grow
+        the cache without bound.
+    """
+
+    def __init__(self, effects, max_cached=1024):
+        # Unconditional (literal effects, assigns), then one per When
+        self._branches = []
+        # (CompiledNumericCondition or None, [ Literal ]) per When
+        self._conditions = []
+        self._numeric_terms = []
+        self._literal_conditions = []
+        unconditional = []
+        for effect in effects:
+            if isinstance(effect, When):
+                self._add_when(effect)
+            else:
+                unconditional.append(effect)
+        self._branches.insert(0, self._compile_effects(unconditional))
+        # Condition context -> indices of triggered self._branches, least
+        # recently used first
+        self.max_cached = max_cached
+        self._triggered_cache = OrderedDict()
+
+    def apply(self, state, assignment):
+        """Get the ground effects of the operator in a state.
+
+        Parameters
+        ----------
+        state : State or BitsetState
+        assignment : { TypedEntity : TypedEntity }
+
+        Returns
+        -------
+        add_effects : { Literal }
+        delete_effects : { Literal }
+            Literals to delete; these are not inverted anti-literals.
+        updates : { (str, (TypedEntity, ...)) : (Function, float) }
+            The function and new value of each assigned term.
+        """
+        fluents = state.fluents
+        if fluents is None and (self._numeric_terms or self._has_assigns):
+            fluents = NumericFluents.from_literals(state.literals)
+        key = self._get_context(state, fluents, assignment)
+        triggered = self._triggered_cache.get(key)
+        if triggered is None:
+            triggered = self._triggered_cache[key] = self._get_triggered(
+                state, fluents, assignment)
+            if len(self._triggered_cache) > self.max_cached:
+                self._triggered_cache.popitem(last=False)
+        else:
+            self._triggered_cache.move_to_end(key)
+
+        add_effects, delete_effects, updates = set(), set(), {}
+        for idx in triggered:
+            literals, assigns = self._branches[idx]
+            for lit in literals:
+                effect = ground_literal(lit, assignment)
+                if effect.is_anti:
+                    delete_effects.add(effect.inverted_anti)
+                else:
+                    add_effects.add(effect)
+            for term, value in assigns:
+                objects = tuple(assignment.get(var, var) for var in term.variables)
+                if not isinstance(value, float):
+                    value = float(value(fluents, assignment)[0])
+                updates[(term.function.name, objects)] = (term.function, value)
+        return add_effects, delete_effects, updates
+
+    @property
+    def _has_assigns(self):
+        return any(assigns for _, assigns in self._branches)
+
+    def _add_when(self, when):
+        """Helper for __init__
+        """
+        condition = when.literal
+        if isinstance(condition, LiteralConjunction):
+            conds = condition.literals
+        else:
+            conds = [condition]
+        literal_conds = [lit for lit in conds if isinstance(lit, Literal)]
+        numeric_conds = [lit for lit in conds if not isinstance(lit, Literal)]
+        compiled = None
+        if numeric_conds:
+            compiled = CompiledNumericCondition(
+                numeric_conds[0] if len(numeric_conds) == 1
+                else LiteralConjunction(numeric_conds))
+            for term in compiled.terms:
+                if term not in self._numeric_terms:
+                    self._numeric_terms.append(term)
+        for lit in literal_conds:
+            if lit not in self._literal_conditions:
+                self._literal_conditions.append(lit)
+        self._conditions.append((compiled, literal_conds))
+        effects = when.variables
+        if not isinstance(effects, list):
+            effects = [effects]
+        self._branches.append(self._compile_effects(effects))
+
+    @staticmethod
+    def _compile_effects(effects):
+        """Helper for __init__. Split effects into literal effects and
+        (FLiteral term, float or CompiledNumericExpression) assigns.
+        """
+        literals, assigns = [], []
+        for effect in effects:
+            if isinstance(effect, LiteralConjunction):
+                effect_literals, effect_assigns = ConditionalEffects._compile_effects(
+                    effect.literals)
+                literals.extend(effect_literals)
+                assigns.extend(effect_assigns)
+            elif isinstance(effect, Assign):
+                value = effect.variables[0]
+                if isinstance(value, (int, float)):
+                    value = float(value)
+                else:
+                    value = CompiledNumericExpression(value)
+                assigns.append((effect.literal, value))
+            elif isinstance(effect, Literal):
+                literals.append(effect)
+            else:
+                raise NotImplementedError("Cannot compile effect {}".format(effect))
+        return literals, assigns
+
+    def _get_context(self, state, fluents, assignment):
+        """Helper for apply. The values and truths that the When
+        conditions depend on.
+        """
+        context = []
+        for name, variables in self._numeric_terms:
+            value = fluents.get(name, [assignment.get(var, var) for var in variables])
+            # NaN is not equal to itself
+            context.append(None if np.isnan(value) else value)
+        for lit in self._literal_conditions:
+            context.append(_holds(state, ground_literal(lit, assignment)))
+        return tuple(context)
+
+    def _get_triggered(self, state, fluents, assignment):
+        """Helper for apply
+        """
+        triggered = [0]
+        for idx, (compiled, literal_conds) in enumerate(self._conditions):
+            if compiled is not None and not compiled(fluents, assignment)[0]:
+                continue
+            if not all(_holds(state, ground_literal(lit, assignment)) for lit in literal_conds):
+                continue
+            triggered.append(idx + 1)
+        return tuple(triggered)
+
+
+def _holds(state, literal):
+    """Helper for ConditionalEffects
+    """
+    if literal.is_negative:
+        return literal.positive not in state.literals
+    return literal in state.literals
@@ -1,11 +1,19 @@
 """PDDL parsing.
 """
-from copy import deepcopy
+from array import array
+from collections import defaultdict
+from copy import copy
 
-from pddlflatland.structs import (Type, Predicate, Function, LiteralConjunction, LiteralDisjunction,
+from pddlflatland.structs import (Type, Predicate, Function, Literal, LiteralConjunction, LiteralDisjunction,
                              Not, Anti, ForAll, Exists, When, Assign, ProbabilisticEffect,
-                             TypedEntity, ground_literal, FLiteral, Equation, Greater, Less)
-
+                             TypedEntity, ground_literal, FLiteral, Equation, Greater, Less,
+                             NumericOperation, NumericCondition)
+from pddlflatland.grounding import GroundOperatorTable
+from pddlflatland.datalog import DatalogEvaluator
+from pddlflatland.numeric import FluentTable, NumericFluents
+from pddlflatland.downward_translate.pddl_parser.lisp_parser import ParseError
+
+import numpy as np
 import re
 
 FAST_DOWNWARD_STR = """
@@ -30,6 +38,16 @@ PROBLEM_STR = """
 """
 
 
+# Parentheses and the tokens between them
+_TOKEN_RE = re.compile(r"[()]|[^\s()]+")
+_COMMENT_RE = re.compile(r";[^\n]*")
+_COMPARATORS = ("<=", ">=", "=", "<", ">")
+_OPERATORS = ("+", "-", "*", "/")
+# Heads of expressions that are not predicates or functions
+_KEYWORDS = frozenset(("and", "or", "forall", "exists", "probabilistic", "not", "at", "over",
+                       "when", "assign") + _COMPARATORS + _OPERATORS)
+
+
 class BasicOperator:
     """Class to hold an operator.
     """
@@ -54,6 +72,15 @@ class Operator(BasicOperator):
         super(Operator, self).__init__(name, params)
         self.preconds = preconds  # structs.Literal representing preconditions
         self.effects = effects  # structs.Literal representing effects
+        # inference.QueryPlan of the preconditions, built lazily by
+        # core._select_operator for inference_mode="csp"
+        self.query_plan = None
+        # numeric.ConditionalEffects of the When and Assign effects, built
+        # lazily by core._apply_effects
+        self.conditional_effects = None
+        # (literals, numeric.CompiledNumericCondition or None) of the
+        # preconditions, built lazily by numeric.get_split_preconds
+        self.split_preconds = None
 
     def pddl_str(self):
         param_strs = [str(param).replace(":", " - ") for param in self.params]
@@ -153,271 +180,311 @@ class DurationOperator(BasicOperator):
         return "\n\t\t\t".join(condition_strs)
 
 
+def parse_sexp(text):
+    """Parse PDDL text into s-expressions in a single pass.
+
+    Parameters
+    ----------
+    text : str
+        PDDL text without comments.
+
+    Returns
+    -------
+    exprs : [ list or str ]
+        The top-level expressions; lists are parenthesized expressions
+        and str are the other tokens.
+    """
+    stack = [[]]
+    for token in _TOKEN_RE.findall(text):
+        if token == "(":
+            stack.append([])
+        elif token == ")":
+            if len(stack) == 1:
+                raise ParseError("Unexpected ')'")
+            expr = stack.pop()
+            stack[-1].append(expr)
+        else:
+            stack[-1].append(token)
+    if len(stack) > 1:
+        raise ParseError("Missing ')'")
+    return stack[0]
+
+
+def iter_tokens(f, chunk_size=1 << 16):
+    """Tokenize PDDL read incrementally from a file handle.
+
+    The text is read in chunks, lowercased and purged of comments one
+    line at a time, so that only a chunk is held in memory at once.
+
+    Parameters
+    ----------
+    f : file
+        A text file handle.
+    chunk_size : int
+
+    Yields
+    ------
+    token : str
+        "(", ")" or the other tokens, as in parse_sexp.
+    """
+    rest = ""
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        text = rest + chunk
+        # Keep the last, possibly partial, line for the next chunk
+        end = text.rfind("\n") + 1
+        rest = text[end:]
+        yield from _TOKEN_RE.findall(_COMMENT_RE.sub("", text[:end].lower()))
+    yield from _TOKEN_RE.findall(_COMMENT_RE.sub("", rest.lower()))
+
+
+def read_sexp(tokens):
+    """Read the rest of an s-expression whose "(" was just consumed
+    from tokens, see iter_tokens.
+
+    Returns
+    -------
+    expr : list
+    """
+    stack = [[]]
+    for token in tokens:
+        if token == "(":
+            stack.append([])
+        elif token == ")":
+            expr = stack.pop()
+            if not stack:
+                return expr
+            stack[-1].append(expr)
+        else:
+            stack[-1].append(token)
+    raise ParseError("Missing ')'")
+
+
+def sexp_to_str(expr):
+    """Write an s-expression as PDDL text.
+    """
+    if isinstance(expr, str):
+        return expr
+    return "(" + " ".join(map(sexp_to_str, expr)) + ")"
+
+
 class PDDLParser:
     """PDDL parsing class.
+
+    Files are read into s-expressions (see parse_sexp) that the
+    _parse_* methods turn into structs.
     """
 
-    def _parse_into_literal(self, string, params, is_effect=False, is_func=False):
-        """Parse the given string (representing either preconditions or effects)
+    def _parse_into_literal(self, expr, params, is_effect=False, is_func=False):
+        """Parse the given s-expression (representing either preconditions or effects)
         into a literal. Check against params to make sure typing is correct.
+
+        params : {str : TypedEntity}
+            Maps the variables or objects in scope from their names.
         """
-        # assert string[0] == "("
-        # assert string[-1] == ")"
-        if string.startswith("(and") and string[4] in (" ", "\n", "("):
-            clauses = self._find_all_balanced_expressions(string[4:-1].strip())
-            return LiteralConjunction([self._parse_into_literal(clause, params,
-                                                                is_effect=is_effect) for clause in clauses])
-        if string.startswith("(or") and string[3] in (" ", "\n", "("):
-            clauses = self._find_all_balanced_expressions(string[3:-1].strip())
-            return LiteralDisjunction([self._parse_into_literal(clause, params,
-                                                                is_effect=is_effect) for clause in clauses])
-        if string.startswith("(forall") and string[7] in (" ", "\n", "("):
-            new_binding, clause = self._find_all_balanced_expressions(
-                string[7:-1].strip())
-            new_name, new_type_name = new_binding.strip()[1:-1].split("-")
-            new_name = new_name.strip()
-            new_type_name = new_type_name.strip()
-            assert new_name not in params, "ForAll variable {} already exists".format(new_name)
-            params[new_name] = self.types[new_type_name]
-            result = ForAll(self._parse_into_literal(clause, params, is_effect=is_effect),
-                            TypedEntity(new_name, params[new_name]))
-            del params[new_name]
+        if isinstance(expr, str):
+            # The whole expression is a number
+            if expr.isdigit():
+                return expr
+            raise ParseError("Expected an expression, got {}".format(expr))
+        if not expr:
+            return LiteralConjunction([])
+        head = expr[0]
+        if head not in _KEYWORDS:
+            return self._parse_atom(expr, params, is_func=is_func)
+
+        if head == "and":
+            return LiteralConjunction([self._parse_into_literal(clause, params, is_effect=is_effect)
+                                       for clause in expr[1:]])
+        if head == "or":
+            return LiteralDisjunction([self._parse_into_literal(clause, params, is_effect=is_effect)
+                                       for clause in expr[1:]])
+        if head == "forall":
+            variables = self._parse_variables(expr[1])
+            for v in variables:
+                assert v.name not in params, "ForAll variable {} already exists".format(v.name)
+                params[v.name] = v
+            result = self._parse_into_literal(expr[2], params, is_effect=is_effect)
+            for v in reversed(variables):
+                result = ForAll(result, v)
+                del params[v.name]
             return result
-        if string.startswith("(exists") and string[7] in (" ", "\n", "("):
-            new_binding, clause = self._find_all_balanced_expressions(
-                string[7:-1].strip())
-            if new_binding[1:-1] == "":
+        if head == "exists":
+            if not expr[1]:
                 # Handle existential goal with no arguments.
-                body = self._parse_into_literal(clause, params, is_effect=is_effect)
-                return body
-            variables = self._parse_objects(new_binding[1:-1])
+                return self._parse_into_literal(expr[2], params, is_effect=is_effect)
+            variables = self._parse_objects(expr[1])
             for v in variables:
-                params[v.name] = v.var_type
-            body = self._parse_into_literal(clause, params, is_effect=is_effect)
-            result = Exists(variables, body)
+                params[v.name] = v
+            body = self._parse_into_literal(expr[2], params, is_effect=is_effect)
             for v in variables:
                 del params[v.name]
-            return result
-        if string.startswith("(probabilistic") and string[14] in (" ", "\n", "("):
+            return Exists(variables, body)
+        if head == "probabilistic":
             assert is_effect, "We only support probabilistic effects"
-            lits = []
-            probs = []
-            expr = string[14:-1].strip()
-            for match in re.finditer("(\d*\.?\d+)", expr):
-                prob = float(match.group())
-                subexpr = self._find_balanced_expression(expr[match.end():].strip(), 0)
-                lit = self._parse_into_literal(subexpr, params, is_effect=is_effect)
-                lits.append(lit)
-                probs.append(prob)
+            probs = [float(prob) for prob in expr[1::2]]
+            lits = [self._parse_into_literal(subexpr, params, is_effect=is_effect)
+                    for subexpr in expr[2::2]]
             return ProbabilisticEffect(lits, probs)
-        if string.startswith("(not") and string[4] in (" ", "\n", "("):
-            clause = string[4:-1].strip()
+        if head == "not":
             if is_effect:
-                return Anti(self._parse_into_literal(clause, params, is_effect=is_effect))
+                return Anti(self._parse_into_literal(expr[1], params, is_effect=is_effect))
             else:
-                return Not(self._parse_into_literal(clause, params, is_effect=is_effect))
+                return Not(self._parse_into_literal(expr[1], params, is_effect=is_effect))
         # Durative Action
-        if string.startswith("(at start") and string[9] in (" ", "\n", "("):
-            return string[9:-1].strip()
-
-        if string.startswith("(at end") and string[7] in (" ", "\n", "("):
-            return string[7:-1].strip()
-
-        if string.startswith("(over all") and string[9] in (" ", "\n", "("):
-            return string[9:-1].strip()
+        if (head == "at" and expr[1:2] in (["start"], ["end"])) or \
+                (head == "over" and expr[1:2] == ["all"]):
+            return " ".join(map(sexp_to_str, expr[2:]))
 
         # Numeric Expression
-        if (string.startswith("(=") or string.startswith("(-") or string.startswith("(+")) and \
-                string[2] in (" ", "\n", "(") and not is_func:
-            if string[2] == " ":
-                index = 3
-            else:
-                index = 2
-            node_string = self._find_balanced_expression(string.strip(), index).strip()
-            if node_string.count('(') > 1:
-                node = deepcopy(self._parse_into_literal(node_string, params, is_effect=is_effect,
-                                                         is_func=False))
-            else:
-                node = deepcopy(self._parse_into_literal(node_string, params, is_effect=is_effect,
-                                                         is_func=True))
-            children_string = string[index + len(node_string): -1].strip()
-            # (= (function int or float) (= (other function) int or float))
-            if children_string.startswith('('):
-                children_string = self._parse_into_literal(children_string, params, is_effect=is_effect,
-                                                           is_func=True)
-            # (= (function ?v) (int or float))
-            if isinstance(node, FLiteral):
-                form = string.strip()[1]
+        if head in _COMPARATORS and not is_func:
+            node = self._parse_numeric_expression(expr[1], params)
+            value = self._parse_numeric_expression(expr[2], params)
+            # (= (function ?v) (int or float)) or (= (function ?v) (other function))
+            if isinstance(node, FLiteral) and head in ("=", ">", "<") and \
+                    not isinstance(value, NumericOperation):
+                node.function = copy(node.function)
                 form_exp = Equation()
-                if form == ">":
+                if head == ">":
                     form_exp = Greater()
-                if form == "<":
+                if head == "<":
                     form_exp = Less()
                 node.function.form = form_exp
-                node.function.value = deepcopy(children_string)
-            return node
-
-        if string.startswith("(when") and string[5] in (" ", "\n", "("):
-            new_binding, clause = self._find_all_balanced_expressions(string[5:-1].strip())
-            front = self._parse_into_literal(new_binding, params, is_effect=is_effect, is_func=False)
-            backend = self._parse_into_literal(clause, params, is_effect=is_effect, is_func=False)
+                node.function.value = expr[2] if isinstance(value, float) else value
+                return node
+            return NumericCondition(head, node, value)
+        if head in _OPERATORS and not is_func:
+            return self._parse_numeric_expression(expr, params)
+
+        if head == "when":
+            front = self._parse_into_literal(expr[1], params, is_effect=is_effect, is_func=False)
+            backend = self._parse_into_literal(expr[2], params, is_effect=is_effect, is_func=False)
             return When(front, backend)
 
-        if string.startswith("(assign") and string[7] in (" ", "\n", "("):
-            index = 8
-            parent_string = self._find_balanced_expression(string.strip(), index).strip()
-            children_string = string[index + len(parent_string):-1].strip()
-            if children_string.count('(') > 1:
-                children = self._parse_into_literal(children_string, params, is_effect=is_effect, is_func=False)
-            else:
-                children = self._parse_into_literal(children_string, params, is_effect=is_effect, is_func=True)
-            return Assign(parent_string, children)
-        # The whole string is number
-        if string.isdigit():
-            return string
-
-        if is_func:  # Function Expression
-            string = string[1:-1].split()
-            func_name, args = string[0], string[1:]
-
-            typed_args = []
-            assert func_name in self.functions, "Function {} is not defined".format(func_name)
-            assert self.functions[func_name].arity == len(args), func_name
-            for i, arg in enumerate(args):
-                if arg not in params:
-                    raise Exception("Argument {} not in params {}".format(arg, params))
-                assert arg in params, "Argument {} is not in the params".format(arg)
-                if isinstance(params, dict):
-                    typed_arg = TypedEntity(arg, params[arg])
-                else:
-                    typed_arg = params[params.index(arg)]
-                typed_args.append(typed_arg)
+        if head == "assign":
+            # (assign (function ?v) numeric expression)
+            parent = self._parse_into_literal(expr[1], params, is_func=True)
+            children = self._parse_numeric_expression(expr[2], params)
+            return Assign(parent, children)
 
-            return self.functions[func_name](*typed_args)
+        return self._parse_atom(expr, params, is_func=is_func)
 
+    def _parse_atom(self, expr, params, is_func=False):
+        """Parse a predicate or (if is_func) a function expression.
+        """
+        name, args = expr[0], expr[1:]
+        if is_func:  # Function Expression
+            assert name in self.functions, "Function {} is not defined".format(name)
+            factory = self.functions[name]
         else:  # Predicate Expression
-            string = string[1:-1].split()
-            pred, args = string[0], string[1:]
-            typed_args = []
-            # Validate types against the given params dict.
-            assert pred in self.predicates, "Predicate {} is not defined".format(pred)
-            assert self.predicates[pred].arity == len(args), pred
-            for i, arg in enumerate(args):
-                if arg not in params:
-                    raise Exception("Argument {} not in params {}".format(arg, params))
-                assert arg in params, "Argument {} is not in the params".format(arg)
-                if isinstance(params, dict):
-                    typed_arg = TypedEntity(arg, params[arg])
-                else:
-                    typed_arg = params[params.index(arg)]
-                typed_args.append(typed_arg)
-            _test = self.predicates[pred]
-            return self.predicates[pred](*typed_args)
-
-    def _parse_objects(self, objects):
-        if self.uses_typing:
-            # Assume typed objects are new-line separated.
-            objects = objects.split("\n")
-        else:
-            # Untyped objects can be separated by any form of whitespace.
-            objects = objects.split()
-        obj_names = []
-        obj_type_names = []
-        for obj in objects:
-            if not obj.strip():
-                continue
+            assert name in self.predicates, "Predicate {} is not defined".format(name)
+            factory = self.predicates[name]
+        assert factory.arity == len(args), name
+        # Validate types against the given params dict.
+        typed_args = []
+        for arg in args:
+            typed_arg = params.get(arg)
+            if typed_arg is None:
+                raise Exception("Argument {} not in params {}".format(arg, params))
+            typed_args.append(typed_arg)
+        return factory(*typed_args)
+
+    def _parse_numeric_expression(self, expr, params):
+        """Parse a number, a function term or an arithmetic operation on
+        numeric expressions. Numbers are returned as floats.
+        """
+        if isinstance(expr, str):
+            return float(expr)
+        if expr and expr[0] in _OPERATORS:
+            return NumericOperation(expr[0], [self._parse_numeric_expression(arg, params)
+                                              for arg in expr[1:]])
+        return self._parse_into_literal(expr, params, is_func=True)
+
+    @staticmethod
+    def _parse_typed_groups(tokens):
+        """Split a typed list like ?x ?y - type1 ?z -type2 into
+        ([names], type name) groups; the type name of names that are not
+        followed by one is None.
+        """
+        groups = []
+        names = []
+        index = 0
+        while index < len(tokens):
+            token = tokens[index]
+            if token == "-":
+                groups.append((names, tokens[index + 1]))
+                names = []
+                index += 2
+            elif token.startswith("-"):
+                groups.append((names, token[1:]))
+                names = []
+                index += 1
+            else:
+                names.append(token)
+                index += 1
+        if names:
+            groups.append((names, None))
+        return groups
+
+    def _parse_variables(self, tokens):
+        """Parse typed variables, e.g. of parameters, into TypedEntitys.
+        """
+        variables = []
+        for names, type_name in self._parse_typed_groups(tokens):
             if self.uses_typing:
-                obj_name, obj_type_name = obj.strip().split(" - ")
-                obj_name = obj_name.strip()
-                obj_type_name = obj_type_name.strip()
-                if len(obj_name.split()) > 1:
-                    for single_obj_name in obj_name.split():
-                        obj_names.append(single_obj_name.strip())
-                        obj_type_names.append(obj_type_name)
-                else:
-                    obj_names.append(obj_name)
-                    obj_type_names.append(obj_type_name)
+                assert type_name is not None, "Variables {} have no type".format(names)
+                var_type = self.types[type_name]
             else:
-                obj_name = obj.strip()
-                if " - " in obj_name:
-                    obj_name, temp = obj_name.split(" - ")
-                    obj_name = obj_name.strip()
-                    assert temp == "default"
-                obj_type_name = "default"
-                obj_names.append(obj_name)
-                obj_type_names.append(obj_type_name)
+                var_type = self.types["default"]
+            variables.extend(var_type(name) for name in names)
+        return variables
+
+    def _parse_objects(self, tokens):
         to_return = set()
-        for obj_name, obj_type_name in zip(obj_names, obj_type_names):
-            if obj_type_name not in self.types:
-                print("Warning: type not declared for object {}, type {}".format(
-                    obj_name, obj_type_name))
-                obj_type = Type(obj_type_name)
-            else:
-                obj_type = self.types[obj_type_name]
-            to_return.add(TypedEntity(obj_name, obj_type))
+        for obj_names, obj_type_name in self._parse_typed_groups(tokens):
+            if not self.uses_typing:
+                assert obj_type_name in (None, "default")
+                obj_type_name = "default"
+            assert obj_type_name is not None, "Objects {} have no type".format(obj_names)
+            for obj_name in obj_names:
+                if obj_type_name not in self.types:
+                    print("Warning: type not declared for object {}, type {}".format(
+                        obj_name, obj_type_name))
+                    obj_type = Type(obj_type_name)
+                else:
+                    obj_type = self.types[obj_type_name]
+                to_return.add(TypedEntity(obj_name, obj_type))
         return sorted(to_return)
 
-    def _purge_comments(self, pddl_str):
+    @staticmethod
+    def _purge_comments(pddl_str):
         # Purge comments from the given string.
-        while True:
-            match = re.search(r";(.*)\n", pddl_str)
-            if match is None:
-                return pddl_str
-            start, end = match.start(), match.end()
-            pddl_str = pddl_str[:start] + pddl_str[end - 1:]
+        return _COMMENT_RE.sub("", pddl_str)
 
     @staticmethod
-    def _find_balanced_expression(string, index):
-        """Find balanced expression in string starting from given index.
+    def _get_sections(define):
+        """Map the heads of the sections of a (define ...) expression to
+        their lists of sections, e.g. ":action" to all the operators.
         """
-        if string.isdigit():
-            return string
-        else:
-            assert string[index] == "(", '"{}" in "{}"'.format(string[index], string)
-
-        start_index = index
-        balance = 1
-        while balance != 0:
-            index += 1
-            symbol = string[index]
-            if symbol == "(":
-                balance += 1
-            elif symbol == ")":
-                balance -= 1
-        return string[start_index:index + 1]
+        assert define and define[0] == "define", "Expected (define ...)"
+        sections = defaultdict(list)
+        for section in define[1:]:
+            if isinstance(section, list) and section:
+                sections[section[0]].append(section)
+        return sections
 
     @staticmethod
-    def _find_all_balanced_expressions(string):
-        """Return a list of all balanced expressions in a string,
-        starting from the beginning.
+    def _get_keyword_arguments(expr):
+        """Map the :keywords of an expression like (:action name
+        :parameters (...) ...) to the expressions following them.
         """
-
-        assert string[0] == "(", string
-        assert string[-1] == ")", string
-        exprs = []
-        index = 0
-        start_index = index
-        balance = 1
-        while index < len(string) - 1:
-            index += 1
-            if balance == 0:
-                exprs.append(string[start_index:index])
-                # Jump to next "(".
-                while True:
-                    if string[index] == "(":  # Jump the line (跳到下一行开始)
-                        break
-                    index += 1
-                start_index = index
-                balance = 1
-                continue
-            symbol = string[index]
-            if symbol == "(":
-                balance += 1
-            elif symbol == ")":
-                balance -= 1
-        assert balance == 0
-        exprs.append(string[start_index:index + 1])
-        return exprs
+        arguments = {}
+        for index, token in enumerate(expr):
+            if isinstance(token, str) and token.startswith(":") and index + 1 < len(expr):
+                arguments[token] = expr[index + 1]
+        return arguments
 
 
 class PDDLDomain:
@@ -425,7 +492,8 @@ class PDDLDomain:
     """
 
     def __init__(self, domain_name=None, types=None, type_hierarchy=None, predicates=None, functions=None,
-                 operators=None, actions=None, operators_as_actions=False, is_probabilistic=False):
+                 operators=None, actions=None, constants=None, operators_as_actions=False,
+                 is_probabilistic=False):
         # String of domain name.
         self.domain_name = domain_name
         # Dict from type name -> structs.Type object.
@@ -440,8 +508,120 @@ class PDDLDomain:
         self.operators = operators
         # Action predicate names (not part of standard PDDL)
         self.actions = actions
+        # List of structs.TypedEntity constants.
+        self.constants = constants or []
         self.operators_as_actions = operators_as_actions
         self.is_probabilistic = is_probabilistic
+        # Built lazily, see self.ground_operator_table.
+        self._ground_operator_table = None
+        # Built lazily, see self.derived_predicate_evaluator.
+        self._derived_predicate_evaluator = None
+        self._derived_predicates_compiled = False
+        # Built lazily, see self.get_action_operators.
+        self._action_to_operators = None
+
+    @property
+    def ground_operator_table(self):
+        """Lazily create the table of ground operators used for
+        inference_mode="grounded" (see pddlflatland.grounding).
+        """
+        if self._ground_operator_table is None:
+            self._ground_operator_table = GroundOperatorTable(self)
+        return self._ground_operator_table
+
+    def get_action_operators(self, action_predicate):
+        """Get the operators that may be selected by taking an action.
+
+        With operators_as_actions, this is the operator with the name
+        of the action predicate. Otherwise, these are the operators with
+        the action predicate among the literals of their preconditions.
+
+        Parameters
+        ----------
+        action_predicate : Predicate
+
+        Returns
+        -------
+        operators : [ Operator ]
+        """
+        if self._action_to_operators is None:
+            self._action_to_operators = self._create_action_to_operators()
+        if self.operators_as_actions:
+            return self._action_to_operators.get(action_predicate.name.lower(), [])
+        return self._action_to_operators.get(str(action_predicate), [])
+
+    def _create_action_to_operators(self):
+        """Helper for get_action_operators
+        """
+        action_to_operators = defaultdict(list)
+        for name, operator in self.operators.items():
+            if self.operators_as_actions:
+                action_to_operators[name.lower()].append(operator)
+                continue
+            if isinstance(operator.preconds, Literal):
+                conds = [operator.preconds]
+            else:
+                conds = operator.preconds.literals
+            for key in {str(lit.predicate) for lit in conds if isinstance(lit, Literal)}:
+                action_to_operators[key].append(operator)
+        if self.operators_as_actions:
+            assert all(len(ops) == 1 for ops in action_to_operators.values()), \
+                "Operator names must be unique"
+        return dict(action_to_operators)
+
+    @property
+    def derived_predicate_evaluator(self):
+        """Lazily compile the derived predicates into Datalog rules (see
+        pddlflatland.datalog). None if some derived predicate cannot be
+        compiled, in which case Prolog must be used instead.
+        """
+        if not self._derived_predicates_compiled:
+            try:
+                self._derived_predicate_evaluator = DatalogEvaluator(self)
+            except NotImplementedError:
+                self._derived_predicate_evaluator = None
+            self._derived_predicates_compiled = True
+        return self._derived_predicate_evaluator
+
+    def get_static_functions(self):
+        """Get the names of the functions that no operator assigns.
+
+        Returns
+        -------
+        static_functions : { str }
+        """
+        assigned = {effect.literal.function.name for effect in self._iter_effects()
+                    if isinstance(effect, Assign)}
+        return set(self.functions or {}) - assigned
+
+    def get_static_predicates(self):
+        """Get the names of the predicates that no operator adds or
+        deletes. Action predicates are not included.
+
+        Returns
+        -------
+        static_predicates : { str }
+        """
+        changed = {effect.predicate.name for effect in self._iter_effects()
+                   if isinstance(effect, Literal)}
+        return set(self.predicates) - set(self.actions or ()) - changed
+
+    def _iter_effects(self):
+        """Helper for get_static_functions and get_static_predicates
+        """
+        for operator in self.operators.values():
+            effects = [operator.effects]
+            while effects:
+                effect = effects.pop()
+                if isinstance(effect, When):
+                    # The effect of (when condition effect)
+                    effects.append(effect.variables)
+                elif isinstance(effect, list):
+                    effects.extend(effect)
+                elif hasattr(effect, "literals"):
+                    effects.extend(effect.literals)
+                else:
+                    yield effect
 
     @property
     def type_to_parent_types(self):
@@ -551,10 +731,8 @@ class PDDLDomainParser(PDDLParser, PDDLDomain):
             self.actions = set()
 
     def _parse_actions(self):
-        start_ind = re.search(r"\(:actions", self.domain).start()
-        actions = self._find_balanced_expression(self.domain, start_ind)
-        actions = actions[9:-1].strip()
-        return set(actions.split())
+        sections = self._get_sections(parse_sexp(self.domain)[0])
+        return set(sections[":actions"][0][1:])
 
     def _create_actions_from_operators(self):
         actions = set()
@@ -567,45 +745,35 @@ class PDDLDomainParser(PDDLParser, PDDLDomain):
         return actions
 
     def _parse_domain(self, is_duration):
-        patt = r"\(domain(.*?)\)"
-        self.domain_name = re.search(patt, self.domain).groups()[0].strip()
-        self._parse_domain_types()
-        self._parse_domain_predicates()
-        self._parse_domain_functions()
-        self._parse_domain_operators(is_duration=is_duration)  # whether duration action in domain or not
-
-    def _parse_domain_types(self):
-        match = re.search(r"\(:types", self.domain)
-        if not match:
+        sections = self._get_sections(parse_sexp(self.domain)[0])
+        self.domain_name = sections["domain"][0][1]
+        self._parse_domain_types(sections[":types"])
+        self._parse_domain_predicates(sections[":predicates"])
+        self._parse_domain_functions(sections[":functions"])
+        # whether duration action in domain or not
+        if is_duration:
+            self._parse_domain_operators(sections[":durative-action"], is_duration=True)
+        else:
+            self._parse_domain_operators(sections[":action"])
+
+    def _parse_domain_types(self, sections):
+        if not sections:
             self.types = {"default": Type("default")}
             self.type_hierarchy = {}
             self.uses_typing = False
             return
         self.uses_typing = True
-        start_ind = match.start()
-        types = self._find_balanced_expression(self.domain, start_ind)
+        types = sections[0][1:]
         # Non-hierarchical types
-        if " - " not in types:
-            types = types[7:-1].split()
+        if not any(token.startswith("-") for token in types):
             self.types = {type_name: Type(type_name) for type_name in types}
             self.type_hierarchy = {}
         # Hierarchical types
         else:
             self.types = {}
             self.type_hierarchy = {}
-            remaining_type_str = types[7:-1]
-            while " - " in remaining_type_str:
-                dash_index = remaining_type_str.index(" - ")
-                s = remaining_type_str[dash_index:]
-                super_start_index = dash_index + len(s) - len(s.lstrip()) + 2
-                s = remaining_type_str[super_start_index:]
-                try:
-                    end_index_offset = min(s.index(" "), s.index("\n"))
-                except ValueError:
-                    end_index_offset = len(s)
-                super_end_index = super_start_index + end_index_offset
-                super_type_name = remaining_type_str[super_start_index:super_end_index]
-                sub_type_names = remaining_type_str[:dash_index].split()
+            for sub_type_names, super_type_name in self._parse_typed_groups(types):
+                assert super_type_name is not None, "Cannot mix hierarchical and non-hierarchical types"
                 # Add new types
                 for new_type in sub_type_names + [super_type_name]:
                     if new_type not in self.types:
@@ -616,114 +784,48 @@ class PDDLDomainParser(PDDLParser, PDDLDomain):
                     self.type_hierarchy[super_type].update({self.types[t] for t in sub_type_names})
                 else:
                     self.type_hierarchy[super_type] = {self.types[t] for t in sub_type_names}
-                remaining_type_str = remaining_type_str[super_end_index:]
-            assert len(remaining_type_str.strip()) == 0, "Cannot mix hierarchical and non-hierarchical types"
 
-    def _parse_domain_predicates(self):
-        start_ind = re.search(r"\(:predicates", self.domain)
-        if not start_ind:
+    def _parse_domain_predicates(self, sections):
+        if not sections:
             return
-        start_ind = start_ind.start()
-        predicates = self._find_balanced_expression(self.domain, start_ind)
-        predicates = predicates[12:-1].strip()
-        predicates = self._find_all_balanced_expressions(predicates)
         self.predicates = {}
-        for pred in predicates:
-            pred = pred.strip()[1:-1].split("?")
-            pred_name = pred[0].strip()
-            # arg_types = [self.types[arg.strip().split("-")[1].strip()]
-            #              for arg in pred[1:]]
-            arg_types = []
-            for arg in pred[1:]:
-                if ' - ' in arg:
-                    assert arg_types is not None, "Mixing of typed and untyped args not allowed"
-                    assert self.uses_typing
-                    arg_type = self.types[arg.strip().split("-")[1].strip()]
-                    arg_types.append(arg_type)
-                else:
-                    assert not self.uses_typing
-                    arg_types.append(self.types["default"])
-            self.predicates[pred_name] = Predicate(
-                pred_name, len(pred[1:]), arg_types)
-
-    def _parse_domain_functions(self):
-        # start_ind = re.search(r"\(:functions", self.domain).start()
-        start_ind = re.search(r"\(:functions", self.domain)
-        if not start_ind:
+        for pred_name, arg_types in self._parse_signatures(sections[0][1:]):
+            self.predicates[pred_name] = Predicate(pred_name, len(arg_types), arg_types)
+
+    def _parse_domain_functions(self, sections):
+        if not sections:
             return
-        start_ind = start_ind.start()
-        functions = self._find_balanced_expression(self.domain, start_ind)
-        functions = functions[12:-1].strip()
-        functions = self._find_all_balanced_expressions(functions)
         self.functions = {}
-        for func in functions:
-            func = func.strip()[1:-1].split("?")
-            func_name = func[0].strip()
-            # arg_types = [self.types[arg.strip().split("-")[1].strip()]
-            #              for arg in pred[1:]]
-            arg_types = []
-            for arg in func[1:]:
-                if ' - ' in arg:
-                    assert arg_types is not None, "Mixing of typed and untyped args not allowed"
-                    assert self.uses_typing
-                    arg_type = self.types[arg.strip().split("-")[1].strip()]
-                    arg_types.append(arg_type)
-                else:
-                    assert not self.uses_typing
-                    arg_types.append(self.types["default"])
-            self.functions[func_name] = Function(
-                func_name, len(func[1:]), arg_types)
-
-    def _parse_domain_operators(self, is_duration=False):
-        if not is_duration:
-            matches = re.finditer(r"\(:action", self.domain)
-            self.operators = {}
-            for match in matches:
-                start_ind = match.start()
-                op = self._find_balanced_expression(self.domain, start_ind).strip()
-                patt = r"\(:action(.*):parameters(.*):precondition(.*):effect(.*)\)"
-                op_match = re.match(patt, op, re.DOTALL)
-                op_name, params, preconds, effects = op_match.groups()
-                op_name = op_name.strip()
-                params = params.strip()[1:-1].split("?")
-                if self.uses_typing:
-                    params = [(param.strip().split("-")[0].strip(),
-                               param.strip().split("-")[1].strip())
-                              for param in params[1:]]
-                    params = [self.types[v]("?" + k) for k, v in params]
-                else:
-                    params = [param.strip() for param in params[1:]]
-                    params = [self.types["default"]("?" + k) for k in params]
-                preconds = self._parse_into_literal(preconds.strip(), params)
-                effects = self._parse_into_literal(effects.strip(), params,
+        for func_name, arg_types in self._parse_signatures(sections[0][1:]):
+            self.functions[func_name] = Function(func_name, len(arg_types), arg_types)
+
+    def _parse_signatures(self, exprs):
+        """Helper for _parse_domain_predicates and _parse_domain_functions
+        """
+        for expr in exprs:
+            # Skip the types of functions, e.g. - number
+            if isinstance(expr, list):
+                yield expr[0], [v.var_type for v in self._parse_variables(expr[1:])]
+
+    def _parse_domain_operators(self, sections, is_duration=False):
+        self.operators = {}
+        for op in sections:
+            op_name = op[1]
+            arguments = self._get_keyword_arguments(op)
+            params = self._parse_variables(arguments[":parameters"])
+            scope = {param.name: param for param in params}
+            if not is_duration:
+                preconds = self._parse_into_literal(arguments[":precondition"], scope)
+                effects = self._parse_into_literal(arguments[":effect"], scope,
                                                    is_effect=True)
                 self.operators[op_name] = Operator(
                     op_name, params, preconds, effects)
-        else:
-            matches = re.finditer(r"\(:durative-action", self.domain)
-            self.operators = {}
-            for match in matches:
-                start_ind = match.start()
-                op = self._find_balanced_expression(self.domain, start_ind).strip()
-                patt = r"\(:durative-action(.*):parameters(.*):duration(.*):condition(.*):effect(.*)\)"
-                op_match = re.match(patt, op, re.DOTALL)
-                op_name, params, duration, conditions, effects = op_match.groups()
-                op_name = op_name.strip()
-                # params parsing
-                params = params.strip()[1:-1].split("?")
-                if self.uses_typing:
-                    params = [(param.strip().split("-")[0].strip(),
-                               param.strip().split("-")[1].strip())
-                              for param in params[1:]]
-                    params = [self.types[v]("?" + k) for k, v in params]
-                else:
-                    params = [param.strip() for param in params[1:]]
-                    params = [self.types["default"]("?" + k) for k in params]
+            else:
                 # duration
-                durations = duration.strip().split(" ")
+                durations = sexp_to_str(arguments[":duration"]).split(" ")
                 durations = (durations[0], durations[2])
-                conditions = self._parse_into_literal(conditions.strip(), params)
-                effects = self._parse_into_literal(effects.strip(), params,
+                conditions = self._parse_into_literal(arguments[":condition"], scope)
+                effects = self._parse_into_literal(arguments[":effect"], scope,
                                                    is_effect=True)
                 self.operators[op_name] = DurationOperator(
                     op_name, params, durations, conditions, effects)
@@ -733,7 +835,8 @@ class PDDLProblemParser(PDDLParser):
     """PDDL problem parsing class.
     """
 
-    def __init__(self, problem_fname, domain_name, types, predicates, functions, action_names):
+    def __init__(self, problem_fname, domain_name, types, predicates, functions, action_names,
+                 streaming=False, static_functions=()):
         self.problem_fname = problem_fname
         self.domain_name = domain_name
         self.types = types
@@ -749,6 +852,17 @@ class PDDLProblemParser(PDDLParser):
         self.initial_state = None
         # structs.Literal representing the goal.
         self.goal = None
+        # numeric.NumericFluents of the static_functions terms of the
+        # initial state, which are then not in self.initial_state. Only
+        # set when streaming, see self.parse_stream.
+        self.static_fluents = None
+
+        if streaming:
+            # The problem text is never held in memory
+            self.problem = None
+            with open(problem_fname, "r") as f:
+                self.initial_state = frozenset(self.parse_stream(f, static_functions))
+            return
 
         ## Read files.
         with open(problem_fname, "r") as f:
@@ -768,33 +882,26 @@ class PDDLProblemParser(PDDLParser):
                                 fast_downward_order=True)
 
     def _parse_problem(self):
-        patt = r"\(problem(.*?)\)"
-        self.problem_name = re.search(patt, self.problem).groups()[0].strip()
-        patt = r"\(:domain(.*?)\)"
-        domain_name = re.search(patt, self.problem).groups()[0].strip()
+        sections = self._get_sections(parse_sexp(self.problem)[0])
+        self.problem_name = sections["problem"][0][1]
+        domain_name = sections[":domain"][0][1]
         assert domain_name == self.domain_name, "Problem file doesn't match the domain file!"
-        self._parse_problem_objects()
-        self._parse_problem_initial_state()
-        self._parse_problem_goal()
-
-    def _parse_problem_objects(self):
-        start_ind = re.search(r"\(:objects", self.problem).start()
-        objects = self._find_balanced_expression(self.problem, start_ind)
-        objects = objects[9:-1].strip()
-        if objects == "":
+        self._parse_problem_objects(sections[":objects"])
+        self._parse_problem_initial_state(sections[":init"])
+        self._parse_problem_goal(sections[":goal"])
+
+    def _parse_problem_objects(self, sections):
+        if not sections or len(sections[0]) == 1:
             self.objects = []
         else:
-            self.objects = self._parse_objects(objects)
+            self.objects = self._parse_objects(sections[0][1:])
 
-    def _parse_problem_initial_state(self):
-        start_ind = re.search(r"\(:init", self.problem).start()
-        init = self._find_balanced_expression(self.problem, start_ind)
-        fluents = self._find_all_balanced_expressions(init[6:-1].strip())
+    def _parse_problem_initial_state(self, sections):
         initial_lits = set()
-        params = {obj.name: obj.var_type for obj in self.objects}
-        for fluent in fluents:
+        params = {obj.name: obj for obj in self.objects}
+        for fluent in sections[0][1:]:
             lit = self._parse_into_literal(fluent, params)
-            if fluent.startswith("(="):
+            if fluent[0] == "=":
                 if lit.function.name in self.action_names:
                     continue
                 initial_lits.add(lit)
@@ -804,12 +911,90 @@ class PDDLProblemParser(PDDLParser):
                 initial_lits.add(lit)
         self.initial_state = frozenset(initial_lits)
 
-    def _parse_problem_goal(self):
-        start_ind = re.search(r"\(:goal", self.problem).start()
-        goal = self._find_balanced_expression(self.problem, start_ind)
-        goal = goal[6:-1].strip()
-        params = {obj.name: obj.var_type for obj in self.objects}
-        self.goal = self._parse_into_literal(goal, params)
+    def _parse_problem_goal(self, sections):
+        params = {obj.name: obj for obj in self.objects}
+        self.goal = self._parse_into_literal(sections[0][1], params)
+
+    def parse_stream(self, f, static_functions=()):
+        """Parse a problem read incrementally from a file handle,
+        yielding the literals of its initial state as they are parsed.
+
+        Every other section is read as a whole when it is reached, so
+        self.problem_name, self.objects and self.goal are set as the
+        literals are yielded, and self.static_fluents once they all were.
+        The :objects section must come before the :init section.
+
+        Parameters
+        ----------
+        f : file
+            A text file handle.
+        static_functions : { str }
+            Names of functions whose number-valued facts (= (f ...) n)
+            are stored in self.static_fluents instead of being yielded,
+            e.g. PDDLDomain.get_static_functions().
+
+        Yields
+        ------
+        literal : Literal or FLiteral
+        """
+        tokens = iter_tokens(f)
+        if next(tokens, None) != "(" or next(tokens, None) != "define":
+            raise ParseError("Expected (define ...)")
+        table = FluentTable()
+        values = array("d")
+        params = None
+        for token in tokens:
+            if token == ")":
+                break
+            if token != "(":
+                raise ParseError("Expected a section, got {}".format(token))
+            head = next(tokens, None)
+            if head == ":init":
+                if self.objects is None:
+                    self.objects = []
+                params = {obj.name: obj for obj in self.objects}
+                yield from self._parse_stream_initial_state(tokens, params, static_functions,
+                                                            table, values)
+                continue
+            section = [head] + read_sexp(tokens)
+            if head == "problem":
+                self.problem_name = section[1]
+            elif head == ":domain":
+                assert section[1] == self.domain_name, "Problem file doesn't match the domain file!"
+            elif head == ":objects":
+                assert params is None, "The :objects of a streamed problem must precede its :init"
+                self._parse_problem_objects([section])
+            elif head == ":goal":
+                self._parse_problem_goal([section])
+        else:
+            raise ParseError("Missing ')'")
+        self.static_fluents = NumericFluents(np.frombuffer(values, dtype=np.float64), table)
+
+    def _parse_stream_initial_state(self, tokens, params, static_functions, table, values):
+        """Helper for parse_stream
+        """
+        for token in tokens:
+            if token == ")":
+                return
+            if token != "(":
+                raise ParseError("Expected a fact, got {}".format(token))
+            fluent = read_sexp(tokens)
+            if fluent[0] == "=" and isinstance(fluent[1], list) and \
+                    fluent[1][0] in static_functions and isinstance(fluent[2], str):
+                idx = table.intern(fluent[1][0], [params[name] for name in fluent[1][1:]])
+                if idx == len(values):
+                    values.append(float(fluent[2]))
+                else:
+                    values[idx] = float(fluent[2])
+                continue
+            lit = self._parse_into_literal(fluent, params)
+            if fluent[0] == "=":
+                if lit.function.name in self.action_names:
+                    continue
+            elif lit.predicate.name in self.action_names:
+                continue
+            yield lit
+        raise ParseError("Missing ')'")
 
     @staticmethod
     def pddl_string(objects, initial_state, problem_name, domain_name, goal,
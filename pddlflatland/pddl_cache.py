@@ -0,0 +1,96 @@
+"""On-disk cache of parsed PDDL domains and problems.
+
+A domain is pickled together with its problems, so that they keep
+sharing types, predicates and functions when they are loaded. Entries
+are keyed by a hash of the package version, the source of the parser,
+the parse options and the paths and contents of the PDDL files: editing
+any of them makes a new entry instead of loading a stale one.
+
+The cache is opt-in: nothing is cached unless a cache_dir, e.g.
+DEFAULT_CACHE_DIR, is passed to PDDLEnv.load_pddl or to the envs.
+"""
+from importlib import metadata
+
+import functools
+import hashlib
+import os
+import pickle
+import tempfile
+
+
+# Set the PDDLFLATLAND_CACHE_DIR environment variable to move the cache
+DEFAULT_CACHE_DIR = os.environ.get(
+    "PDDLFLATLAND_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "pddlflatland"))
+# Modules whose source determines what is pickled
+_PARSER_MODULES = ("parser.py", "structs.py", "numeric.py")
+
+
+@functools.lru_cache(maxsize=None)
+def _get_code_version():
+    """Helper for get_cache_key
+    """
+    try:
+        version = metadata.version("pddlflatland")
+    except metadata.PackageNotFoundError:
+        version = "unknown"
+    digest = hashlib.sha256(version.encode())
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    for module in _PARSER_MODULES:
+        with open(os.path.join(dir_path, module), "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def get_cache_key(domain_file, problem_files, **options):
+    """Get the key of a domain and its problems parsed with options.
+
+    Parameters
+    ----------
+    domain_file : str
+    problem_files : [ str ]
+    options : dict
+        Keyword arguments of the parser, e.g. operators_as_actions.
+
+    Returns
+    -------
+    key : str
+    """
+    digest = hashlib.sha256(_get_code_version().encode())
+    digest.update(repr(sorted(options.items())).encode())
+    for fname in [domain_file] + list(problem_files):
+        with open(fname, "rb") as f:
+            content = f.read()
+        digest.update("\0{}\0{}\0".format(os.path.abspath(fname), len(content)).encode())
+        digest.update(content)
+    return digest.hexdigest()
+
+
+def load(key, cache_dir=DEFAULT_CACHE_DIR):
+    """Load a cache entry, or return None if there is no valid one.
+    """
+    try:
+        with open(os.path.join(cache_dir, key + ".pkl"), "rb") as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+        return None
+
+
+def save(key, value, cache_dir=DEFAULT_CACHE_DIR):
+    """Save a cache entry.
+
+    The entry is written to a temporary file that is then renamed, so
+    processes loading it concurrently never see a partial pickle.
+    """
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_fname = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_fname, os.path.join(cache_dir, key + ".pkl"))
+        except BaseException:
+            os.remove(tmp_fname)
+            raise
+    except OSError as e:
+        print("Warning: could not cache parsed PDDL in {}: {}".format(cache_dir, e))
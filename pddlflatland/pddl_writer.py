@@ -0,0 +1,149 @@
+"""Write PDDL problems for planners, reusing text between calls.
+
+PDDLProblemParser.pddl_string formats every literal of a problem each
+time it is called. A ProblemWriter instead keeps the PDDL text of every
+ground literal it has written, and the text of a base initial state, so
+that writing the states met while replanning mostly takes time in the
+size of their difference to the base. Problems are written to the file
+piece by piece instead of being formatted into one string first.
+
+The text of the literals is kept until the objects change or a new
+base is set, e.g. once per episode, so it does not grow without bound.
+"""
+from pddlflatland.parser import FAST_DOWNWARD_STR, PROBLEM_STR
+
+import os
+
+
+class ProblemWriter:
+    """Writes PDDL problems of a domain.
+
+    Unlike PDDLProblemParser.pddl_string, the literals of the initial
+    state are sorted by their PDDL text and, with a base, the literals
+    that are not in the base come last.
+
+    Parameters
+    ----------
+    domain_name : str
+    problem_name : str
+    fast_downward_order : bool
+        If True, write the :init section before the :goal section.
+    """
+
+    def __init__(self, domain_name, problem_name="myproblem", fast_downward_order=True):
+        self.domain_name = domain_name
+        self.problem_name = problem_name
+        template = FAST_DOWNWARD_STR if fast_downward_order else PROBLEM_STR
+        head_template, _, self._tail_template = template.partition("{init_state}")
+        # The lines of literals start with their own "\n\t"
+        self._head_template = head_template.rstrip("\n\t")
+        # Ground literal -> "\n\t" + its PDDL text, since the objects
+        # or the base last changed
+        self._lines = {}
+        # Set by self.set_base
+        self._base = None
+        self._base_lines = []
+        self._base_text = ""
+        # The frozenset of objects last written and its text
+        self._objects = None
+        self._objects_text = None
+
+    def literal_str(self, lit):
+        """Get the PDDL text of a ground literal.
+        """
+        return self._get_line(lit)[2:]
+
+    def set_base(self, initial_state):
+        """Keep the text of the literals of a base initial state, e.g.
+        the first state of an episode, as one block.
+
+        Parameters
+        ----------
+        initial_state : { Literal }
+        """
+        self._lines = {}
+        self._base = frozenset(initial_state)
+        self._base_lines = sorted(map(self._get_line, self._base))
+        self._base_text = "".join(self._base_lines)
+
+    def write(self, file_or_filepath, objects, initial_state, goal, delta=None):
+        """Write a problem.
+
+        Parameters
+        ----------
+        file_or_filepath : file or str or int
+            A text file handle, a path or a file descriptor, which is
+            left open.
+        objects : { TypedEntity }
+        initial_state : { Literal }
+        goal : Literal or LiteralConjunction
+        delta : ({ Literal }, { Literal }) or None
+            The literals of initial_state added to and deleted from the
+            base, if known; otherwise they are computed when there is a
+            base, see self.set_base.
+        """
+        if isinstance(file_or_filepath, int):
+            with os.fdopen(file_or_filepath, "w", closefd=False) as f:
+                return self.write(f, objects, initial_state, goal, delta=delta)
+        if isinstance(file_or_filepath, str):
+            with open(file_or_filepath, "w") as f:
+                return self.write(f, objects, initial_state, goal, delta=delta)
+        f = file_or_filepath
+
+        fields = dict(problem=self.problem_name, domain=self.domain_name,
+                      objects=self._get_objects_text(objects), goal=goal.pddl_str())
+        f.write(self._head_template.format(**fields))
+        if self._base is None:
+            f.writelines(sorted(map(self._get_line, initial_state)))
+        else:
+            if delta is None:
+                initial_state = frozenset(initial_state)
+                added, deleted = initial_state - self._base, self._base - initial_state
+            else:
+                added, deleted = delta
+            if deleted:
+                deleted_lines = set(map(self._get_line, deleted))
+                f.writelines(line for line in self._base_lines if line not in deleted_lines)
+            else:
+                f.write(self._base_text)
+            f.writelines(sorted(map(self._get_line, added)))
+        f.write(self._tail_template.format(**fields))
+
+    def pddl_string(self, objects, initial_state, goal, delta=None):
+        """Get the text that self.write would write.
+        """
+        lines = []
+        self.write(_ListWriter(lines), objects, initial_state, goal, delta=delta)
+        return "".join(lines)
+
+    def _get_line(self, lit):
+        """Helper for write and set_base
+        """
+        line = self._lines.get(lit)
+        if line is None:
+            line = self._lines[lit] = "\n\t" + lit.pddl_str()
+        return line
+
+    def _get_objects_text(self, objects):
+        """Helper for write
+        """
+        if objects is self._objects:
+            return self._objects_text
+        # Mutable sets may change before the next call
+        objects = frozenset(objects)
+        if objects != self._objects:
+            self._objects_text = "\n\t".join(sorted(str(o).replace(":", " - ") for o in objects))
+            if self._objects is not None:
+                # The literals of other objects are not written again
+                self._lines = {}
+        self._objects = objects
+        return self._objects_text
+
+
+class _ListWriter:
+    """Helper for ProblemWriter.pddl_string
+    """
+
+    def __init__(self, lines):
+        self.write = lines.append
+        self.writelines = lines.extend
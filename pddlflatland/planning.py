@@ -14,9 +14,60 @@ def run_planner(domain_file, problem_file, planner_name, **kwargs):
         return run_ff(domain_file, problem_file, **kwargs)
     if planner_name == 'lpg':
         return run_lpg(domain_file, problem_file, **kwargs)
+    if planner_name in ('builtin-gbfs', 'builtin-astar'):
+        return run_builtin(domain_file, problem_file, algorithm=planner_name[len('builtin-'):],
+                           **kwargs)
     raise Exception("Unknown planner `{}`".format(planner_name))
 
 
+# (domain file, its mtime, options) -> search.Planner, which keeps the
+# parsed domain and the ground task of the last problem between calls
+_BUILTIN_PLANNERS = {}
+
+
+def run_builtin(domain_file, problem_file, algorithm="gbfs", heuristic="hff",
+                max_expansions=None, operators_as_actions=True, horizon=np.inf, state=None):
+    """
+        plan in this process with a search.Planner, without writing files
+        or starting a planner process. The planner of a domain file is
+        reused between calls, so replanning from the states of an episode
+        neither parses nor grounds the domain again
+
+        :param
+            domain_file
+            problem_file: may be None if a state is given
+            algorithm: "gbfs" or "astar"
+            heuristic: "hff" or "hadd"
+            max_expansions
+            operators_as_actions: False for domains that declare action predicates
+            horizon
+            state: a State to plan from instead of the problem, e.g. an observation
+        :return plan, as action Literals
+    """
+    # Not at the top: search imports spaces, which imports utils, which imports this module
+    from pddlflatland.lazy_problems import parse_domain, parse_problem
+    from pddlflatland.search import Planner
+    from pddlflatland.structs import State
+
+    key = (os.path.realpath(domain_file), os.stat(domain_file).st_mtime_ns, operators_as_actions,
+           algorithm, heuristic, max_expansions)
+    planner = _BUILTIN_PLANNERS.get(key)
+    if planner is None:
+        domain = parse_domain(domain_file, operators_as_actions=operators_as_actions)
+        planner = _BUILTIN_PLANNERS[key] = Planner(domain, algorithm=algorithm,
+                                                   heuristic=heuristic,
+                                                   max_expansions=max_expansions)
+    if state is None:
+        if problem_file is None:
+            raise PlanningException("Either a problem file or a state is needed to plan")
+        problem = parse_problem(problem_file, planner.domain)
+        state = State(frozenset(problem.initial_state), frozenset(problem.objects), problem.goal)
+    plan = planner.plan(state)
+    if len(plan) > horizon:
+        return []
+    return plan
+
+
 def run_lpg(domain_file, problem_file, horizon=np.inf, timeout=10):
     """
         run the lpg planner to planning
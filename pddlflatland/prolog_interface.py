@@ -1,17 +1,59 @@
 from pddlflatland.structs import Predicate, Literal, LiteralConjunction, LiteralDisjunction, ForAll, Exists, Not
 from pddlflatland.utils import get_object_combinations
-import random
-from collections import defaultdict
+import atexit
+import os
 import subprocess
 import sys
 import tempfile
+import zlib
+
+
+PROLOG_SESSION_DRIVER = """
+:- use_module(library(bounds)).
+:- use_module(library(time)).
+:- style_check(-singleton).
+
+print_solutions([]).
+print_solutions([H|T]) :- write(H), nl, print_solutions(T).
+
+session_loop :-
+    read_term(user_input, Command, []),
+    (   Command == end_of_file
+    ->  halt
+    ;   catch(session_command(Command), E,
+              (print_message(error, E), write('ERROR'), nl)),
+        write('__end__'), nl, flush_output,
+        session_loop
+    ).
+
+session_command(declare(Preds)) :-
+    forall(member(P, Preds), dynamic(P)).
+session_command(assert_facts(Facts)) :-
+    forall(member(F, Facts), assertz(F)).
+session_command(retract_facts(Facts)) :-
+    forall(member(F, Facts), retract(F)).
+session_command(add_clauses(Clauses)) :-
+    forall(member(C, Clauses), assertz(C)).
+session_command(query(Timeout, N, Vars, Goal)) :-
+    session_solutions(Timeout, N, Vars, Goal, L),
+    print_solutions(L).
+
+session_solutions(Timeout, N, Vars, Goal, L) :-
+    catch(call_with_time_limit(Timeout, findnsols(N, Vars, Goal, L0)),
+          time_limit_exceeded, L0 = []),
+    !,
+    L = L0.
+session_solutions(_, _, _, _, []).
+
+:- initialization(session_loop, main).
+"""
 
 
 class PrologInterface:
     """
     """
     def __init__(self, kb, conds, max_assignment_count=2, timeout=2, 
-                 allow_redundant_variables=True, constants=None):
+                 allow_redundant_variables=True, constants=None, session=None):
         if not isinstance(conds, list):
             conds = [conds]
         # Preprocess negative literals into renamed positive literals
@@ -24,12 +66,16 @@ class PrologInterface:
         self._timeout = timeout
         self._varnames_to_var = self._create_varname_to_var(self._cond_lits, 
             lambda x : self._clean_variable_name(x).lower())
-        self._atomname_to_atom = self._create_varname_to_var(self._kb, self._clean_atom_name)
-        self._type_to_atomnames = defaultdict(list)
-        for atom_name, atom in self._atomname_to_atom.items():
-            self._type_to_atomnames[atom.var_type].append(atom_name)
-        self._prolog_str = self._create_prolog_str()
+        # Built lazily, see self.run; sessions keep the atoms of their facts
+        self._atomname_to_atom = None
+        self._helper_clauses = []  # added to by prolog_goal
+        self._quantified_types = set()  # added to by prolog_goal
+        self._goal_str, self._goal_variables = self._prolog_goal(self._conds,
+                                                                 self._allow_redundant_variables)
+        # Built lazily, see self.run; sessions do not need the program text
+        self._prolog_str = None
         self._constants = constants # unused now because variables begin with ? by convention
+        self._session = session
         # print(self._prolog_str)
         # import ipdb; ipdb.set_trace()
 
@@ -151,34 +197,48 @@ class PrologInterface:
     def _create_prolog_str(self):
         """
         """
-        preamble = self._prolog_preamble(self._conds)
+        preamble = self._prolog_preamble(self._conds, self._quantified_types)
         type_str = self._prolog_type_str(self._kb)
-        self._kb_str = self._prolog_kb_str(self._kb)  # can be changed by prolog_goal
-        goal_str, variables = self._prolog_goal(self._conds, self._allow_redundant_variables)
-        end = self._prolog_end(variables, self._max_assignment_count)
-        return '\n'.join([preamble, self._kb_str, type_str, goal_str, end])
+        self._kb_str = self._prolog_kb_str(self._kb) + \
+            "".join("\n{}.".format(clause) for clause in self._helper_clauses)
+        end = self._prolog_end(self._goal_variables, self._max_assignment_count)
+        return '\n'.join([preamble, self._kb_str, type_str, self._goal_str, end])
 
     @classmethod
     def _prolog_kb_str(cls, kb):
         """
         """
-        kb_str = ""
+        return "".join("\n{}.".format(fact) for fact in cls._prolog_kb_facts(kb))
+
+    @classmethod
+    def _prolog_kb_facts(cls, kb):
+        """
+        """
+        facts = []
         for lit in sorted(kb):
             pred_name = cls._clean_predicate_name(lit.predicate.name)
             atoms = ",".join([cls._clean_atom_name(a) for a in lit.variables])
-            kb_str += "\n{}({}).".format(pred_name, atoms)
-        return kb_str
+            facts.append("{}({})".format(pred_name, atoms))
+        return facts
 
     @classmethod
     def _prolog_type_str(cls, kb):
+        """
+        """
+        return "".join("\n{}.".format(fact) for fact in cls._prolog_type_facts(kb))
+
+    @classmethod
+    def _prolog_type_facts(cls, kb):
         """
         """
         all_atoms = sorted({ v for lit in kb for v in lit.variables })
-        type_str = ""
-        for v in sorted(all_atoms, key=lambda v:v.var_type):
-            vname = cls._clean_atom_name(v.name)
-            type_str += "\nistype{}({}).".format(v.var_type, vname)
-        return type_str
+        return [cls._prolog_type_fact(v) for v in sorted(all_atoms, key=lambda v:v.var_type)]
+
+    @classmethod
+    def _prolog_type_fact(cls, atom):
+        """
+        """
+        return "istype{}({})".format(atom.var_type, cls._clean_atom_name(atom.name))
 
     def _prolog_goal(self, conds, allow_redundant_variables):
         """
@@ -242,27 +302,28 @@ class PrologInterface:
             pred_str = "{}({})".format(pred_name, variables)
             return pred_str
         if isinstance(lit, ForAll):
-            variables = ",".join([self._clean_variable_name(a.name) for a in lit.variables])
-            assert len(variables) == 1, "TODO: support ForAlls over multiple variables"
-            variable = variables[0]
+            assert len(lit.variables) == 1, "TODO: support ForAlls over multiple variables"
+            variable = self._clean_variable_name(lit.variables[0].name)
             var_type = lit.variables[0].var_type
-            objects_of_type = self._type_to_atomnames[var_type]
-            objects_str = "[" + ",".join(objects_of_type) + "]"
+            # The objects come from the type facts rather than the goal, so
+            # that the goal does not depend on the kb and sessions reuse it
+            self._quantified_types.add(var_type)
             pred_str_body = self._prolog_goal_line(lit.body)
-            pred_str = "forall(member({}, {}), {})".format(variable, objects_str, pred_str_body)
+            pred_str = "forall(istype{}({}), {})".format(var_type, variable, pred_str_body)
             return pred_str
         if isinstance(lit, Exists):
             variables = ",".join([self._clean_variable_name(a.name)
                                   for a in self._get_variables(lit, set())])
-            rand_num = random.randint(0, 1e6)
             body = self._prolog_goal_line(lit.body)
-            self._kb_str += "\nhelper{}({}) :- {}.".format(rand_num, variables, body)
-            pred_str = "helper{}({})".format(rand_num, variables)
+            # Named by content so that sessions can reuse the clause
+            helper_num = zlib.crc32("{}:{}".format(variables, body).encode())
+            self._helper_clauses.append("helper{}({}) :- {}".format(helper_num, variables, body))
+            pred_str = "helper{}({})".format(helper_num, variables)
             return pred_str
         raise NotImplementedError(lit)
 
     @classmethod
-    def _prolog_preamble(cls, conds):
+    def _prolog_preamble(cls, conds, quantified_types=()):
         cond_lits = cls._get_lits_from_conds(conds)
         pred_definitions = ""
         preds = set()
@@ -272,6 +333,9 @@ class PrologInterface:
         for pred in preds:
             pred_name = cls._clean_predicate_name(pred.name)
             pred_definitions += "\n:- multifile({}/{}).".format(pred_name, pred.arity)
+        # Types without objects in the kb have no type facts
+        for var_type in sorted(quantified_types):
+            pred_definitions += "\n:- multifile(istype{}/1).".format(var_type)
 
         return """print_solutions([]).
 print_solutions([H|T]) :- write(H), nl, print_solutions(T).
@@ -314,6 +378,10 @@ print_solutions([H|T]) :- write(H), nl, print_solutions(T).
     def run(self):
         """
         """
+        if self._session is not None:
+            return self._run_in_session()
+        if self._prolog_str is None:
+            self._prolog_str = self._create_prolog_str()
         file = tempfile.NamedTemporaryFile(suffix=".pl")
         tmp_name = file.name
         with open(tmp_name, 'w') as f:
@@ -324,6 +392,8 @@ print_solutions([H|T]) :- write(H), nl, print_solutions(T).
         if "ERROR" in output or "Warning" in output:
             import ipdb; ipdb.set_trace()
             raise Exception("Prolog terminated with an error: \n{}".format(output))
+        if self._atomname_to_atom is None:
+            self._atomname_to_atom = self._create_varname_to_var(self._kb, self._clean_atom_name)
         lines = output.split('\n')
         varnames = self._parse_output_line(lines.pop(0))
         vs = [self._varnames_to_var[v] for v in varnames]
@@ -338,3 +408,201 @@ print_solutions([H|T]) :- write(H), nl, print_solutions(T).
             assignment = dict(zip(vs, atoms))
             assignments.append(assignment)
         return assignments
+
+    def _run_in_session(self):
+        """Answer the query with the persistent PrologSession instead
+        of spawning swipl.
+        """
+        declarations = {(self._clean_predicate_name(lit.predicate.name), lit.predicate.arity)
+                        for lit in self._cond_lits}
+        declarations.update(("istype{}".format(v.var_type), 1) for v in self._goal_variables)
+        declarations.update(("istype{}".format(t), 1) for t in self._quantified_types)
+        # The goal clause text without its head name and trailing "."
+        goal_clause = self._goal_str.strip()[len("goal"):-1]
+        outputs = self._session.query(self._kb, declarations, goal_clause, self._helper_clauses,
+                                      [self._clean_variable_name(v) for v in self._goal_variables],
+                                      self._max_assignment_count, self._timeout)
+        vs = [self._varnames_to_var[self._clean_variable_name(v).lower()]
+              for v in self._goal_variables]
+        assignments = []
+        for binding in outputs:
+            atomnames = self._parse_output_line(binding)
+            # Recover original (typed) atoms
+            atoms = [self._session.get_atom(v) for v in atomnames]
+            assignment = dict(zip(vs, atoms))
+            assignments.append(assignment)
+        return assignments
+
+
+class PrologSession:
+    """A long-lived swipl process that answers PrologInterface queries.
+
+    The session speaks a line protocol over pipes: each request is one
+    Prolog term, and each response ends with a line "__end__". Facts
+    are asserted and retracted incrementally, so that each query only
+    formats and sends the literals that differ from those of the
+    previous query. Goal and helper clauses do not depend on the
+    knowledge base, so they are asserted once per distinct query and
+    reused afterwards.
+
+    Parameters
+    ----------
+    executable : str
+        The swipl executable.
+    """
+    def __init__(self, executable="swipl"):
+        self._executable = executable
+        self._process = None
+        self._driver_fname = None
+        self._kb = frozenset()
+        # Atom name -> (atom, number of literals of self._kb it is in)
+        self._atoms = {}
+        self._declared = set()
+        self._goal_clause_to_name = {}
+        self._helper_clauses = set()
+
+    def start(self):
+        if self._process is not None:
+            return
+        f_desc, self._driver_fname = tempfile.mkstemp(suffix=".pl", text=True)
+        with os.fdopen(f_desc, "w") as f:
+            f.write(PROLOG_SESSION_DRIVER)
+        self._process = subprocess.Popen([self._executable, "-q", self._driver_fname],
+                                         stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                         stderr=subprocess.DEVNULL, universal_newlines=True,
+                                         bufsize=1)
+        atexit.register(self.close)
+
+    def close(self):
+        # Registered again by the next self.start
+        atexit.unregister(self.close)
+        if self._process is not None:
+            try:
+                self._process.stdin.close()
+                self._process.wait(timeout=1)
+            except (OSError, subprocess.TimeoutExpired):
+                self._process.kill()
+            self._process = None
+        if self._driver_fname is not None:
+            os.remove(self._driver_fname)
+            self._driver_fname = None
+        self._kb = frozenset()
+        self._atoms = {}
+        self._declared = set()
+        self._goal_clause_to_name = {}
+        self._helper_clauses = set()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get_atom(self, atom_name):
+        """The atom of the facts of the session with the given Prolog name.
+        """
+        return self._atoms[atom_name][0]
+
+    def query(self, kb, declarations, goal_clause, helper_clauses, variables,
+              max_assignment_count, timeout):
+        """Sync the facts and return the output lines of the query.
+
+        Parameters
+        ----------
+        kb : frozenset or [ Literal ]
+            All literals that should hold. Only their difference with the
+            kb of the previous query is turned into facts, which takes no
+            time if kb is the same frozenset.
+        declarations : { (str, int) }
+            Predicates (name, arity) referenced by the query.
+        goal_clause : str
+            The goal clause without head name, e.g. "(X) :- predon(X,b)".
+        helper_clauses : [ str ]
+            Extra clauses referenced by the goal clause.
+        variables : [ str ]
+            The Prolog variables of the goal head.
+        """
+        self.start()
+        commands = []
+        new_declarations = set(declarations) - self._declared
+        if new_declarations:
+            commands.append("declare([{}])".format(",".join(
+                "{}/{}".format(name, arity) for name, arity in sorted(new_declarations))))
+            self._declared.update(new_declarations)
+        commands.extend(self._sync_kb(kb))
+        new_clauses = [c for c in helper_clauses if c not in self._helper_clauses]
+        self._helper_clauses.update(new_clauses)
+        if goal_clause not in self._goal_clause_to_name:
+            goal_name = "goal{}".format(len(self._goal_clause_to_name))
+            self._goal_clause_to_name[goal_clause] = goal_name
+            new_clauses.append(goal_name + goal_clause)
+        goal_name = self._goal_clause_to_name[goal_clause]
+        if new_clauses:
+            commands.append("add_clauses([{}])".format(",".join(
+                "({})".format(c) for c in new_clauses)))
+        variables_str = ",".join(variables)
+        commands.append("query({}, {}, [{}], {}({}))".format(
+            timeout, max_assignment_count, variables_str, goal_name, variables_str))
+        responses = self._send(commands)
+        return responses[-1]
+
+    def _sync_kb(self, kb):
+        """Helper for query
+        """
+        if not isinstance(kb, frozenset):
+            kb = frozenset(kb)
+        if kb is self._kb:
+            return []
+        added, deleted = kb - self._kb, self._kb - kb
+        self._kb = kb
+        # Type facts are kept for the atoms in at least one literal
+        to_retract = PrologInterface._prolog_kb_facts(deleted)
+        for lit in deleted:
+            for atom in lit.variables:
+                atom_name = PrologInterface._clean_atom_name(atom.name)
+                count = self._atoms[atom_name][1] - 1
+                if count == 0:
+                    del self._atoms[atom_name]
+                    to_retract.append(PrologInterface._prolog_type_fact(atom))
+                else:
+                    self._atoms[atom_name] = (atom, count)
+        to_assert = PrologInterface._prolog_kb_facts(added)
+        for lit in added:
+            for atom in lit.variables:
+                atom_name = PrologInterface._clean_atom_name(atom.name)
+                if atom_name in self._atoms:
+                    self._atoms[atom_name] = (atom, self._atoms[atom_name][1] + 1)
+                else:
+                    self._atoms[atom_name] = (atom, 1)
+                    to_assert.append(PrologInterface._prolog_type_fact(atom))
+        commands = []
+        if to_retract:
+            commands.append("retract_facts([{}])".format(",".join(to_retract)))
+        if to_assert:
+            commands.append("assert_facts([{}])".format(",".join(to_assert)))
+        return commands
+
+    def _send(self, commands):
+        """Send commands and collect the output lines of each.
+        """
+        for command in commands:
+            self._process.stdin.write(command + ".\n")
+        self._process.stdin.flush()
+        responses = []
+        for _ in commands:
+            lines = []
+            while True:
+                line = self._process.stdout.readline()
+                if line == "":
+                    self.close()
+                    raise Exception("Prolog session terminated unexpectedly")
+                line = line.rstrip("\n")
+                if line == "__end__":
+                    break
+                lines.append(line)
+            if "ERROR" in lines:
+                self.close()
+                raise Exception("Prolog terminated with an error: \n{}".format(commands))
+            responses.append(lines)
+        return responses
@@ -0,0 +1,766 @@
+"""In-process planning over ground tasks.
+
+run_planner with planner_name "builtin-gbfs" or "builtin-astar", or a
+Planner, plans without writing PDDL files or starting a planner process.
+The operators of a domain are grounded once per problem into a
+GroundTask, whose states are Python int bitsets over the ids of an
+AtomTable, as in BitsetState. Greedy best-first search and A* search run
+over those with the hFF or hadd heuristic, and plans are returned as
+action Literals.
+
+STRIPS domains with operators_as_actions are grounded by FastDownward's
+instantiator, as in LiteralActionSpace. Other domains, like the numeric
+flatland domain, are grounded by ground_domain: conditions on static
+predicates and functions are evaluated in the state, and conditions like
+(= (direction ?x) 1) on the other functions become facts that assigns
+delete and add.
+"""
+from pddlflatland.downward_translate.instantiate import explore as downward_explore
+from pddlflatland.grounding import GroundOperator
+from pddlflatland.numeric import COMPARATORS, OPERATIONS, NumericFluents, fluent_literal
+from pddlflatland.planning import PlanningException
+from pddlflatland.spaces import create_downward_task
+from pddlflatland.structs import (Literal, FLiteral, NumericOperation, NumericCondition,
+                                  LiteralConjunction, LiteralDisjunction, When, Assign,
+                                  AtomTable)
+from pddlflatland.utils import nostdout
+
+from collections import defaultdict
+from heapq import heappush, heappop
+
+import functools
+import itertools
+import math
+
+
+class GroundTask:
+    """A STRIPS task whose states are int bitsets.
+
+    Parameters
+    ----------
+    ground_operators : [ GroundOperator ]
+        Deterministic ground operators.
+    actions : [ Literal ]
+        The action literal of each ground operator.
+
+    Attributes
+    ----------
+    table : AtomTable
+        Interns the facts of the preconditions and effects.
+    """
+
+    def __init__(self, ground_operators, actions):
+        self.ground_operators = ground_operators
+        self.actions = actions
+        self.table = table = AtomTable()
+        self._pre_ids = [sorted({table.intern(lit) for lit in op.pos_preconds})
+                         for op in ground_operators]
+        self._pre = [_to_bits(ids) for ids in self._pre_ids]
+        self._neg = [table.encode(op.neg_preconds) for op in ground_operators]
+        self._add_ids = [sorted({table.intern(lit) for lit in op.add_effects})
+                         for op in ground_operators]
+        self._add = [_to_bits(ids) for ids in self._add_ids]
+        self._delete = [table.encode(op.delete_effects) for op in ground_operators]
+        # Fact id -> operators with the fact as a precondition, for the heuristics
+        fact_to_ops = defaultdict(list)
+        for op, ids in enumerate(self._pre_ids):
+            for idx in ids:
+                fact_to_ops[idx].append(op)
+        self._fact_to_ops = dict(fact_to_ops)
+        self._no_pre_ops = [op for op, ids in enumerate(self._pre_ids) if not ids]
+        # Fact id -> operators whose least shared precondition it is, for
+        # self.applicable
+        self._buckets = defaultdict(list)
+        for op, ids in enumerate(self._pre_ids):
+            if ids:
+                self._buckets[min(ids, key=lambda idx: len(fact_to_ops[idx]))].append(op)
+        self._bucket_mask = _to_bits(self._buckets)
+
+    def __len__(self):
+        return len(self.ground_operators)
+
+    def encode(self, literals, strict=False):
+        """Encode the literals that are facts of the task as an int bitset.
+
+        Parameters
+        ----------
+        literals : { Literal }
+        strict : bool
+            If True, return None if some literal is not a fact of the task.
+        """
+        bits = 0
+        for lit in literals:
+            idx = self.table.get_id(lit)
+            if idx >= 0:
+                bits |= 1 << idx
+            elif strict:
+                return None
+        return bits
+
+    def applicable(self, bits):
+        """Iterate over the indices of the operators applicable in a state.
+        """
+        for op in self._no_pre_ops:
+            if not bits & self._neg[op]:
+                yield op
+        pre, neg = self._pre, self._neg
+        for idx in AtomTable.iter_ids(bits & self._bucket_mask):
+            for op in self._buckets[idx]:
+                if bits & pre[op] == pre[op] and not bits & neg[op]:
+                    yield op
+
+    def successor(self, bits, op):
+        """Get the state after applying an operator.
+        """
+        return bits & ~self._delete[op] | self._add[op]
+
+    def h_add(self, bits, goal_ids):
+        """The additive heuristic, see self._relax.
+        """
+        cost, _ = self._relax(bits, goal_ids)
+        if cost is None:
+            return math.inf
+        return sum(cost[idx] for idx in goal_ids)
+
+    def h_ff(self, bits, goal_ids):
+        """The FF heuristic: the number of operators of a relaxed plan
+        extracted from the best supporters of the additive heuristic.
+        """
+        cost, supporters = self._relax(bits, goal_ids)
+        if cost is None:
+            return math.inf
+        relaxed_plan = set()
+        stack = [idx for idx in goal_ids if cost[idx] > 0]
+        while stack:
+            op = supporters[stack.pop()]
+            if op not in relaxed_plan:
+                relaxed_plan.add(op)
+                stack.extend(idx for idx in self._pre_ids[op] if cost[idx] > 0)
+        return len(relaxed_plan)
+
+    def _relax(self, bits, goal_ids):
+        """Helper for the heuristics. Compute the additive costs of the
+        facts with unit operator costs, until all goal facts are reached.
+
+        Returns
+        -------
+        cost : { int : int } or None
+            Cost of each reached fact id, or None if some goal fact is
+            unreachable.
+        supporters : { int : int }
+            The operator reaching each fact with a positive cost at its
+            cost.
+        """
+        cost, supporters = {}, {}
+        queue = [(0, idx) for idx in AtomTable.iter_ids(bits)]
+        for _, idx in queue:
+            cost[idx] = 0
+        remaining = {}
+        op_cost = {}
+        fact_to_ops, pre_ids, add_ids = self._fact_to_ops, self._pre_ids, self._add_ids
+
+        def reach(op, c):
+            for idx in add_ids[op]:
+                if c < cost.get(idx, math.inf):
+                    cost[idx] = c
+                    supporters[idx] = op
+                    heappush(queue, (c, idx))
+
+        for op in self._no_pre_ops:
+            reach(op, 1)
+        goals_left = set(goal_ids)
+        while queue:
+            c, idx = heappop(queue)
+            if c > cost[idx]:
+                continue
+            goals_left.discard(idx)
+            if not goals_left:
+                return cost, supporters
+            for op in fact_to_ops.get(idx, ()):
+                left = remaining.get(op, len(pre_ids[op])) - 1
+                remaining[op] = left
+                op_cost[op] = op_cost.get(op, 0) + c
+                if left == 0:
+                    reach(op, op_cost[op] + 1)
+        if goals_left:
+            return None, supporters
+        return cost, supporters
+
+
+def search(task, init_bits, goal_bits, goal_neg_bits=0, algorithm="gbfs", heuristic="hff",
+           max_expansions=None):
+    """Search for a plan in a GroundTask.
+
+    Parameters
+    ----------
+    task : GroundTask
+    init_bits : int
+    goal_bits : int
+        Facts that must hold in a goal state.
+    goal_neg_bits : int
+        Facts that must not hold in a goal state. The heuristics ignore
+        them.
+    algorithm : "gbfs" or "astar"
+        Greedy best-first search, which does not reopen states, or A*.
+    heuristic : "hff" or "hadd"
+    max_expansions : int or None
+
+    Returns
+    -------
+    plan : [ int ] or None
+        The indices of the operators of a plan, or None if there is no
+        plan or max_expansions is reached.
+    """
+    if algorithm not in ("gbfs", "astar"):
+        raise ValueError("Unknown search algorithm `{}`".format(algorithm))
+    if heuristic == "hff":
+        evaluate = task.h_ff
+    elif heuristic == "hadd":
+        evaluate = task.h_add
+    else:
+        raise ValueError("Unknown heuristic `{}`".format(heuristic))
+    goal_ids = list(AtomTable.iter_ids(goal_bits))
+    greedy = algorithm == "gbfs"
+
+    h = evaluate(init_bits, goal_ids)
+    if h == math.inf:
+        return None
+    counter = itertools.count()
+    queue = [((h, 0) if greedy else (h, h), next(counter), init_bits)]
+    # State -> (parent state, operator), None for init_bits
+    parents = {init_bits: None}
+    g_values = {init_bits: 0}
+    closed = set()
+    expansions = 0
+    while queue:
+        _, _, bits = heappop(queue)
+        if bits in closed:
+            continue
+        if bits & goal_bits == goal_bits and not bits & goal_neg_bits:
+            return _extract_plan(parents, bits)
+        closed.add(bits)
+        expansions += 1
+        if max_expansions is not None and expansions > max_expansions:
+            return None
+        g = g_values[bits] + 1
+        for op in task.applicable(bits):
+            next_bits = task.successor(bits, op)
+            if g >= g_values.get(next_bits, math.inf):
+                continue
+            if next_bits in closed:
+                if greedy:
+                    continue
+                closed.discard(next_bits)
+            g_values[next_bits] = g
+            parents[next_bits] = (bits, op)
+            h = evaluate(next_bits, goal_ids)
+            if h == math.inf:
+                continue
+            heappush(queue, ((h, g) if greedy else (g + h, h), next(counter), next_bits))
+    return None
+
+
+def _extract_plan(parents, bits):
+    """Helper for search
+    """
+    plan = []
+    while parents[bits] is not None:
+        bits, op = parents[bits]
+        plan.append(op)
+    return plan[::-1]
+
+
+def _to_bits(ids):
+    """Helper for GroundTask
+    """
+    bits = 0
+    for idx in ids:
+        bits |= 1 << idx
+    return bits
+
+
+class Planner:
+    """Plans from the states of the problems of a domain.
+
+    The ground task of a problem is kept between calls of self.plan, and
+    is only grounded again when the objects or the static literals and
+    fluents of the state change, or, for tasks grounded by FastDownward's
+    instantiator, when the state has facts that it did not reach.
+
+    Parameters
+    ----------
+    domain : PDDLDomain
+    algorithm : "gbfs" or "astar"
+    heuristic : "hff" or "hadd"
+    max_expansions : int or None
+    """
+
+    def __init__(self, domain, algorithm="gbfs", heuristic="hff", max_expansions=None):
+        self.domain = domain
+        self.algorithm = algorithm
+        self.heuristic = heuristic
+        self.max_expansions = max_expansions
+        self._static_predicates = domain.get_static_predicates()
+        self._static_functions = domain.get_static_functions()
+        # Built lazily, see self.get_task
+        self._task = None
+        self._task_key = None
+        self._task_is_downward = False
+
+    def plan(self, state):
+        """Plan from a state to its goal.
+
+        Parameters
+        ----------
+        state : State
+            Its goal is a Literal or a LiteralConjunction of Literals and
+            (= (function objects) value) FLiterals.
+
+        Returns
+        -------
+        plan : [ Literal ]
+            Action literals.
+
+        Raises
+        ------
+        PlanningException
+            If no plan is found.
+        """
+        task, init_bits = self.get_task(state)
+        goal = self._encode_goal(task, state)
+        plan = None
+        if goal is not None:
+            plan = search(task, init_bits, *goal, algorithm=self.algorithm,
+                          heuristic=self.heuristic, max_expansions=self.max_expansions)
+        if plan is None:
+            raise PlanningException("Plan not found with builtin-{}!".format(self.algorithm))
+        return [task.actions[op] for op in plan]
+
+    def get_task(self, state):
+        """Get the ground task of the problem of a state.
+
+        Returns
+        -------
+        task : GroundTask
+        init_bits : int
+            The state encoded in task.
+        """
+        static_literals, dynamic_literals = [], []
+        for lit in state.literals:
+            if isinstance(lit, FLiteral) and lit.function.name in self._static_functions:
+                # See below
+                continue
+            if self._is_static(lit):
+                static_literals.append(lit)
+            else:
+                dynamic_literals.append(lit)
+        # The same with and without state.fluents
+        fluents = state.fluents
+        if fluents is None:
+            fluents = NumericFluents.from_literals(state.literals)
+        static_fluents = frozenset(item for item in fluents.to_dict().items()
+                                   if item[0][0] in self._static_functions)
+        key = (state.objects, frozenset(static_literals), static_fluents)
+        if self._task is not None and key == self._task_key:
+            init_bits = self._task.encode(dynamic_literals, strict=self._task_is_downward)
+            if init_bits is not None:
+                return self._task, init_bits
+        try:
+            ground_operators, actions = ground_downward(self.domain, state)
+            self._task_is_downward = True
+        except NotImplementedError:
+            ground_operators, actions = ground_domain(self.domain, state)
+            self._task_is_downward = False
+        self._task = GroundTask(ground_operators, actions)
+        self._task_key = key
+        return self._task, self._task.encode(dynamic_literals)
+
+    def _is_static(self, lit):
+        """Helper for get_task
+        """
+        if isinstance(lit, FLiteral):
+            return lit.function.name in self._static_functions
+        return lit.predicate.name in self._static_predicates
+
+    def _encode_goal(self, task, state):
+        """Helper for plan. Get the goal_bits and goal_neg_bits of search,
+        or None if the goal cannot be reached.
+        """
+        goal = state.goal
+        conds = goal.literals if isinstance(goal, LiteralConjunction) else [goal]
+        goal_bits, goal_neg_bits = 0, 0
+        fluents = None
+        for lit in conds:
+            if isinstance(lit, FLiteral):
+                if _get_comparator(lit) != "=":
+                    raise NotImplementedError("Cannot plan for goal {}".format(lit))
+                negative = False
+            elif isinstance(lit, Literal):
+                negative = lit.is_negative
+                lit = lit.positive if negative else lit
+            else:
+                raise NotImplementedError("Cannot plan for goal {}".format(lit))
+            idx = task.table.get_id(lit)
+            if idx >= 0:
+                if negative:
+                    goal_neg_bits |= 1 << idx
+                else:
+                    goal_bits |= 1 << idx
+                continue
+            # No operator changes lit
+            if isinstance(lit, FLiteral) and lit not in state.literals:
+                if fluents is None:
+                    fluents = state.fluents
+                    if fluents is None:
+                        fluents = NumericFluents.from_literals(state.literals)
+                holds = fluents.get(lit.function.name, lit.variables) == float(lit.function.value)
+            else:
+                holds = lit in state.literals
+            if holds == negative:
+                return None
+        return goal_bits, goal_neg_bits
+
+
+def ground_downward(domain, state):
+    """Ground the operators of a STRIPS domain with operators_as_actions
+    with FastDownward's instantiator.
+
+    Returns
+    -------
+    ground_operators : [ GroundOperator ]
+    actions : [ Literal ]
+        The action literal of each ground operator.
+
+    Raises
+    ------
+    NotImplementedError
+        If the domain does not have operators_as_actions, if
+        create_downward_task does not support it, or if some operator
+        has conditional effects.
+    """
+    if not domain.operators_as_actions:
+        raise NotImplementedError("Only domains with operators_as_actions are supported")
+    task = create_downward_task(domain, state)
+    with nostdout():
+        _, _, downward_actions, _, _ = downward_explore(task)
+    obj_name_to_obj = {obj.name: obj for obj in state.objects}
+
+    def convert(atom):
+        return domain.predicates[atom.predicate](*[obj_name_to_obj[arg] for arg in atom.args])
+
+    ground_operators, actions = [], []
+    for downward_action in downward_actions:
+        name = downward_action.name.strip().strip("()").split()
+        operator, objs = domain.operators[name[0]], [obj_name_to_obj[obj] for obj in name[1:]]
+        # As in LiteralActionSpace
+        if len(set(objs)) != len(objs):
+            continue
+        effects = downward_action.add_effects + downward_action.del_effects
+        if any(conditions for conditions, _ in effects):
+            raise NotImplementedError("Cannot ground conditional effects")
+        preconds = [atom for atom in downward_action.precondition if atom.predicate != "="]
+        ground_operators.append(GroundOperator(
+            operator, dict(zip(operator.params, objs)),
+            frozenset(convert(atom) for atom in preconds if not atom.negated),
+            frozenset(convert(atom.negate()) for atom in preconds if atom.negated),
+            frozenset(convert(atom) for _, atom in downward_action.add_effects),
+            frozenset(convert(atom) for _, atom in downward_action.del_effects),
+            None))
+        actions.append(domain.predicates[operator.name](*objs))
+    return ground_operators, actions
+
+
+def ground_domain(domain, state):
+    """Ground the operators of a domain for the objects of a state.
+
+    Conditions on static predicates and functions, which no operator
+    changes, are evaluated in the state, and only the ground operators
+    whose static conditions hold are kept. Each branch of a disjunctive
+    precondition is grounded separately. A condition (= (f ?x) value) on
+    another function becomes the fact fluent_literal(f, objects, value);
+    an assign of the term deletes it and adds the fact of the new value.
+    As in LiteralActionSpace, variables are not assigned repeated objects.
+
+    Returns
+    -------
+    ground_operators : [ GroundOperator ]
+    actions : [ Literal ]
+        The action literal of each ground operator.
+
+    Raises
+    ------
+    NotImplementedError
+        For conditions other than literals, numeric comparisons,
+        conjunctions and disjunctions, and for numeric conditions other
+        than (= (f ...) value) on functions that are not static. Also if
+        the old value of an assigned term, or the condition of a when
+        effect, is not determined by the preconditions.
+    """
+    return _DomainGrounder(domain, state).ground()
+
+
+class _DomainGrounder:
+    """Helper for ground_domain
+    """
+
+    def __init__(self, domain, state):
+        self.domain = domain
+        self.static_predicates = domain.get_static_predicates()
+        self.static_functions = domain.get_static_functions()
+        self.action_names = set() if domain.operators_as_actions else set(domain.actions or ())
+        self.literals = state.literals
+        self.fluents = state.fluents
+        if self.fluents is None:
+            self.fluents = NumericFluents.from_literals(state.literals)
+        type_to_parent_types = domain.type_to_parent_types
+        self.type_to_objs = defaultdict(list)
+        for obj in sorted(state.objects):
+            for t in type_to_parent_types.get(obj.var_type, {obj.var_type}):
+                self.type_to_objs[t].append(obj)
+
+    def ground(self):
+        ground_operators, actions = [], []
+        for operator in self.domain.operators.values():
+            effects = _flatten_effects(operator.effects)
+            for branch in _to_dnf(operator.preconds):
+                for assignment in self._iter_assignments(operator.params, branch):
+                    ground = self._ground_operator(operator, assignment, branch, effects)
+                    if ground is not None:
+                        ground_operators.append(ground[0])
+                        actions.append(ground[1])
+        return ground_operators, actions
+
+    def _iter_assignments(self, params, branch):
+        """Assign objects to params one by one, checking each static
+        condition as soon as its variables are assigned.
+        """
+        index = {param: i for i, param in enumerate(params)}
+        checks = [[] for _ in params]
+        for cond in branch:
+            if not self._is_static(cond):
+                continue
+            depth = max((index[var] for var in _get_variables(cond) if var in index), default=-1)
+            if depth < 0:
+                if not self._holds(cond, {}):
+                    return
+            else:
+                checks[depth].append(cond)
+        candidates = [self.type_to_objs.get(param.var_type, []) for param in params]
+        assignment = {}
+
+        def extend(depth):
+            if depth == len(params):
+                yield dict(assignment)
+                return
+            param = params[depth]
+            for obj in candidates[depth]:
+                if obj in assignment.values():
+                    continue
+                assignment[param] = obj
+                if all(self._holds(cond, assignment) for cond in checks[depth]):
+                    yield from extend(depth + 1)
+                del assignment[param]
+
+        yield from extend(0)
+
+    def _ground_operator(self, operator, assignment, branch, effects):
+        """Get (GroundOperator, action literal), or None if the
+        preconditions contradict each other.
+        """
+        pos_preconds, neg_preconds, known = set(), set(), {}
+        action = None
+        if self.domain.operators_as_actions:
+            action = self.domain.predicates[operator.name](
+                *[assignment[param] for param in operator.params])
+        for cond in branch:
+            if isinstance(cond, Literal):
+                if cond.predicate.name in self.action_names:
+                    action = _ground(cond, assignment)
+                elif cond.predicate.name not in self.static_predicates:
+                    lit = _ground(cond, assignment)
+                    if lit.is_negative:
+                        neg_preconds.add(lit.positive)
+                    else:
+                        pos_preconds.add(lit)
+            elif not self._is_static(cond):
+                comparator, left, right = _get_comparison(cond)
+                if comparator != "=" or not isinstance(left, FLiteral) or \
+                        left.function.name in self.static_functions:
+                    raise NotImplementedError(
+                        "Cannot ground numeric condition {}".format(cond))
+                term = (left.function.name, _ground_objects(left, assignment))
+                value = self._evaluate(right, assignment, known)
+                if known.setdefault(term, value) != value:
+                    return None
+                pos_preconds.add(fluent_literal(self.domain.functions[term[0]], term[1], value))
+        if action is None or pos_preconds & neg_preconds:
+            return None
+
+        add_effects, delete_effects = set(), set()
+        for condition, effect in effects:
+            if condition is not None and not self._holds_given(
+                    condition, assignment, pos_preconds, neg_preconds, known):
+                continue
+            if isinstance(effect, Literal):
+                lit = _ground(effect, assignment)
+                if lit.is_anti:
+                    delete_effects.add(lit.inverted_anti)
+                else:
+                    add_effects.add(lit)
+                continue
+            term = (effect.literal.function.name, _ground_objects(effect.literal, assignment))
+            if term not in known:
+                raise NotImplementedError(
+                    "The preconditions do not determine the value of {}".format(effect.literal))
+            function = self.domain.functions[term[0]]
+            delete_effects.add(fluent_literal(function, term[1], known[term]))
+            add_effects.add(fluent_literal(
+                function, term[1], self._evaluate(effect.variables[0], assignment, known)))
+        return GroundOperator(operator, assignment, frozenset(pos_preconds),
+                              frozenset(neg_preconds), frozenset(add_effects),
+                              frozenset(delete_effects), None), action
+
+    def _is_static(self, cond):
+        """Whether a condition only depends on static predicates and functions.
+        """
+        if isinstance(cond, Literal):
+            return cond.predicate.name in self.static_predicates
+        return all(term.function.name in self.static_functions for term in _iter_terms(cond))
+
+    def _holds(self, cond, assignment):
+        """Evaluate a static condition.
+        """
+        if isinstance(cond, Literal):
+            lit = _ground(cond, assignment)
+            if lit.is_negative:
+                return lit.positive not in self.literals
+            return lit in self.literals
+        comparator, left, right = _get_comparison(cond)
+        return bool(COMPARATORS[comparator](self._evaluate(left, assignment, {}),
+                                            self._evaluate(right, assignment, {})))
+
+    def _holds_given(self, cond, assignment, pos_preconds, neg_preconds, known):
+        """Evaluate the condition of a when effect given the preconditions.
+        """
+        if isinstance(cond, LiteralConjunction):
+            return all(self._holds_given(lit, assignment, pos_preconds, neg_preconds, known)
+                       for lit in cond.literals)
+        if self._is_static(cond):
+            return self._holds(cond, assignment)
+        if isinstance(cond, Literal):
+            lit = _ground(cond, assignment)
+            positive = lit.positive if lit.is_negative else lit
+            if positive not in pos_preconds and positive not in neg_preconds:
+                raise NotImplementedError(
+                    "The preconditions do not determine the condition {}".format(cond))
+            return (positive in pos_preconds) != lit.is_negative
+        comparator, left, right = _get_comparison(cond)
+        return bool(COMPARATORS[comparator](self._evaluate(left, assignment, known),
+                                            self._evaluate(right, assignment, known)))
+
+    def _evaluate(self, expression, assignment, known):
+        """Evaluate a numeric expression with the static fluents and the
+        known values of the other function terms.
+        """
+        if isinstance(expression, (int, float, str)):
+            return float(expression)
+        if isinstance(expression, NumericOperation):
+            values = [self._evaluate(arg, assignment, known) for arg in expression.arguments]
+            if len(values) == 1 and expression.operator == "-":
+                return -values[0]
+            return float(functools.reduce(OPERATIONS[expression.operator], values))
+        if isinstance(expression, FLiteral):
+            name, objects = expression.function.name, _ground_objects(expression, assignment)
+            if name in self.static_functions:
+                return self.fluents.get(name, objects)
+            if (name, objects) not in known:
+                raise NotImplementedError(
+                    "The preconditions do not determine the value of {}".format(expression))
+            return known[name, objects]
+        raise NotImplementedError("Cannot evaluate numeric expression {}".format(expression))
+
+
+def _to_dnf(condition):
+    """Helper for ground_domain. Get the branches of a condition as
+    lists of literals and numeric conditions.
+    """
+    if isinstance(condition, LiteralConjunction):
+        branches = [[]]
+        for cond in condition.literals:
+            branches = [branch + other for branch in branches for other in _to_dnf(cond)]
+        return branches
+    if isinstance(condition, LiteralDisjunction):
+        return [branch for cond in condition.literals for branch in _to_dnf(cond)]
+    if isinstance(condition, (Literal, FLiteral, NumericCondition)):
+        return [[condition]]
+    raise NotImplementedError("Cannot ground condition {}".format(condition))
+
+
+def _flatten_effects(effects, condition=None):
+    """Helper for ground_domain. Get (condition or None, Literal or
+    Assign) pairs.
+    """
+    if isinstance(effects, LiteralConjunction):
+        effects = effects.literals
+    if isinstance(effects, list):
+        return [pair for effect in effects for pair in _flatten_effects(effect, condition)]
+    if isinstance(effects, When):
+        if condition is not None:
+            raise NotImplementedError("Cannot ground nested when effects")
+        return _flatten_effects(effects.variables, effects.literal)
+    if isinstance(effects, (Literal, Assign)):
+        return [(condition, effects)]
+    raise NotImplementedError("Cannot ground effect {}".format(effects))
+
+
+def _get_comparator(lit):
+    """Helper for ground_domain. The comparator of an FLiteral holding a
+    value.
+    """
+    form = lit.function.form
+    return getattr(form, "form", form)
+
+
+def _get_comparison(cond):
+    """Helper for ground_domain. Get (comparator, left, right).
+    """
+    if isinstance(cond, NumericCondition):
+        return cond.comparator, cond.left, cond.right
+    return _get_comparator(cond), cond, cond.function.value
+
+
+def _iter_terms(expression):
+    """Helper for ground_domain. Iterate over the function terms of a
+    numeric condition or expression.
+    """
+    if isinstance(expression, FLiteral):
+        yield expression
+        if isinstance(expression.function.value, FLiteral):
+            yield expression.function.value
+    elif isinstance(expression, NumericCondition):
+        yield from _iter_terms(expression.left)
+        yield from _iter_terms(expression.right)
+    elif isinstance(expression, NumericOperation):
+        for arg in expression.arguments:
+            yield from _iter_terms(arg)
+
+
+def _get_variables(cond):
+    """Helper for ground_domain
+    """
+    if isinstance(cond, Literal):
+        return cond.variables
+    return [var for term in _iter_terms(cond) for var in term.variables]
+
+
+def _ground(lit, assignment):
+    """Helper for ground_domain. Like ground_literal, but keeping
+    constants.
+    """
+    return lit.predicate(*_ground_objects(lit, assignment))
+
+
+def _ground_objects(lit, assignment):
+    """Helper for ground_domain
+    """
+    return tuple(assignment.get(var, var) for var in lit.variables)
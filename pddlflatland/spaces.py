@@ -4,22 +4,37 @@ Unlike typical spaces, Literal spaces may change with
 each episode, since objects, and therefore possible
 groundings, may change with each new PDDL problem.
 """
-from pddlflatland.structs import LiteralConjunction, Literal, ground_literal
-from pddlflatland.parser import PDDLProblemParser
+from pddlflatland.structs import LiteralConjunction, LiteralDisjunction, Literal, ground_literal, \
+    BitsetState
+from pddlflatland.pddl_writer import ProblemWriter
 from pddlflatland.downward_translate.instantiate import explore as downward_explore
 from pddlflatland.downward_translate.pddl_parser import open as downward_open
+from pddlflatland.downward_translate.pddl_parser.parsing_functions import \
+    parse_task as downward_parse_task
 from pddlflatland.utils import nostdout
 from gym.spaces import Space
 from collections import defaultdict
 
+import numpy as np
 import os
 import tempfile
 import itertools
+import bisect
+import math
 
 TMP_PDDL_DIR = "/dev/shm" if os.path.exists("/dev/shm") else None
 
 
 class LiteralSpace(Space):
+    """Space of the ground literals of some predicates.
+
+    Ground literals are not materialized. The ground literals of each
+    predicate are indexed in mixed radix over the sorted objects of its
+    argument types, after those of the previous predicates, so they can
+    be counted, sampled and decoded without enumerating the cross product.
+    See self.index_to_literal. Indices whose literal repeats an object
+    are never valid.
+    """
 
     def __init__(self, predicates,
                  lit_valid_test=lambda state,lit: True,
@@ -27,6 +42,7 @@ class LiteralSpace(Space):
                  type_to_parent_types=None):
         self.predicates = sorted(predicates)
         self.num_predicates = len(predicates)
+        self._predicate_to_index = {p: i for i, p in enumerate(self.predicates)}
         self._objects = None
         self._lit_valid_test = lit_valid_test
         self.type_hierarchy = type_hierarchy
@@ -35,11 +51,11 @@ class LiteralSpace(Space):
 
     def _update_objects_from_state(self, state):
         """Given a state, extract the objects and if they have changed, 
-        recompute all ground literals
+        recompute the index of the ground literals
         """
         # Check whether the objects have changed
         # If so, we need to recompute the ground literals
-        if state.objects == self._objects:
+        if state.objects is self._objects or state.objects == self._objects:
             return
 
         # Organize objects by type
@@ -51,15 +67,68 @@ class LiteralSpace(Space):
             else:
                 for t in self._type_to_parent_types[obj.var_type]:
                     self._type_to_objs[t].append(obj)
+        self._type_to_obj_index = {t: {obj: i for i, obj in enumerate(objs)}
+                                   for t, objs in self._type_to_objs.items()}
+
+        # Mixed-radix index, see self.index_to_literal
+        self._radices = []
+        self._offsets = [0]
+        for predicate in self.predicates:
+            radices = [len(self._type_to_objs[vt]) for vt in predicate.var_types]
+            self._radices.append(radices)
+            self._offsets.append(self._offsets[-1] + math.prod(radices))
 
         self._objects = state.objects
-        self._all_ground_literals = sorted(self._compute_all_ground_literals(state))
+
+    @property
+    def num_ground_literals(self):
+        """The number of indices of the current objects, including
+        literals that repeat an object.
+        """
+        return self._offsets[-1]
+
+    def index_to_literal(self, index):
+        """Decode an index of the current objects' ground literals.
+        """
+        if not 0 <= index < self._offsets[-1]:
+            raise IndexError(index)
+        predicate_index = bisect.bisect_right(self._offsets, index) - 1
+        predicate = self.predicates[predicate_index]
+        index -= self._offsets[predicate_index]
+        digits = []
+        for radix in reversed(self._radices[predicate_index]):
+            index, digit = divmod(index, radix)
+            digits.append(digit)
+        return predicate(*[self._type_to_objs[vt][digit] for vt, digit
+                           in zip(predicate.var_types, reversed(digits))])
+
+    def literal_to_index(self, literal):
+        """Inverse of index_to_literal.
+        """
+        predicate_index = self._predicate_to_index[literal.predicate]
+        index = 0
+        for var_type, radix, obj in zip(literal.predicate.var_types,
+                                        self._radices[predicate_index],
+                                        literal.variables):
+            index = index * radix + self._type_to_obj_index[var_type][obj]
+        return self._offsets[predicate_index] + index
+
+    def action_mask(self, state):
+        """Get a bool array over the ground literals of state's objects
+        that is True for the valid literals. See index_to_literal.
+        """
+        self._update_objects_from_state(state)
+        return np.fromiter((len(set(choice)) == len(choice) and
+                            self._lit_valid_test(state, predicate(*choice))
+                            for predicate, choice in self._iter_choices()),
+                           dtype=bool, count=self.num_ground_literals)
 
     def sample_literal(self, state):
+        # Rejection sampling; only the sampled candidates are tested
         while True:
-            num_lits = len(self._all_ground_literals)
-            idx = self.np_random.choice(num_lits)
-            lit = self._all_ground_literals[idx]
+            lit = self.index_to_literal(self.np_random.choice(self.num_ground_literals))
+            if len(set(lit.variables)) != len(lit.variables):
+                continue
             if self._lit_valid_test(state, lit):
                 break
         return lit  
@@ -71,25 +140,104 @@ class LiteralSpace(Space):
     def all_ground_literals(self, state, valid_only=True):
         self._update_objects_from_state(state)
         if not valid_only:
-            return set(self._all_ground_literals)
-        return set(l for l in self._all_ground_literals \
+            return self._compute_all_ground_literals(state)
+        return set(l for l in self._iter_ground_literals() \
                    if self._lit_valid_test(state, l))
 
-    def _compute_all_ground_literals(self, state):
-        all_ground_literals = set()
+    def _iter_choices(self):
+        """Yield (predicate, objects) in index order.
+        """
         for predicate in self.predicates:
             choices = [self._type_to_objs[vt] for vt in predicate.var_types]
             for choice in itertools.product(*choices):
-                if len(set(choice)) != len(choice):
-                    continue
-                lit = predicate(*choice)
-                all_ground_literals.add(lit)
-        return all_ground_literals
+                yield predicate, choice
+
+    def _iter_ground_literals(self):
+        for predicate, choice in self._iter_choices():
+            if len(set(choice)) != len(choice):
+                continue
+            yield predicate(*choice)
+
+    def _compute_all_ground_literals(self, state):
+        return set(self._iter_ground_literals())
+
+
+class EnumeratedLiteralSpace(LiteralSpace):
+    """Literal space over an explicit list of ground literals.
 
+    For domains where the ground literals that can ever be valid are far
+    fewer than the cross product of typed objects. The ground literals
+    are computed by ground_literals_fn (or an override of
+    self._compute_all_ground_literals) whenever the objects change, and
+    indexed by their position in sorted order.
+
+    Parameters
+    ----------
+    predicates : [ Predicate ]
+    ground_literals_fn : fn or None
+        state -> { Literal }, the ground literals for the objects of state.
+    """
+    def __init__(self, predicates, ground_literals_fn=None,
+                 lit_valid_test=lambda state,lit: True,
+                 type_hierarchy=None, type_to_parent_types=None):
+        self._ground_literals_fn = ground_literals_fn
+        super().__init__(predicates,
+            lit_valid_test=lit_valid_test,
+            type_hierarchy=type_hierarchy,
+            type_to_parent_types=type_to_parent_types)
+
+    def _update_objects_from_state(self, state):
+        if state.objects is self._objects or state.objects == self._objects:
+            return
+        super()._update_objects_from_state(state)
+        self._all_ground_literals = sorted(self._compute_all_ground_literals(state))
+        self._literal_to_index = {lit: i for i, lit in enumerate(self._all_ground_literals)}
+
+    @property
+    def num_ground_literals(self):
+        return len(self._all_ground_literals)
+
+    def index_to_literal(self, index):
+        """Get the ground literal with an index in the current objects'
+        sorted ground literals.
+        """
+        return self._all_ground_literals[index]
+
+    def literal_to_index(self, literal):
+        """Inverse of index_to_literal.
+        """
+        return self._literal_to_index[literal]
+
+    def action_mask(self, state):
+        self._update_objects_from_state(state)
+        return np.fromiter((self._lit_valid_test(state, lit)
+                            for lit in self._all_ground_literals),
+                           dtype=bool, count=len(self._all_ground_literals))
+
+    def all_ground_literals(self, state, valid_only=True):
+        self._update_objects_from_state(state)
+        if not valid_only:
+            return set(self._all_ground_literals)
+        return super().all_ground_literals(state, valid_only=True)
+
+    def _iter_ground_literals(self):
+        return iter(self._all_ground_literals)
+
+    def _compute_all_ground_literals(self, state):
+        return set(self._ground_literals_fn(state))
 
-class LiteralActionSpace(LiteralSpace):
+
+class LiteralActionSpace(EnumeratedLiteralSpace):
     """Literal space with more efficient valid action generation.
 
+    Valid actions are maintained incrementally: each ground action
+    keeps a count of its unsatisfied preconditions, and an inverted
+    index from ground atoms to the actions whose preconditions mention
+    them updates the counts from the literals added and deleted between
+    two states. See self.update_applicable. The counts and valid actions
+    are arrays over the indices of the ground actions, see
+    self.action_mask.
+
     For now, assumes operators_as_actions.
     """
     def __init__(self, domain, predicates,
@@ -107,6 +255,8 @@ class LiteralActionSpace(LiteralSpace):
             assert isinstance(operator.preconds, LiteralConjunction)
             assert all([isinstance(l, Literal) for l in operator.preconds.literals])
         self._action_predicate_to_operators = action_predicate_to_operators
+        # Keeps the text of literals between calls of self._load_downward_task
+        self._problem_writer = ProblemWriter(domain.domain_name)
 
         super().__init__(predicates,
             type_hierarchy=type_hierarchy,
@@ -115,7 +265,7 @@ class LiteralActionSpace(LiteralSpace):
     def _update_objects_from_state(self, state):
         # Check whether the objects have changed
         # If so, we need to recompute things
-        if state.objects == self._objects:
+        if state.objects is self._objects or state.objects == self._objects:
             return
 
         # Parent class update
@@ -125,7 +275,8 @@ class LiteralActionSpace(LiteralSpace):
         # Associate each ground action literal with ground preconditions
         self._ground_action_to_pos_preconds = {}
         self._ground_action_to_neg_preconds = {}
-        for ground_action in self._all_ground_literals:
+        atom_to_ground_actions = defaultdict(list)
+        for index, ground_action in enumerate(self._all_ground_literals):
             operator = self._action_predicate_to_operators[ground_action.predicate]
             lifted_preconds = operator.preconds.literals
             subs = dict(zip(operator.params, ground_action.variables))
@@ -138,11 +289,132 @@ class LiteralActionSpace(LiteralSpace):
                     pos_preconds.add(p)
             self._ground_action_to_pos_preconds[ground_action] = pos_preconds
             self._ground_action_to_neg_preconds[ground_action] = neg_preconds
+            for p in pos_preconds:
+                atom_to_ground_actions[p].append((index, 1))
+            for p in neg_preconds:
+                atom_to_ground_actions[p].append((index, -1))
+
+        # Maps each precondition atom to the indices of the ground actions
+        # that mention it and +1 / -1 for a positive / negative precondition
+        self._atom_to_ground_actions = {}
+        self._atom_to_index = {}
+        for atom, entries in sorted(atom_to_ground_actions.items()):
+            self._atom_to_index[atom] = len(self._atom_to_index)
+            indices, polarities = zip(*entries)
+            self._atom_to_ground_actions[atom] = (np.array(indices, dtype=np.int64),
+                                                  np.array(polarities, dtype=np.int64))
+        # Precondition incidence as padded atom index arrays. Two sentinel
+        # columns after the atoms pad them: one is always true and one is
+        # always false
+        num_atoms = len(self._atom_to_index)
+        self._pos_preconds = _pad(
+            [[self._atom_to_index[p] for p in self._ground_action_to_pos_preconds[a]]
+             for a in self._all_ground_literals], num_atoms)
+        self._neg_preconds = _pad(
+            [[self._atom_to_index[p] for p in self._ground_action_to_neg_preconds[a]]
+             for a in self._all_ground_literals], num_atoms + 1)
+
+        # Built lazily for the state in self._synced_state, see
+        # self._sync_applicable
+        self._synced_state = None
+        self._num_unsatisfied = None
+        self._mask = None
+
+    def update_applicable(self, state, next_state, added, deleted):
+        """Update the valid actions after a transition.
+
+        Called by the env after the effects of an action are applied,
+        so that the next query only needs to visit the actions whose
+        preconditions mention the changed literals.
+
+        Parameters
+        ----------
+        state : State
+            The state before the transition.
+        next_state : State
+            The state after the transition.
+        added : { Literal }
+            Literals in next_state but not in state.
+        deleted : { Literal }
+            Literals in state but not in next_state.
+        """
+        # Nothing to update if the valid actions were not computed for
+        # state; the next query finds the delta itself
+        if self._synced_state is None or not _same_literals(self._synced_state, state):
+            return
+        self._apply_delta(added, deleted)
+        self._synced_state = next_state
+
+    def _sync_applicable(self, state):
+        """Bring the valid actions up to date with the literals of a state.
+        """
+        if self._synced_state is not None and _same_literals(self._synced_state, state):
+            return
+        if self._synced_state is None:
+            atoms = np.zeros(len(self._atom_to_index) + 2, dtype=bool)
+            atoms[[self._atom_to_index[lit] for lit in state.literals
+                   if lit in self._atom_to_index]] = True
+            atoms[len(self._atom_to_index)] = True
+            self._num_unsatisfied = (~atoms[self._pos_preconds]).sum(axis=1) + \
+                atoms[self._neg_preconds].sum(axis=1)
+            self._mask = self._num_unsatisfied == 0
+        else:
+            self._apply_delta(*_get_delta(self._synced_state, state))
+        self._synced_state = state
+
+    def _apply_delta(self, added, deleted):
+        """Helper for update_applicable and _sync_applicable
+        """
+        for atoms, sign in ((added, -1), (deleted, 1)):
+            for atom in atoms:
+                try:
+                    indices, polarities = self._atom_to_ground_actions[atom]
+                except KeyError:
+                    continue
+                self._num_unsatisfied[indices] += sign * polarities
+                self._mask[indices] = self._num_unsatisfied[indices] == 0
+
+    def precondition_arrays(self, state):
+        """Get the ground actions of state's objects and their
+        preconditions as padded index arrays.
+
+        Parameters
+        ----------
+        state : State
+
+        Returns
+        -------
+        ground_actions : [ Literal ]
+            See index_to_literal.
+        atoms : [ Literal ]
+            The atoms of the preconditions, indexed by the arrays.
+        pos_preconds : np.ndarray
+            (num_ground_actions, width) int array of the positive
+            preconditions of each ground action. Rows are padded with
+            len(atoms), which stands for an atom that always holds.
+        neg_preconds : np.ndarray
+            Likewise for the negative preconditions, padded with
+            len(atoms) + 1, which stands for an atom that never holds.
+        """
+        self._update_objects_from_state(state)
+        return (list(self._all_ground_literals), list(self._atom_to_index),
+                self._pos_preconds, self._neg_preconds)
+
+    def action_mask(self, state):
+        """Get a bool array over the ground actions of state's objects
+        that is True for the valid actions. See index_to_literal.
+        """
+        self._update_objects_from_state(state)
+        self._sync_applicable(state)
+        return self._mask.copy()
 
     def sample_literal(self, state):
-        valid_literals = self.all_ground_literals(state)
-        valid_literals = list(sorted(valid_literals))
-        return valid_literals[self.np_random.choice(len(valid_literals))]
+        self._update_objects_from_state(state)
+        self._sync_applicable(state)
+        # The ground actions are sorted, so this matches sampling from
+        # the sorted valid actions
+        valid_indices = np.flatnonzero(self._mask)
+        return self._all_ground_literals[valid_indices[self.np_random.choice(len(valid_indices))]]
 
     def sample(self, state):
         return self.sample_literal(state)
@@ -150,35 +422,17 @@ class LiteralActionSpace(LiteralSpace):
     def all_ground_literals(self, state, valid_only=True):
         self._update_objects_from_state(state)
         assert valid_only, "The point of this class is to avoid the cross product!"
-        valid_literals = set()
-        for ground_action in self._all_ground_literals:
-            pos_preconds = self._ground_action_to_pos_preconds[ground_action]
-            if not pos_preconds.issubset(state.literals):
-                continue
-            neg_preconds = self._ground_action_to_neg_preconds[ground_action]
-            if len(neg_preconds & state.literals) > 0:
-                continue
-            valid_literals.add(ground_action)
-        return valid_literals
+        self._sync_applicable(state)
+        return {self._all_ground_literals[i] for i in np.flatnonzero(self._mask)}
 
     def _compute_all_ground_literals(self, state):
         """Call FastDownward's instantiator.
         """
-        # Generate temporary files to hand over to instantiator.
-        _, domain_fname = tempfile.mkstemp(dir=TMP_PDDL_DIR, text=True)
-        self.domain.write(domain_fname)
-        p_desc, problem_fname = tempfile.mkstemp(dir=TMP_PDDL_DIR, text=True)
-        with os.fdopen(p_desc, "w") as f:
-            PDDLProblemParser.create_pddl_file(
-                file_or_filepath=f,
-                objects=state.objects,
-                initial_state=state.literals,
-                problem_name="myproblem",
-                domain_name=self.domain.domain_name,
-                goal=state.goal,
-                fast_downward_order=True)
+        try:
+            task = create_downward_task(self.domain, state)
+        except NotImplementedError:
+            task = self._load_downward_task(state)
         # Call instantiator.
-        task = downward_open(domain_fname, problem_fname)
         with nostdout():
             _, _, actions, _, _ = downward_explore(task)
         # Post-process to our representation.
@@ -200,6 +454,133 @@ class LiteralActionSpace(LiteralSpace):
             all_ground_literals.add(pred(*objs))
         return all_ground_literals
 
+    def _load_downward_task(self, state):
+        """Create a FastDownward task through temporary PDDL files, for
+        domains that create_downward_task does not support.
+        """
+        d_desc, domain_fname = tempfile.mkstemp(dir=TMP_PDDL_DIR, text=True)
+        p_desc, problem_fname = tempfile.mkstemp(dir=TMP_PDDL_DIR, text=True)
+        try:
+            os.close(d_desc)
+            self.domain.write(domain_fname)
+            with os.fdopen(p_desc, "w") as f:
+                self._problem_writer.write(f, state.objects, state.literals, state.goal)
+            return downward_open(domain_fname, problem_fname)
+        finally:
+            os.remove(domain_fname)
+            os.remove(problem_fname)
+
+
+def _pad(index_lists, fill):
+    """Helper for LiteralActionSpace and vector.BatchedPDDLEnv. Stack lists
+    of indices as the rows of an array, padded with fill.
+    """
+    width = max([len(ids) for ids in index_lists] + [1])
+    arr = np.full((len(index_lists), width), fill, dtype=np.int64)
+    for i, ids in enumerate(index_lists):
+        arr[i, :len(ids)] = ids
+    return arr
+
+
+def _same_literals(state, other):
+    """Helper for LiteralActionSpace. Whether two states are known to
+    have the same literals without comparing them.
+    """
+    if isinstance(state, BitsetState) and isinstance(other, BitsetState) and \
+            state.table is other.table:
+        return state.bits == other.bits
+    return state.literals is other.literals
+
+
+def _get_delta(state, next_state):
+    """Helper for LiteralActionSpace. Get the literals added and deleted
+    between two states.
+    """
+    if isinstance(state, BitsetState) and isinstance(next_state, BitsetState) and \
+            state.table is next_state.table:
+        return (state.table.decode(next_state.bits & ~state.bits),
+                state.table.decode(state.bits & ~next_state.bits))
+    literals, next_literals = state.literals, next_state.literals
+    return next_literals - literals, literals - next_literals
+
+
+def create_downward_task(domain, state):
+    """Create the FastDownward task of a domain and a state in memory.
+
+    The domain and state are converted into the nested lists that
+    FastDownward's PDDL parser produces from files, so no files are
+    written or parsed. Like PDDLDomain.write, only the predicates and
+    operators of the domain are included.
+
+    Parameters
+    ----------
+    domain : PDDLDomain
+    state : State
+
+    Returns
+    -------
+    task : downward_translate.pddl.Task
+
+    Raises
+    ------
+    NotImplementedError
+        If the domain or state contains something other than literals,
+        conjunctions and disjunctions (e.g. numeric fluents).
+    """
+    subtypes = {t for sub_types in domain.type_hierarchy.values() for t in sub_types}
+    types = [":types"]
+    for super_type, sub_types in domain.type_hierarchy.items():
+        types.extend(sorted(sub_types) + ["-", super_type])
+    types.extend(t for t in sorted(domain.types.values())
+                 if t not in subtypes and t != "object")
+    predicates = [":predicates"]
+    for predicate in domain.predicates.values():
+        predicates.append([predicate.name] + _typed_list(
+            ["?v{}".format(i) for i in range(predicate.arity)], predicate.var_types))
+    objects = sorted(state.objects)
+    constants = [c for c in domain.constants if c not in state.objects]
+    domain_pddl = ["define", ["domain", domain.domain_name],
+                   [":requirements", ":strips", ":typing"], types,
+                   [":constants"] + _typed_list(constants, [c.var_type for c in constants]),
+                   predicates]
+    for operator in domain.operators.values():
+        domain_pddl.append([":action", operator.name,
+                            ":parameters", _typed_list(operator.params,
+                                                       [p.var_type for p in operator.params]),
+                            ":precondition", _struct_to_lisp(operator.preconds),
+                            ":effect", _struct_to_lisp(operator.effects)])
+    task_pddl = ["define", ["problem", "myproblem"], [":domain", domain.domain_name],
+                 [":objects"] + _typed_list(objects, [o.var_type for o in objects]),
+                 [":init"] + [_struct_to_lisp(lit) for lit in sorted(state.literals)],
+                 [":goal", _struct_to_lisp(state.goal)]]
+    return downward_parse_task(domain_pddl, task_pddl)
+
+
+def _typed_list(names, types):
+    """Helper for create_downward_task
+    """
+    typed_list = []
+    for name, var_type in zip(names, types):
+        typed_list.extend([str.__str__(name), "-", str.__str__(var_type)])
+    return typed_list
+
+
+def _struct_to_lisp(struct):
+    """Helper for create_downward_task
+    """
+    if isinstance(struct, Literal):
+        if struct.negated_as_failure:
+            raise NotImplementedError()
+        atom = [struct.predicate.name] + [str.__str__(v) for v in struct.variables]
+        if struct.is_negative or struct.is_anti:
+            return ["not", atom]
+        return atom
+    if isinstance(struct, LiteralConjunction):
+        return ["and"] + [_struct_to_lisp(lit) for lit in struct.literals]
+    if isinstance(struct, LiteralDisjunction):
+        return ["or"] + [_struct_to_lisp(lit) for lit in struct.literals]
+    raise NotImplementedError()
+
 
 class LiteralSetSpace(LiteralSpace):
 
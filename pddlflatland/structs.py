@@ -92,6 +92,7 @@ class Predicate(object):
         self.negated_as_failure = negated_as_failure
         self.is_anti = is_anti
         self.is_numeric = is_numeric
+        self.is_derived = False
 
     def __call__(self, *variables):
         return Literal(self, list(variables))
@@ -331,6 +332,11 @@ class Literal:
         self._str = str(self.predicate) + '(' + ','.join(map(str, self.variables)) + ')'
         self._hash = hash(self._str)
 
+    def __setstate__(self, state):
+        # str hashes differ between processes, e.g. for pickled Literals
+        self.__dict__.update(state)
+        self._hash = hash(self._str)
+
     def __str__(self):
         return self._str
 
@@ -464,6 +470,92 @@ class FLiteral:
                                         self.function.value)
 
 
+def _numeric_pddl_str(expression):
+    """Helper for NumericOperation and NumericCondition
+    """
+    if isinstance(expression, FLiteral):
+        return "({})".format(" ".join([expression.function.name] + expression.pddl_variables()))
+    if isinstance(expression, float) and expression.is_integer():
+        return str(int(expression))
+    if isinstance(expression, (int, float)):
+        return str(expression)
+    return expression.pddl_str()
+
+
+def _numeric_str(expression):
+    """Helper for NumericOperation and NumericCondition
+    """
+    if isinstance(expression, FLiteral):
+        return "{}({})".format(expression.function.name, ",".join(map(str, expression.variables)))
+    return str(expression)
+
+
+class NumericOperation:
+    """An arithmetic operation (+, -, * or /) on numeric expressions.
+
+    Parameters
+    ----------
+    operator : str
+    arguments : [ FLiteral or float or NumericOperation ]
+        FLiterals are function terms; their values are ignored.
+    """
+
+    def __init__(self, operator, arguments):
+        self.operator = operator
+        self.arguments = arguments
+
+    def __str__(self):
+        return "({} {})".format(self.operator, " ".join(map(_numeric_str, self.arguments)))
+
+    def __repr__(self):
+        return str(self)
+
+    def __hash__(self):
+        return hash(str(self))
+
+    def __eq__(self, other):
+        return str(self) == str(other)
+
+    def pddl_str(self):
+        return "({} {})".format(self.operator, " ".join(map(_numeric_pddl_str, self.arguments)))
+
+
+class NumericCondition:
+    """A comparison (=, <, >, <= or >=) of two numeric expressions.
+
+    Simple conditions like (= (function ?v) 1) are parsed into FLiterals
+    holding the value instead.
+
+    Parameters
+    ----------
+    comparator : str
+    left : FLiteral or float or NumericOperation
+    right : FLiteral or float or NumericOperation
+    """
+
+    def __init__(self, comparator, left, right):
+        self.comparator = comparator
+        self.left = left
+        self.right = right
+
+    def __str__(self):
+        return "({} {} {})".format(self.comparator, _numeric_str(self.left),
+                                   _numeric_str(self.right))
+
+    def __repr__(self):
+        return str(self)
+
+    def __hash__(self):
+        return hash(str(self))
+
+    def __eq__(self, other):
+        return str(self) == str(other)
+
+    def pddl_str(self):
+        return "({} {} {})".format(self.comparator, _numeric_pddl_str(self.left),
+                                   _numeric_pddl_str(self.right))
+
+
 class LiteralConjunction:
     """A logical conjunction (AND) of Literals.
 
@@ -550,6 +642,9 @@ class ForAll:
     variable is a structs.TypedEntity.
     """
 
+    # Negated quantifiers are not parsed, see PrologInterface
+    is_negative = False
+
     def __init__(self, literal, variables):
         if isinstance(variables, str):
             variables = [variables]
@@ -557,6 +652,11 @@ class ForAll:
         self.literal = literal
         self.variables = variables
 
+    @property
+    def body(self):
+        # Named as the body of Exists
+        return self.literal
+
     def __str__(self):
         return "FORALL ({}) : {}".format(self.variables, self.literal)
 
@@ -597,11 +697,12 @@ class When:
 
 class Assign:
     """Represents a Assign over the given variable in the given literal.
-    variable is a structs.TypedEntity.
+    literal is the FLiteral term assigned to and variables is a list
+    holding the assigned numeric expression.
     """
 
     def __init__(self, literal, variables):
-        if isinstance(variables, str):
+        if not isinstance(variables, list):
             variables = [variables]
 
         self.literal = literal
@@ -624,6 +725,9 @@ class Exists:
     """
     """
 
+    # Negated quantifiers are not parsed, see PrologInterface
+    is_negative = False
+
     def __init__(self, variables, literal):
         self.variables = variables
         self.body = literal
@@ -682,7 +786,12 @@ class ProbabilisticEffect:
 ### States ###
 
 # A State is a frozenset of ground literals and a frozenset of objects
-class State(namedtuple("State", ["literals", "objects", "goal"])):
+class State(namedtuple("State", ["literals", "objects", "goal", "fluents"],
+                         defaults=(None,))):
+    """
+    fluents : NumericFluents or None
+        The values of the ground function terms, see pddlflatland.numeric.
+    """
     __slots__ = ()
 
     def with_literals(self, literals):
@@ -706,6 +815,171 @@ class State(namedtuple("State", ["literals", "objects", "goal"])):
         """
         return self._replace(goal=goal)
 
+    def with_fluents(self, fluents):
+        """
+        Return a new state that is the same as the given one, but has the
+        given NumericFluents instead of state.fluents.
+        """
+        return self._replace(fluents=fluents)
+
+
+class AtomTable:
+    """Interns ground literals (atoms) as consecutive integer ids.
+
+    One table is shared by all compact states of a problem. Sets of
+    atoms are encoded as Python int bitsets where bit i is set iff
+    the atom with id i holds.
+
+    Parameters
+    ----------
+    atoms : [ Literal ]
+        Atoms to intern upfront. More are interned on demand.
+    """
+
+    def __init__(self, atoms=()):
+        self._atom_to_id = {}
+        self._atoms = []
+        self._condition_masks = {}
+        for atom in atoms:
+            self.intern(atom)
+
+    def __len__(self):
+        return len(self._atoms)
+
+    def intern(self, atom):
+        """Get the id of an atom, creating one if necessary.
+        """
+        try:
+            return self._atom_to_id[atom]
+        except KeyError:
+            idx = len(self._atoms)
+            self._atom_to_id[atom] = idx
+            self._atoms.append(atom)
+            return idx
+
+    def get_id(self, atom):
+        """Get the id of an atom, or -1 if it is not in the table.
+        """
+        return self._atom_to_id.get(atom, -1)
+
+    def atom(self, idx):
+        return self._atoms[idx]
+
+    def encode(self, atoms):
+        """Encode a set of atoms as an int bitset.
+        """
+        bits = 0
+        for atom in atoms:
+            bits |= 1 << self.intern(atom)
+        return bits
+
+    def decode(self, bits):
+        """Decode an int bitset into a frozenset of atoms.
+        """
+        return frozenset(self._atoms[i] for i in self.iter_ids(bits))
+
+    @staticmethod
+    def iter_ids(bits):
+        """Iterate over the ids of the set bits, in increasing order.
+        """
+        while bits:
+            low_bit = bits & -bits
+            yield low_bit.bit_length() - 1
+            bits ^= low_bit
+
+    def to_array(self, bits, size=None):
+        """Convert an int bitset into a NumPy bool array indexed by atom id.
+        """
+        size = len(self) if size is None else size
+        arr = np.zeros(size, dtype=bool)
+        arr[list(self.iter_ids(bits))] = True
+        return arr
+
+    @staticmethod
+    def from_array(arr):
+        """Convert a NumPy bool array indexed by atom id into an int bitset.
+        """
+        bits = 0
+        for i in np.flatnonzero(arr):
+            bits |= 1 << int(i)
+        return bits
+
+    def get_condition_masks(self, condition):
+        """Get (positive mask, negative mask) for a Literal or a
+        LiteralConjunction of Literals, or None for other conditions.
+        """
+        try:
+            return self._condition_masks[condition]
+        except KeyError:
+            pass
+        if isinstance(condition, Literal):
+            literals = [condition]
+        elif isinstance(condition, LiteralConjunction) and \
+                all(isinstance(lit, Literal) for lit in condition.literals):
+            literals = condition.literals
+        else:
+            literals = None
+        if literals is None:
+            masks = None
+        else:
+            masks = (self.encode(lit for lit in literals if not lit.is_negative),
+                     self.encode(lit.positive for lit in literals if lit.is_negative))
+        self._condition_masks[condition] = masks
+        return masks
+
+
+class BitsetState(namedtuple("BitsetState", ["bits", "objects", "goal", "table", "fluents"],
+                               defaults=(None,))):
+    """A compact State whose literals are an int bitset over an AtomTable.
+
+    BitsetState exposes the same literals / objects / goal interface as
+    State, so it can be used wherever a State is expected, but
+    precondition checks, effect application and goal tests can be done
+    with bit operations.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_state(cls, state, table=None):
+        """Encode a State. A new AtomTable is created if none is given.
+        """
+        if table is None:
+            table = AtomTable(sorted(state.literals))
+        return cls(table.encode(state.literals), frozenset(state.objects),
+                   state.goal, table, state.fluents)
+
+    def to_state(self):
+        return State(self.literals, self.objects, self.goal, self.fluents)
+
+    @property
+    def literals(self):
+        return self.table.decode(self.bits)
+
+    def holds(self, pos_mask, neg_mask=0):
+        """Check that all atoms in pos_mask and no atoms in neg_mask hold.
+        """
+        return (self.bits & pos_mask) == pos_mask and not (self.bits & neg_mask)
+
+    def with_bits(self, bits):
+        return self._replace(bits=bits)
+
+    def apply(self, add_mask, delete_mask):
+        """Delete then add atoms, as in operator effects.
+        """
+        return self._replace(bits=(self.bits & ~delete_mask) | add_mask)
+
+    def with_literals(self, literals):
+        return self._replace(bits=self.table.encode(literals))
+
+    def with_objects(self, objects):
+        return self._replace(objects=frozenset(objects))
+
+    def with_goal(self, goal):
+        return self._replace(goal=goal)
+
+    def with_fluents(self, fluents):
+        return self._replace(fluents=fluents)
+
 
 ### Helpers ###
 # Receive a Literal that return the Predicate
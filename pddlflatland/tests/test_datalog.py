@@ -0,0 +1,98 @@
+from pddlflatland.datalog import DatalogEvaluator
+from pddlflatland.parser import PDDLDomain
+from pddlflatland.structs import (Type, Predicate, DerivedPredicate, LiteralConjunction,
+                                  LiteralDisjunction, Exists, Not)
+
+import numpy as np
+
+
+def _create_domain():
+    node_type = Type("node")
+    edge = Predicate("edge", 2, [node_type, node_type])
+    blocked = Predicate("blocked", 1, [node_type])
+    reachable = DerivedPredicate("reachable", 2, [node_type, node_type])
+    open_path = DerivedPredicate("open-path", 2, [node_type, node_type])
+    x, y, z = node_type("?x"), node_type("?y"), node_type("?z")
+    # Recursive, with an existential
+    reachable.setup(["?x", "?y"], LiteralDisjunction([
+        edge(x, y),
+        Exists([z], LiteralConjunction([reachable(x, z), edge(z, y)]))]))
+    # Negation of a base predicate, in a higher stratum
+    open_path.setup(["?x", "?y"], LiteralConjunction([reachable(x, y), Not(blocked(y))]))
+    predicates = {p.name: p for p in [edge, blocked, reachable, open_path]}
+    domain = PDDLDomain(domain_name="graph", types={"node": node_type},
+                        type_hierarchy={}, predicates=predicates, functions={},
+                        operators={}, actions=[])
+    return domain, predicates
+
+
+def _naive_derived_literals(predicates, edges, blocked_nodes):
+    """Transitive closure of edges, computed naively.
+    """
+    reachable = set(edges)
+    while True:
+        new_reachable = {(x, y2) for (x, y) in reachable for (y1, y2) in edges if y == y1}
+        if new_reachable.issubset(reachable):
+            break
+        reachable |= new_reachable
+    derived_literals = {predicates["reachable"](x, y) for x, y in reachable}
+    derived_literals |= {predicates["open-path"](x, y) for x, y in reachable
+                         if y not in blocked_nodes}
+    return derived_literals
+
+
+def test_datalog_derived_predicates():
+    domain, predicates = _create_domain()
+    edge, blocked = predicates["edge"], predicates["blocked"]
+    reachable, open_path = predicates["reachable"], predicates["open-path"]
+    evaluator = DatalogEvaluator(domain)
+    assert domain.derived_predicate_evaluator is not None
+
+    nodes = [domain.types["node"]("n{}".format(i)) for i in range(6)]
+    edges = [(nodes[i], nodes[i + 1]) for i in range(4)] + [(nodes[3], nodes[1])]
+    literals = {edge(x, y) for x, y in edges} | {blocked(nodes[2])}
+    derived_literals = evaluator.evaluate(literals, set(nodes))
+
+    assert reachable(nodes[0], nodes[4]) in derived_literals
+    assert reachable(nodes[2], nodes[2]) in derived_literals
+    assert reachable(nodes[4], nodes[0]) not in derived_literals
+    assert not any(lit.variables[0] == nodes[5] for lit in derived_literals)
+    assert open_path(nodes[0], nodes[3]) in derived_literals
+    assert open_path(nodes[0], nodes[2]) not in derived_literals
+    assert derived_literals == _naive_derived_literals(predicates, edges, {nodes[2]})
+
+    # Derived literals in the input are recomputed, not trusted
+    derived_literals2 = evaluator.evaluate(literals | {reachable(nodes[5], nodes[0])}, set(nodes))
+    assert derived_literals2 == derived_literals
+
+    print("Test passed.")
+
+
+def test_datalog_incremental_update():
+    domain, predicates = _create_domain()
+    edge, blocked = predicates["edge"], predicates["blocked"]
+    evaluator = DatalogEvaluator(domain)
+    assert evaluator.is_incremental
+
+    rng = np.random.RandomState(0)
+    nodes = [domain.types["node"]("n{}".format(i)) for i in range(6)]
+    candidates = [edge(x, y) for x in nodes for y in nodes] + [blocked(x) for x in nodes]
+    literals = set()
+    model = evaluator.create_model(literals, set(nodes))
+    derived_literals = set()
+    for _ in range(50):
+        changed = {candidates[i] for i in rng.choice(len(candidates), size=3, replace=False)}
+        added, deleted = changed - literals, changed & literals
+        literals = (literals | added) - deleted
+        derived_added, derived_deleted = evaluator.update(model, added, deleted)
+        assert not derived_added & derived_literals
+        assert derived_deleted.issubset(derived_literals)
+        derived_literals = (derived_literals - derived_deleted) | derived_added
+        assert derived_literals == evaluator.evaluate(literals, set(nodes))
+
+    print("Test passed.")
+
+
+if __name__ == "__main__":
+    test_datalog_derived_predicates()
+    test_datalog_incremental_update()
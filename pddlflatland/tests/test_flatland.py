@@ -1,5 +1,393 @@
 from pddlgym.parser import PDDLDomainParser, PDDLProblemParser
-from pddlgym.structs import Equation
+from pddlgym.structs import Equation, State
+from pddlgym.numeric import NumericFluents, ConditionalEffects, compile_numeric_condition
+from pddlgym.core import PDDLFlatlandEnv, _apply_effects
+from pddlgym.inference import check_goal
+from pddlgym.flatland_encoding import RailEnvEncoder, encode_transitions, get_transition_code, \
+    DONE_REMOVED
+from flatland.envs.rail_env import RailEnvActions
+from types import SimpleNamespace
+
+import numpy as np
+import os
+import pytest
+
+
+def _import_sparse_schedule_generator():
+    # Later versions of flatland-rl renamed the module to line_generators,
+    # which raises an ImportError instead of a ModuleNotFoundError
+    try:
+        from flatland.envs.schedule_generators import sparse_schedule_generator
+    except ImportError:
+        pytest.skip("flatland.envs.schedule_generators is not available")
+    return sparse_schedule_generator
+
+
+def test_grid_aware_grounding():
+    sparse_schedule_generator = _import_sparse_schedule_generator()
+    from flatland.envs.rail_generators import sparse_rail_generator
+    from flatland.envs.observations import GlobalObsForRailEnv
+
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    domain_file = os.path.join(dir_path, '..', 'pddl', 'flatland.pddl')
+    problem_dir = os.path.join(dir_path, '..', 'pddl', 'flatland')
+    env = PDDLFlatlandEnv(width=3,
+                          height=3,
+                          rail_generator=sparse_rail_generator(seed=0),
+                          schedule_generator=sparse_schedule_generator(),
+                          number_of_agents=2,
+                          obs_builder_object=GlobalObsForRailEnv(),
+                          domain_file=domain_file,
+                          problem_dir=problem_dir)
+    problem = env.problems[0]
+    state = State(frozenset(problem.initial_state), frozenset(problem.objects), problem.goal)
+    position = {lit.variables[0]: int(lit.function.value) - 1 for lit in state.literals
+                if hasattr(lit, 'function') and lit.function.name == 'position'}
+
+    # No rail yet, so every 4-neighbour may be moved to
+    ground_actions = env.ground_actions(state)
+    moves = [a for a in ground_actions if a.predicate.name.startswith('move-')]
+    # 3 move operators, 2 agents and 24 ordered pairs of adjacent cells
+    assert len(moves) == 3 * 2 * 24
+    for move in moves:
+        row, col = divmod(position[move.variables[2]], 3)
+        next_row, next_col = divmod(position[move.variables[3]], 3)
+        assert abs(row - next_row) + abs(col - next_col) == 1
+    # stop is grounded for all agents and cells
+    assert len(ground_actions) - len(moves) == 2 * 9
+
+    print("Test passed.")
+
+
+def test_step_without_encoder():
+    sparse_schedule_generator = _import_sparse_schedule_generator()
+    from flatland.envs.rail_generators import sparse_rail_generator
+    from flatland.envs.observations import GlobalObsForRailEnv
+
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    domain_file = os.path.join(dir_path, '..', 'pddl', 'flatland.pddl')
+    problem_dir = os.path.join(dir_path, '..', 'pddl', 'flatland')
+    env = PDDLFlatlandEnv(width=3,
+                          height=3,
+                          rail_generator=sparse_rail_generator(seed=0),
+                          schedule_generator=sparse_schedule_generator(),
+                          number_of_agents=2,
+                          obs_builder_object=GlobalObsForRailEnv(),
+                          domain_file=domain_file,
+                          problem_dir=problem_dir)
+    state, _ = env.reset()
+    action = next(a for a in env.ground_actions(state) if env._action_valid_test(state, a))
+    expected_state, _, _, _ = env.sample_transition(action)
+
+    # Steps the PDDL problem only
+    next_state, _, _, _ = env.step(action)
+    assert next_state.literals == expected_state.literals
+    assert env.get_state() is next_state
+
+    print("Test passed.")
+
+
+def test_encode_transitions():
+    vertical, horizontal = 0x8020, 0x0401
+    # Entered from the south and leaving east, or entered from the east
+    # and leaving south
+    curve = 0x4002
+    codes = encode_transitions(np.array([[vertical, horizontal], [curve, 0]], dtype=np.uint16))
+    assert codes.tolist() == [[1, 2], [10, 0]]
+    assert get_transition_code(curve, 0) == 13
+    assert get_transition_code(curve, 3) == 10
+    assert get_transition_code(curve, 1) is None
+
+    print("Test passed.")
+
+
+def test_rail_env_encoder():
+    sparse_schedule_generator = _import_sparse_schedule_generator()
+    from flatland.envs.rail_generators import sparse_rail_generator
+    from flatland.envs.observations import GlobalObsForRailEnv
+
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    domain_file = os.path.join(dir_path, '..', 'pddl', 'flatland.pddl')
+    problem_dir = os.path.join(dir_path, '..', 'pddl', 'flatland')
+    env = PDDLFlatlandEnv(width=25,
+                          height=25,
+                          rail_generator=sparse_rail_generator(max_num_cities=2, seed=0),
+                          schedule_generator=sparse_schedule_generator(),
+                          number_of_agents=2,
+                          obs_builder_object=GlobalObsForRailEnv(),
+                          domain_file=domain_file,
+                          problem_dir=problem_dir,
+                          encode_rail_env=True)
+    state, debug_info = env.reset()
+    assert debug_info['problem_file'] is None
+
+    cells = [obj for obj in state.objects if obj.var_type == 'cell']
+    assert len(cells) == np.count_nonzero(env.rail.grid)
+    at = env.domain.predicates['at']
+    agent_cells = {}
+    for agent in env.agents:
+        obj = env.encoder.handle_to_agent[agent.handle]
+        agent_cells[obj] = [lit.variables[1] for lit in state.literals
+                            if getattr(lit, 'predicate', None) == at and lit.variables[0] == obj]
+        assert len(agent_cells[obj]) == 1
+        assert at(obj, env.encoder.cell(*agent.target)) in state.goal.literals
+
+    obj = env.encoder.handle_to_agent[1]
+    action = env.domain.predicates['stop'](obj, agent_cells[obj][0])
+    assert env.encoder.decode_actions([action]) == {1: RailEnvActions.STOP_MOVING}
+
+    # Stepping synchronizes the state with the agents of the RailEnv
+    moves = [env.domain.predicates['move-forward'](env.encoder.railway, obj, cells[0], cells[0])
+             for obj, cells in agent_cells.items()]
+    next_state, _, _, _ = env.step(moves)
+    expected_state = RailEnvEncoder(env.domain).encode(env)
+    assert next_state.literals == expected_state.literals
+    assert next_state.fluents == expected_state.fluents
+
+    print("Test passed.")
+
+
+def test_numeric_fluents():
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    domain_file = os.path.join(dir_path, '..', 'pddl', 'flatland.pddl')
+    problem_file = os.path.join(dir_path, '..', 'pddl', 'flatland', 'problem.pddl')
+    domain = PDDLDomainParser(domain_file)
+    problem = PDDLProblemParser(problem_file, domain.domain_name, domain.types,
+                                domain.predicates, domain.functions, domain.actions)
+    objects = {obj.name: obj for obj in problem.objects}
+    fluents = NumericFluents.from_literals(problem.initial_state)
+    assert fluents.get('position', [objects['c11']]) == 5
+    assert fluents.get('direction', [objects['agent0']]) == 0
+    assert np.isnan(fluents.get('direction', [objects['c11']]))
+
+    # (= (- (position ?c) (position ?c2)) 1) keeps the subtraction
+    operator = domain.operators['move-left']
+    condition, = [lit for lit in operator.preconds.literals
+                  if lit.pddl_str().startswith('(or')]
+    assert condition.literals[-1].literals[-1].pddl_str() == \
+        '(= (- (position ?c) (position ?c2)) 1)'
+
+    # agent0 faces north on c11, whose transition turns it left to c10
+    railway, agent, cell, next_cell = operator.params
+    cells = sorted(obj for obj in problem.objects if obj.var_type == 'cell')
+    compiled = compile_numeric_condition(condition)
+    assert set(compiled.variables) == {railway, agent, cell, next_cell}
+    holds = compiled(fluents, {railway: objects['rail'], agent: objects['agent0'],
+                               cell: objects['c11'], next_cell: cells})
+    assert [c.name for c, h in zip(cells, holds) if h] == ['c10']
+
+    # Facing west on c11, no left turn is allowed
+    next_fluents = fluents.assign({('direction', (objects['agent0'],)): 3})
+    assert next_fluents != fluents
+    assert fluents.get('direction', [objects['agent0']]) == 0
+    assert not compiled(next_fluents, {railway: objects['rail'], agent: objects['agent0'],
+                                       cell: objects['c11'], next_cell: cells}).any()
+
+    print("Test passed.")
+
+
+def test_encoder_agent_removed_at_target():
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    domain = PDDLDomainParser(os.path.join(dir_path, '..', 'pddl', 'flatland.pddl'),
+                              operators_as_actions=True)
+    # A straight east-west track of 3 cells, with one agent heading east
+    # from c0_0 to c0_2. The encoder only reads these attributes.
+    horizontal = 0x0401
+    agent = SimpleNamespace(handle=0, position=(0, 0), direction=1, status=1, moving=True,
+                            initial_position=(0, 0), initial_direction=1, target=(0, 2))
+    rail_env = SimpleNamespace(rail=SimpleNamespace(grid=np.full((1, 3), horizontal)),
+                               agents=[agent])
+    encoder = RailEnvEncoder(domain)
+    state = encoder.encode(rail_env)
+    at, available = domain.predicates['at'], domain.predicates['available']
+    obj = encoder.handle_to_agent[0]
+    assert not check_goal(state, state.goal)
+
+    agent.position = (0, 1)
+    state, _, _ = encoder.sync(rail_env, state)
+    assert at(obj, encoder.cell(0, 1)) in state.literals
+    assert not check_goal(state, state.goal)
+
+    # With remove_agents_at_target, the RailEnv takes the agent off the
+    # grid once it reaches its target
+    agent.position, agent.status, agent.moving = None, 3, False
+    state, added, deleted = encoder.sync(rail_env, state)
+    assert at(obj, encoder.cell(0, 2)) in added
+    assert at(obj, encoder.cell(0, 1)) in deleted
+    assert available(encoder.cell(0, 2)) in state.literals
+    assert check_goal(state, state.goal)
+
+    print("Test passed.")
+
+
+def test_encoder_sync_visits_changed_cells():
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    domain = PDDLDomainParser(os.path.join(dir_path, '..', 'pddl', 'flatland.pddl'),
+                              operators_as_actions=True)
+    # A straight east-west track of 8 cells, with one agent heading east
+    # from c0_0 and one waiting on c0_7
+    horizontal = 0x0401
+    agent0 = SimpleNamespace(handle=0, position=(0, 0), direction=1, status=1, moving=True,
+                             initial_position=(0, 0), initial_direction=1, target=(0, 3))
+    agent1 = SimpleNamespace(handle=1, position=(0, 7), direction=3, status=1, moving=False,
+                             initial_position=(0, 7), initial_direction=3, target=(0, 4))
+    rail_env = SimpleNamespace(rail=SimpleNamespace(grid=np.full((1, 8), horizontal)),
+                               agents=[agent0, agent1])
+    encoder = RailEnvEncoder(domain)
+    state = encoder.encode(rail_env, compact=True)
+    at = domain.predicates['at']
+
+    visited = []
+    get_cell_literals = encoder._get_cell_literals
+    def spy(position):
+        visited.append(position)
+        return get_cell_literals(position)
+    encoder._get_cell_literals = spy
+    decode = encoder.table.decode
+    def no_decode(bits):
+        assert False, "The state was decoded"
+    encoder.table.decode = no_decode
+
+    agent0.position = (0, 1)
+    next_state, added, deleted = encoder.sync(rail_env, state)
+    # Only the cells left and entered are visited, and the other literals
+    # are shared through the table of the BitsetState
+    assert sorted(set(visited)) == [(0, 0), (0, 1)]
+    assert next_state.table is state.table
+    assert {lit.variables[0] for lit in added | deleted if lit.variables[0].var_type == 'cell'} \
+        == {encoder.cell(0, 0), encoder.cell(0, 1)}
+    assert next_state.fluents.get('direction', [encoder.handle_to_agent[1]]) == 3
+
+    # Nothing changed
+    visited.clear()
+    assert encoder.sync(rail_env, next_state) == (next_state, set(), set())
+    assert not visited
+
+    encoder.table.decode = decode
+    assert at(encoder.handle_to_agent[0], encoder.cell(0, 1)) in next_state.literals
+    assert at(encoder.handle_to_agent[1], encoder.cell(0, 7)) in next_state.literals
+
+    print("Test passed.")
+
+
+def test_encoder_sync_matches_encode():
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    domain = PDDLDomainParser(os.path.join(dir_path, '..', 'pddl', 'flatland.pddl'),
+                              operators_as_actions=True)
+    horizontal = 0x0401
+
+    def check_encoded(rail_env, state):
+        reference = RailEnvEncoder(domain).encode(rail_env)
+        assert state.literals == reference.literals
+        assert state.goal.literals == reference.goal.literals
+        for lit in reference.literals:
+            if hasattr(lit, 'function'):
+                assert state.fluents.get(lit.function.name, lit.variables) == \
+                    reference.fluents.get(lit.function.name, lit.variables)
+
+    for compact in [False, True]:
+        # A straight east-west track of 6 cells, with agent0 heading east
+        # to c0_3 and agent1 waiting to depart west from c0_5
+        agent0 = SimpleNamespace(handle=0, position=(0, 0), direction=1, status=1, moving=True,
+                                 initial_position=(0, 0), initial_direction=1, target=(0, 3))
+        agent1 = SimpleNamespace(handle=1, position=None, direction=3, status=0, moving=False,
+                                 initial_position=(0, 5), initial_direction=3, target=(0, 1))
+        rail_env = SimpleNamespace(rail=SimpleNamespace(grid=np.full((1, 6), horizontal)),
+                                   agents=[agent0, agent1])
+        encoder = RailEnvEncoder(domain)
+        state = encoder.encode(rail_env, compact=compact)
+        assert hasattr(state, 'bits') == compact
+        check_encoded(rail_env, state)
+
+        visited = []
+        get_cell_literals = encoder._get_cell_literals
+        def spy(position):
+            visited.append(position)
+            return get_cell_literals(position)
+        encoder._get_cell_literals = spy
+
+        def move(agent, **info):
+            agent.__dict__.update(info)
+        steps = [
+            [(agent0, dict(position=(0, 1))), (agent1, dict(position=(0, 5), status=1))],
+            [(agent0, dict(position=(0, 2))), (agent1, dict(position=(0, 4), moving=True))],
+            # agent0 is taken off the grid at its target, so its cell is
+            # available again
+            [(agent0, dict(position=None, status=DONE_REMOVED, moving=False))],
+            [(agent1, dict(position=(0, 3)))],
+            [(agent1, dict(position=(0, 2), direction=1, moving=False))],
+        ]
+        for changes in steps:
+            for agent, info in changes:
+                move(agent, **info)
+            visited.clear()
+            next_state, added, deleted = encoder.sync(rail_env, state)
+            assert type(next_state) is type(state)
+            assert visited
+            assert next_state.literals == (state.literals - deleted) | added
+            check_encoded(rail_env, next_state)
+            state = next_state
+
+        at, available = domain.predicates['at'], domain.predicates['available']
+        assert at(encoder.handle_to_agent[0], encoder.cell(0, 3)) in state.literals
+        assert available(encoder.cell(0, 3)) in state.literals
+        assert available(encoder.cell(0, 2)) not in state.literals
+
+    print("Test passed.")
+
+
+def test_conditional_effects():
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    domain_file = os.path.join(dir_path, '..', 'pddl', 'flatland.pddl')
+    problem_file = os.path.join(dir_path, '..', 'pddl', 'flatland', 'problem.pddl')
+    domain = PDDLDomainParser(domain_file, operators_as_actions=True)
+    problem = PDDLProblemParser(problem_file, domain.domain_name, domain.types,
+                                domain.predicates, domain.functions, domain.actions)
+    objects = {obj.name: obj for obj in problem.objects}
+    state = State(frozenset(problem.initial_state), frozenset(problem.objects), problem.goal)
+    state = state.with_fluents(NumericFluents.from_literals(state.literals))
+    available = domain.predicates['available']
+
+    # agent0 faces north on c11 and turns left to c10, facing west
+    operator = domain.operators['move-left']
+    railway, agent, cell, next_cell = operator.params
+    assignment = {railway: objects['rail'], agent: objects['agent0'],
+                  cell: objects['c11'], next_cell: objects['c10']}
+    next_state, added, deleted = _apply_effects(state, operator.effects.literals, assignment,
+                                                return_delta=True, operator=operator)
+    assert next_state.fluents.get('direction', [objects['agent0']]) == 3
+    assert next_state.fluents.get('direction', [objects['agent1']]) == 2
+    assert {str(lit) for lit in added} == {
+        str(domain.predicates['at'](objects['agent0'], objects['c10'])),
+        str(available(objects['c11'])), 'direction = 3(agent0:agent)'}
+    assert {str(lit) for lit in deleted} == {
+        str(available(objects['c10'])), 'direction = 0(agent0:agent)'}
+    assert state.fluents.get('direction', [objects['agent0']]) == 0
+
+    # The triggered When branch is looked up by the direction of agent0
+    assert len(operator.conditional_effects._triggered_cache) == 1
+    assert _apply_effects(state, operator.effects.literals, assignment,
+                          operator=operator) == next_state
+    assert len(operator.conditional_effects._triggered_cache) == 1
+
+    # The cache keeps the most recently used contexts
+    conditional_effects = ConditionalEffects(operator.effects.literals[3:], max_cached=2)
+    for direction in [0, 1, 2, 3, 2]:
+        fluents = state.fluents.assign({('direction', (objects['agent0'],)): direction})
+        conditional_effects.apply(state.with_fluents(fluents), assignment)
+    assert [key[0] for key in conditional_effects._triggered_cache] == [3, 2]
+
+    # Without fluents, they are read from the function literals
+    assert _apply_effects(state.with_fluents(None), operator.effects.literals,
+                          assignment).literals == next_state.literals
+
+    # Moving forward keeps the direction
+    operator = domain.operators['move-forward']
+    next_state = _apply_effects(state, operator.effects.literals, assignment, operator=operator)
+    assert next_state.fluents == state.fluents
+
+    print("Test passed.")
+
 
 if __name__ == '__main__':
     # Test parser
@@ -0,0 +1,168 @@
+from pddlflatland.core import get_successor_state, InvalidAction
+from pddlflatland.inference import check_goal
+from pddlflatland.numeric import NumericFluents
+from pddlflatland.parser import PDDLDomainParser, PDDLProblemParser
+from pddlflatland.structs import State, BitsetState
+
+import itertools
+import os
+
+
+def _load_test_problem(operators_as_actions=True):
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    domain_file = os.path.join(dir_path, 'pddl', 'test_domain.pddl')
+    problem_file = os.path.join(dir_path, 'pddl', 'test_domain', 'test_problem.pddl')
+    domain = PDDLDomainParser(domain_file, operators_as_actions=operators_as_actions)
+    problem = PDDLProblemParser(problem_file, domain.domain_name, domain.types,
+        domain.predicates, domain.functions, domain.actions)
+    state = State(problem.initial_state, frozenset(problem.objects), problem.goal)
+    return domain, state
+
+
+def test_grounded_successor_state():
+    domain, state = _load_test_problem()
+    action_pred = domain.predicates['action1']
+
+    num_valid = 0
+    for objs in itertools.product(sorted(state.objects), repeat=action_pred.arity):
+        if any(o.var_type != t for o, t in zip(objs, action_pred.var_types)):
+            continue
+        action = action_pred(*objs)
+        csp_state = get_successor_state(state, action, domain, inference_mode="csp")
+        grounded_state = get_successor_state(state, action, domain, inference_mode="grounded")
+        assert csp_state == grounded_state
+        if grounded_state != state:
+            num_valid += 1
+    assert num_valid == 1
+
+    action = action_pred('a1', 'b2', 'c1', 'd1')
+    next_state = get_successor_state(state, action, domain, inference_mode="grounded")
+    assert next_state.literals == (state.literals - { domain.predicates['pred2']('c1') }) | \
+        { domain.predicates['pred3']('b2', 'd1', 'c1') }
+
+    try:
+        get_successor_state(next_state, action, domain, inference_mode="grounded",
+                            raise_error_on_invalid_action=True)
+        assert False, "Action was supposed to be invalid"
+    except InvalidAction:
+        pass
+
+    print("Test passed.")
+
+
+def test_bitset_state():
+    domain, state = _load_test_problem()
+    action_pred = domain.predicates['action1']
+    pred2 = domain.predicates['pred2']
+    pred3 = domain.predicates['pred3']
+
+    compact_state = BitsetState.from_state(state)
+    assert compact_state.literals == state.literals
+    assert compact_state.to_state() == state
+    table = compact_state.table
+    assert table.decode(table.from_array(table.to_array(compact_state.bits))) == state.literals
+
+    action = action_pred('a1', 'b2', 'c1', 'd1')
+    next_compact_state = get_successor_state(compact_state, action, domain,
+                                             inference_mode="grounded")
+    assert isinstance(next_compact_state, BitsetState)
+    next_state = get_successor_state(state, action, domain, inference_mode="grounded")
+    assert next_compact_state.literals == next_state.literals
+    # No longer applicable
+    assert get_successor_state(next_compact_state, action, domain,
+                               inference_mode="grounded") == next_compact_state
+
+    assert not check_goal(next_compact_state, state.goal)
+    goal_state = next_compact_state.with_literals(
+        next_state.literals | { pred2('c2'), pred3('b1', 'c1', 'd1') })
+    assert check_goal(goal_state, state.goal)
+    assert check_goal(goal_state.to_state(), state.goal)
+
+    print("Test passed.")
+
+
+def test_action_operators():
+    domain, state = _load_test_problem()
+    assert domain.get_action_operators(domain.predicates['action1']) == \
+        [domain.operators['action1']]
+
+    domain, state = _load_test_problem(operators_as_actions=False)
+    action_pred = domain.predicates['actionpred']
+    assert domain.get_action_operators(action_pred) == [domain.operators['action1']]
+    assert domain.get_action_operators(domain.predicates['pred1'].negative) == []
+
+    action = action_pred('b2')
+    next_state = get_successor_state(state, action, domain, inference_mode="csp")
+    assert next_state == get_successor_state(state, action, domain, inference_mode="grounded")
+    assert next_state != state
+
+    print("Test passed.")
+
+
+def test_grounded_without_numeric_preconditions():
+    domain, state = _load_test_problem()
+    action_pred = domain.predicates['action1']
+    compact_state = BitsetState.from_state(state)
+    assert state.fluents is None and compact_state.fluents is None
+
+    # The fluents are not needed to select a ground operator of a domain
+    # without numeric preconditions
+    from_literals = NumericFluents.from_literals
+    def fail(*args, **kwargs):
+        assert False, "The fluents were built"
+    NumericFluents.from_literals = fail
+    try:
+        for objs in itertools.product(sorted(state.objects), repeat=action_pred.arity):
+            if any(o.var_type != t for o, t in zip(objs, action_pred.var_types)):
+                continue
+            action = action_pred(*objs)
+            for initial_state in [state, compact_state]:
+                get_successor_state(initial_state, action, domain, inference_mode="grounded")
+    finally:
+        NumericFluents.from_literals = from_literals
+
+    print("Test passed.")
+
+
+def test_numeric_preconditions():
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    domain = PDDLDomainParser(os.path.join(dir_path, '..', 'pddl', 'flatland.pddl'),
+                              operators_as_actions=True)
+    problem = PDDLProblemParser(os.path.join(dir_path, '..', 'pddl', 'flatland', 'problem.pddl'),
+        domain.domain_name, domain.types, domain.predicates, domain.functions, domain.actions)
+    objects = {obj.name: obj for obj in problem.objects}
+    state = State(frozenset(problem.initial_state), frozenset(problem.objects), problem.goal)
+    state = state.with_fluents(NumericFluents.from_literals(state.literals))
+    move_left, move_right = domain.predicates['move-left'], domain.predicates['move-right']
+    at = domain.predicates['at']
+
+    # agent0 faces north on c11 and can only turn left to c10
+    action = move_left(objects['rail'], objects['agent0'], objects['c11'], objects['c10'])
+    invalid_action = move_right(objects['rail'], objects['agent0'], objects['c11'], objects['c10'])
+    for inference_mode in ["grounded", "infer", "csp"]:
+        for initial_state in [state, BitsetState.from_state(state)]:
+            next_state = get_successor_state(initial_state, action, domain,
+                                             inference_mode=inference_mode)
+            assert at(objects['agent0'], objects['c10']) in next_state.literals
+            assert next_state.fluents.get('direction', [objects['agent0']]) == 3
+            try:
+                get_successor_state(initial_state, invalid_action, domain,
+                                    inference_mode=inference_mode,
+                                    raise_error_on_invalid_action=True)
+                assert False, "Action was supposed to be invalid"
+            except InvalidAction:
+                pass
+    # The numeric preconditions are checked on the ground operator
+    ground_operators = domain.ground_operator_table.get_ground_operators(action, state.objects)
+    assert len(ground_operators) == 1
+    assert ground_operators[0].numeric_preconds is not None
+
+    print("Test passed.")
+
+
+if __name__ == "__main__":
+    test_grounded_successor_state()
+    test_bitset_state()
+    test_action_operators()
+    test_grounded_without_numeric_preconditions()
+    test_numeric_preconditions()
@@ -1,5 +1,9 @@
-from pddlgym.inference import find_satisfying_assignments
-from pddlgym.structs import Predicate, Type, Not
+from pddlgym.inference import find_satisfying_assignments, check_goal, QueryPlan
+from pddlgym.prolog_interface import PrologSession
+from pddlgym.structs import Predicate, Type, Not, ForAll, State
+
+import pytest
+import shutil
 
 
 def test_prover():
@@ -105,8 +109,97 @@ def test_zero_arity_negative_preconditions():
 
     print("Pass.")
 
+def test_indexed_kb_lookup():
+    CellType = Type('cell')
+    Transition = Predicate('Transition', 2, var_types=[CellType, CellType])
+    Start = Predicate('Start', 1, var_types=[CellType])
+    Blocked = Predicate('Blocked', 1, var_types=[CellType])
+    cells = [CellType('c{}'.format(i)) for i in range(50)]
+
+    # A chain c0 -> c1 -> ... -> c49
+    kb = { Transition(cells[i], cells[i+1]) for i in range(49) }
+    kb |= { Start(cells[10]), Blocked(cells[12]) }
+
+    conds = [ Start("?x0"), Transition("?x0", "?x1"), Transition("?x1", "?x2") ]
+    assignments = find_satisfying_assignments(kb, conds, max_assignment_count=10)
+    assert len(assignments) == 1
+    assert assignments[0][CellType("?x2")] == cells[12]
+
+    conds.append(Not(Blocked("?x2")))
+    assignments = find_satisfying_assignments(kb, conds, max_assignment_count=10)
+    assert len(assignments) == 0
+
+    print("Pass.")
+
+def test_query_plan():
+    CellType = Type('cell')
+    Transition = Predicate('Transition', 2, var_types=[CellType, CellType])
+    Start = Predicate('Start', 1, var_types=[CellType])
+    Blocked = Predicate('Blocked', 1, var_types=[CellType])
+    cells = [CellType('c{}'.format(i)) for i in range(50)]
+    kb = { Transition(cells[i], cells[i+1]) for i in range(49) }
+    kb |= { Start(cells[10]), Blocked(cells[12]) }
+    counts = { 'Transition' : 49, 'Start' : 1, 'Blocked' : 1 }
+
+    conds = [ Transition("?x0", "?x1"), Transition("?x1", "?x2"), Start("?x0") ]
+    plan = QueryPlan(conds, predicate_counts=counts)
+    # The start literal has the fewest facts, so it is joined first
+    assert plan.steps[0][1] == 'Start'
+    assignments = find_satisfying_assignments(kb, conds, query_plan=plan, max_assignment_count=10)
+    assert len(assignments) == 1
+    assert assignments[0][CellType("?x2")] == cells[12]
+    assert assignments == find_satisfying_assignments(kb, conds, max_assignment_count=10)
+
+    conds.append(Not(Blocked("?x2")))
+    plan = QueryPlan(conds, predicate_counts=counts)
+    assert len(plan.execute(kb, max_assignment_count=10)) == 0
+
+    # ?x1 only occurs in a negative literal, so it is bound by type
+    conds = [ Start("?x0"), Not(Transition("?x0", "?x1")) ]
+    plan = QueryPlan(conds, predicate_counts=counts)
+    assert len(plan.execute(kb, max_assignment_count=100)) == 50 - 1
+
+    print("Pass.")
+
+def test_prolog_session():
+    if shutil.which("swipl") is None:
+        pytest.skip("swipl is not installed")
+    CellType = Type('cell')
+    Transition = Predicate('Transition', 2, var_types=[CellType, CellType])
+    Start = Predicate('Start', 1, var_types=[CellType])
+    Visited = Predicate('Visited', 1, var_types=[CellType])
+    cells = [CellType('c{}'.format(i)) for i in range(8)]
+    type_to_parent_types = { CellType : { CellType } }
+    conds = [ Start("?x0"), Transition("?x0", "?x1") ]
+    goal = ForAll(Visited("?c"), [CellType("?c")])
+
+    with PrologSession() as session:
+        # The objects of the kb change between queries
+        for n in range(2, len(cells) + 1):
+            kb = { Transition(cells[i], cells[i+1]) for i in range(n - 1) }
+            kb |= { Start(cells[n - 2]) } | { Visited(c) for c in cells[:n - 1] }
+            kb = frozenset(kb)
+            answers = []
+            for prolog_session in [None, session]:
+                assignments = find_satisfying_assignments(
+                    kb, conds, type_to_parent_types=type_to_parent_types, mode="prolog",
+                    max_assignment_count=10, prolog_session=prolog_session)
+                answers.append({ frozenset(a.items()) for a in assignments })
+            assert answers[0] == answers[1]
+            assert len(answers[1]) == 1
+            for kb in [kb, kb | { Visited(cells[n - 1]) }]:
+                state = State(kb, frozenset(), goal)
+                assert check_goal(state, goal, prolog_session=session) == check_goal(state, goal)
+            assert check_goal(state, goal, prolog_session=session)
+        # Goal clauses do not depend on the objects of the kb
+        assert len(session._goal_clause_to_name) == 2
+
+    print("Pass.")
+
 if __name__ == "__main__":
     test_prover()
     test_negative_preconditions()
     test_zero_arity_negative_preconditions()
-
+    test_indexed_kb_lookup()
+    test_query_plan()
+    test_prolog_session()
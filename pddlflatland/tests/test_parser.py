@@ -1,7 +1,14 @@
-from pddlgym.parser import PDDLDomainParser, PDDLProblemParser
+from pddlgym.parser import PDDLDomainParser, PDDLProblemParser, parse_sexp, sexp_to_str
 from pddlgym.structs import Predicate, Literal, Type, Not, Anti, LiteralConjunction
+from pddlgym.core import PDDLEnv
+from pddlgym import pddl_cache
+from pddlgym.pddl_writer import ProblemWriter
+
+import numpy as np
 
 import os
+import shutil
+import tempfile
 
 def test_parser():
     dir_path = os.path.dirname(os.path.realpath(__file__))
@@ -99,6 +106,181 @@ def test_hierarchical_types():
 
     print("Test passed.")
 
+def test_parse_cache():
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        domain_file = os.path.join(tmp_dir, 'test_domain.pddl')
+        problem_dir = os.path.join(tmp_dir, 'test_domain')
+        cache_dir = os.path.join(tmp_dir, 'cache')
+        shutil.copy(os.path.join(dir_path, 'pddl', 'test_domain.pddl'), domain_file)
+        shutil.copytree(os.path.join(dir_path, 'pddl', 'test_domain'), problem_dir)
+
+        domain, problems = PDDLEnv.load_pddl(domain_file, problem_dir, operators_as_actions=True,
+                                             cache_dir=cache_dir)
+        assert len(os.listdir(cache_dir)) == 1
+        cached_domain, cached_problems = PDDLEnv.load_pddl(
+            domain_file, problem_dir, operators_as_actions=True, cache_dir=cache_dir)
+        assert len(os.listdir(cache_dir)) == 1
+        assert cached_domain is not domain
+        assert set(cached_domain.operators) == set(domain.operators)
+        assert cached_problems[0].initial_state == problems[0].initial_state
+        assert cached_problems[0].goal == problems[0].goal
+        # The problems still share the predicates of the domain
+        lit = next(iter(cached_problems[0].initial_state))
+        assert lit.predicate is cached_domain.predicates[lit.predicate.name]
+
+        # Parse options and file contents are part of the key
+        problem_files = [os.path.join(problem_dir, 'test_problem.pddl')]
+        assert pddl_cache.get_cache_key(domain_file, problem_files, operators_as_actions=True) != \
+            pddl_cache.get_cache_key(domain_file, problem_files, operators_as_actions=False)
+        with open(problem_files[0], 'a') as f:
+            f.write('\n')
+        PDDLEnv.load_pddl(domain_file, problem_dir, operators_as_actions=True,
+                          cache_dir=cache_dir)
+        assert len(os.listdir(cache_dir)) == 2
+
+    print("Test passed.")
+
+def test_parse_sexp():
+    text = "(define (domain d) ; a comment\n  (:predicates (on ?x - block)))"
+    exprs = parse_sexp(PDDLDomainParser._purge_comments(text))
+    assert exprs == [["define", ["domain", "d"], [":predicates", ["on", "?x", "-", "block"]]]]
+    assert sexp_to_str(exprs[0][2]) == "(:predicates (on ?x - block))"
+    for text in ["(and (on a b)", "(on a b))"]:
+        try:
+            parse_sexp(text)
+        except Exception as e:
+            assert type(e).__name__ == "ParseError"
+        else:
+            assert False, "Unbalanced {} parsed".format(text)
+
+    print("Test passed.")
+
+def test_parse_stream():
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    domain_file = os.path.join(dir_path, '..', 'pddl', 'flatland.pddl')
+    problem_file = os.path.join(dir_path, '..', 'pddl', 'flatland', 'problem.pddl')
+    domain = PDDLDomainParser(domain_file, operators_as_actions=True)
+    args = (problem_file, domain.domain_name, domain.types, domain.predicates,
+            domain.functions, domain.actions)
+    problem = PDDLProblemParser(*args)
+    streamed_problem = PDDLProblemParser(*args, streaming=True)
+    assert streamed_problem.problem_name == problem.problem_name
+    assert streamed_problem.objects == problem.objects
+    assert streamed_problem.initial_state == problem.initial_state
+    assert streamed_problem.goal.pddl_str() == problem.goal.pddl_str()
+    assert len(streamed_problem.static_fluents) == 0
+
+    # Only the direction of agents is assigned by operators
+    static_functions = domain.get_static_functions()
+    assert static_functions == {'height', 'weight', 'position', 'status', 'transition'}
+    streamed_problem = PDDLProblemParser(*args, streaming=True, static_functions=static_functions)
+    static_lits = {lit for lit in problem.initial_state
+                   if hasattr(lit, 'function') and lit.function.name in static_functions}
+    assert streamed_problem.initial_state == problem.initial_state - static_lits
+    objects = {obj.name: obj for obj in problem.objects}
+    assert streamed_problem.static_fluents.get('position', [objects['c11']]) == 5
+    assert len(streamed_problem.static_fluents) == len(static_lits)
+
+    print("Test passed.")
+
+def test_lazy_problems():
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    domain_file = os.path.join(dir_path, 'pddl', 'test_domain.pddl')
+    problem_dir = os.path.join(dir_path, 'pddl', 'test_domain')
+    domain, problems = PDDLEnv.load_pddl(domain_file, problem_dir, operators_as_actions=True,
+                                         cache_dir=None)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        lazy_domain, lazy_problems = PDDLEnv.load_pddl(
+            domain_file, problem_dir, operators_as_actions=True, cache_dir=cache_dir,
+            lazy=True, prefetch=1)
+        assert len(lazy_problems) == len(problems)
+        assert not lazy_problems._parsed
+        for problem, lazy_problem in zip(problems, lazy_problems):
+            assert lazy_problem.initial_state == problem.initial_state
+            assert lazy_problem.goal.pddl_str() == problem.goal.pddl_str()
+        assert lazy_problems[-1] is lazy_problems[len(problems) - 1]
+        lazy_problems.close()
+
+        # Problems loaded from the cache share the predicates of the domain
+        lazy_domain, lazy_problems = PDDLEnv.load_pddl(
+            domain_file, problem_dir, operators_as_actions=True, cache_dir=cache_dir, lazy=True)
+        lit = next(iter(lazy_problems[0].initial_state))
+        assert lit.predicate is lazy_domain.predicates[lit.predicate.name]
+
+    print("Test passed.")
+
+def test_lazy_problems_random_access():
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    domain_file = os.path.join(dir_path, 'pddl', 'test_domain.pddl')
+    problem_file = os.path.join(dir_path, 'pddl', 'test_domain', 'test_problem.pddl')
+    with tempfile.TemporaryDirectory() as problem_dir:
+        for i in range(8):
+            shutil.copy(problem_file, os.path.join(problem_dir, 'problem{}.pddl'.format(i)))
+        prefetch = 2
+        _, lazy_problems = PDDLEnv.load_pddl(domain_file, problem_dir, operators_as_actions=True,
+                                             cache_dir=None, lazy=True, prefetch=prefetch)
+        lazy_problems.max_parsed = 2
+        rng = np.random.RandomState(0)
+        for idx in rng.choice(len(lazy_problems), size=20):
+            lazy_problems[idx]
+            assert len(lazy_problems._futures) <= prefetch
+
+        # Draws are those of the rng, and their problems are parsed ahead
+        rng, draw_rng = np.random.RandomState(0), np.random.RandomState(0)
+        for _ in range(20):
+            idx = lazy_problems.draw(draw_rng)
+            assert idx == rng.choice(len(lazy_problems))
+            lazy_problems[idx]
+            assert set(lazy_problems._futures) <= set(lazy_problems._drawn)
+            assert len(lazy_problems._futures) <= prefetch
+        lazy_problems.close()
+
+    print("Test passed.")
+
+def test_problem_writer():
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    domain_file = os.path.join(dir_path, '..', 'pddl', 'flatland.pddl')
+    problem_file = os.path.join(dir_path, '..', 'pddl', 'flatland', 'problem.pddl')
+    domain = PDDLDomainParser(domain_file, operators_as_actions=True)
+    args = (domain.domain_name, domain.types, domain.predicates, domain.functions, domain.actions)
+    problem = PDDLProblemParser(problem_file, *args)
+    objects = frozenset(problem.objects)
+    writer = ProblemWriter(domain.domain_name)
+    # The same text as pddl_string, up to the order of the literals
+    problem_str = PDDLProblemParser.pddl_string(objects, problem.initial_state, 'myproblem',
+                                                domain.domain_name, problem.goal,
+                                                fast_downward_order=True)
+    assert sorted(writer.pddl_string(objects, problem.initial_state, problem.goal).split("\n")) \
+        == sorted(problem_str.split("\n"))
+
+    # Write the difference to a base through a file descriptor
+    writer.set_base(problem.initial_state)
+    at = domain.predicates['at']
+    old_at = next(lit for lit in problem.initial_state if getattr(lit, 'predicate', None) == at)
+    new_at = at(old_at.variables[0], min(o for o in objects
+                                         if o.var_type == 'cell' and o != old_at.variables[1]))
+    initial_state = (problem.initial_state - {old_at}) | {new_at}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fname = os.path.join(tmp_dir, 'problem.pddl')
+        fd = os.open(fname, os.O_WRONLY | os.O_CREAT)
+        try:
+            writer.write(fd, objects, initial_state, problem.goal, delta=({new_at}, {old_at}))
+        finally:
+            os.close(fd)
+        written_problem = PDDLProblemParser(fname, *args)
+    assert written_problem.initial_state == initial_state
+    assert writer.pddl_string(objects, initial_state, problem.goal) == \
+        writer.pddl_string(objects, initial_state, problem.goal, delta=({new_at}, {old_at}))
+
+    # The text of the literals is dropped when the objects change
+    assert new_at in writer._lines
+    writer.pddl_string(objects - {new_at.variables[1]}, problem.initial_state, problem.goal)
+    assert new_at not in writer._lines
+
+    print("Test passed.")
+
+
 if __name__ == "__main__":
     test_parser()
     test_hierarchical_types()
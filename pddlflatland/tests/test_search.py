@@ -0,0 +1,94 @@
+from pddlflatland.core import _apply_effects
+from pddlflatland.parser import PDDLDomainParser, PDDLProblemParser
+from pddlflatland.planning import PlanningException, run_planner, run_builtin
+from pddlflatland import planning
+from pddlflatland.search import Planner
+from pddlflatland.structs import State, LiteralConjunction
+
+import os
+
+
+def _load_problem(domain_file, problem_file):
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    domain = PDDLDomainParser(os.path.join(dir_path, domain_file), operators_as_actions=True)
+    problem = PDDLProblemParser(os.path.join(dir_path, problem_file), domain.domain_name,
+        domain.types, domain.predicates, domain.functions, domain.actions)
+    state = State(frozenset(problem.initial_state), frozenset(problem.objects), problem.goal)
+    return domain, state
+
+
+def test_flatland_planner():
+    domain, state = _load_problem(os.path.join('..', 'pddl', 'flatland.pddl'),
+                                  os.path.join('..', 'pddl', 'flatland', 'problem.pddl'))
+    at = domain.predicates['at']
+    # agent0 can only turn left to c10; agent1 goes around to c20
+    goal = LiteralConjunction([at('agent0', 'c10'), at('agent1', 'c20')])
+    state = state.with_goal(goal)
+
+    for algorithm in ["gbfs", "astar"]:
+        for heuristic in ["hff", "hadd"]:
+            planner = Planner(domain, algorithm=algorithm, heuristic=heuristic)
+            plan = planner.plan(state)
+            assert len(plan) == 5
+            task = planner.get_task(state)[0]
+
+            # Execute the plan, replanning after every step
+            next_state = state
+            for i, action in enumerate(plan):
+                operator = domain.operators[action.predicate.name]
+                assignment = dict(zip(operator.params, action.variables))
+                assert at(action.variables[1], action.variables[2]) in next_state.literals
+                next_state = _apply_effects(next_state, operator.effects.literals, assignment,
+                                            operator=operator)
+                assert len(planner.plan(next_state)) == len(plan) - i - 1
+                assert planner.get_task(next_state)[0] is task
+            assert set(goal.literals) <= next_state.literals
+
+    # The goal of the problem is unreachable for agent0
+    try:
+        Planner(domain).plan(state.with_goal(at('agent0', 'c00')))
+        assert False, "Planning was supposed to fail"
+    except PlanningException:
+        pass
+
+    print("Test passed.")
+
+
+def test_strips_planner():
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    domain_file = os.path.join(dir_path, 'pddl', 'test_domain.pddl')
+    problem_file = os.path.join(dir_path, 'pddl', 'test_domain', 'test_problem.pddl')
+    domain, state = _load_problem(domain_file, problem_file)
+    pred3 = domain.predicates['pred3']
+
+    planner = Planner(domain, algorithm="astar")
+    plan = planner.plan(state.with_goal(pred3('b2', 'd1', 'c1')))
+    assert plan == [domain.predicates['action1']('a1', 'b2', 'c1', 'd1')]
+    assert planner.plan(state.with_goal(pred3('a1', 'c1', 'd1'))) == []
+
+    # The goal of the problem needs pred1(b1)
+    try:
+        run_planner(domain_file, problem_file, "builtin-gbfs")
+        assert False, "Planning was supposed to fail"
+    except PlanningException:
+        pass
+
+    # Plan from states without a problem file, reusing the planner of the
+    # domain file
+    goal_state = state.with_goal(pred3('b2', 'd1', 'c1'))
+    assert run_builtin(domain_file, None, state=goal_state) == plan
+    planners = dict(planning._BUILTIN_PLANNERS)
+    assert run_planner(domain_file, None, "builtin-gbfs", state=goal_state) == plan
+    assert planning._BUILTIN_PLANNERS == planners
+    try:
+        run_builtin(domain_file, None)
+        assert False, "Planning was supposed to fail"
+    except PlanningException:
+        pass
+
+    print("Test passed.")
+
+
+if __name__ == "__main__":
+    test_flatland_planner()
+    test_strips_planner()
@@ -1,12 +1,25 @@
-from pddlgym.parser import PDDLDomainParser, PDDLProblemParser
-from pddlgym.structs import Predicate, Literal, Type, Not, Anti, LiteralConjunction, State
-from pddlgym.spaces import LiteralSpace
-from pddlgym.core import PDDLEnv
+from pddlflatland.parser import PDDLDomainParser, PDDLProblemParser
+from pddlflatland.structs import Predicate, Literal, Type, Not, Anti, LiteralConjunction, State
+from pddlflatland.spaces import LiteralSpace, LiteralActionSpace, create_downward_task
+from pddlflatland.core import PDDLEnv, get_successor_state
 
 import os
 import time
 
 
+def _load_test_space():
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    domain_file = os.path.join(dir_path, 'pddl', 'test_domain.pddl')
+    problem_dir = os.path.join(dir_path, 'pddl', 'test_domain')
+    domain, problems = PDDLEnv.load_pddl(domain_file, problem_dir, operators_as_actions=True)
+    problem = problems[0]
+    state = State(frozenset(problem.initial_state), frozenset(problem.objects), problem.goal)
+    action_predicates = [domain.predicates[a] for a in domain.actions]
+    space = LiteralActionSpace(domain, action_predicates,
+        type_to_parent_types=domain.type_to_parent_types)
+    return domain, state, space
+
+
 def test_hierarchical_spaces():
     dir_path = os.path.dirname(os.path.realpath(__file__))
     domain_file = os.path.join(dir_path, 'pddl', 'hierarchical_type_test_domain.pddl')
@@ -120,6 +133,92 @@ def test_dynamic_action_space(verbose=False):
     print("Test passed.")
 
 
+def test_downward_task():
+    domain, state, space = _load_test_space()
+    task = create_downward_task(domain, state)
+    file_task = space._load_downward_task(state)
+    assert sorted(map(str, task.objects)) == sorted(map(str, file_task.objects))
+    assert sorted(map(str, task.init)) == sorted(map(str, file_task.init))
+    assert [a.name for a in task.actions] == [a.name for a in file_task.actions] == ['action1']
+
+    assert space._compute_all_ground_literals(state) == \
+        { domain.predicates['action1']('a1', 'b2', 'c1', 'd1') }
+
+    print("Test passed.")
+
+
+def test_incremental_applicable():
+    domain, state, space = _load_test_space()
+    action1, pred2 = domain.predicates['action1'], domain.predicates['pred2']
+    assert space.all_ground_literals(state) == { action1('a1', 'b2', 'c1', 'd1') }
+
+    # Update from the delta of a step
+    next_state, added, deleted = get_successor_state(state, action1('a1', 'b2', 'c1', 'd1'),
+        domain, inference_mode="grounded", return_delta=True)
+    space.update_applicable(state, next_state, added, deleted)
+    assert space._synced_state is next_state
+    assert space.all_ground_literals(next_state) == set()
+
+    # Update from a state that was not reached by a step
+    other_state = next_state.with_literals(next_state.literals | { pred2('c1') })
+    assert space.all_ground_literals(other_state) == { action1('a1', 'b2', 'c1', 'd1') }
+    assert space.all_ground_literals(next_state) == set()
+    # A stale update is ignored
+    space.update_applicable(state, other_state, deleted, added)
+    assert space.all_ground_literals(next_state) == set()
+
+    print("Test passed.")
+
+
+def test_action_mask():
+    domain, state, space = _load_test_space()
+    action = domain.predicates['action1']('a1', 'b2', 'c1', 'd1')
+    mask = space.action_mask(state)
+    assert mask.dtype == bool and mask.sum() == 1
+    assert space.index_to_literal(mask.argmax()) == action
+    assert space.literal_to_index(action) == mask.argmax()
+    assert space.sample(state) == action
+
+    next_state = get_successor_state(state, action, domain, inference_mode="grounded")
+    assert not space.action_mask(next_state).any()
+
+    print("Test passed.")
+
+
+def test_lazy_literal_space():
+    RailwayType, AgentType, CellType = Type('railway'), Type('agent'), Type('cell')
+    Move = Predicate('move', 4, var_types=[RailwayType, AgentType, CellType, CellType])
+    At = Predicate('at', 2, var_types=[AgentType, CellType])
+    objects = [RailwayType('r')] + [AgentType('a{}'.format(i)) for i in range(10)] + \
+        [CellType('c{}_{}'.format(i, j)) for i in range(50) for j in range(50)]
+    state = State(frozenset(), frozenset(objects), None)
+
+    # Too many literals to enumerate
+    space = LiteralSpace([Move, At], lit_valid_test=lambda state, lit: lit.predicate == Move)
+    space.seed(0)
+    move = space.sample(state)
+    assert move.predicate == Move
+    assert space.num_ground_literals == 10 * 2500 * 2500 + 10 * 2500
+    index = space.literal_to_index(move)
+    assert space.index_to_literal(index) == move
+
+    # Indices follow the product of the sorted objects of each type
+    assert space.literal_to_index(At('a0', 'c0_0')) == 0
+    assert space.index_to_literal(1) == At('a0', 'c0_1')
+    assert space.index_to_literal(10 * 2500) == Move('r', 'a0', 'c0_0', 'c0_0')
+
+    # Literals that repeat an object are not valid
+    space = LiteralSpace([At, Move], lit_valid_test=lambda state, lit: True)
+    state = State(frozenset(), frozenset(objects[:1] + objects[1:3] + objects[11:14]), None)
+    mask = space.action_mask(state)
+    assert len(mask) == space.num_ground_literals == 2 * 3 + 2 * 3 * 3
+    assert {space.index_to_literal(i) for i in mask.nonzero()[0]} == \
+        space.all_ground_literals(state, valid_only=False)
+    assert mask.sum() == 2 * 3 + 2 * 3 * 2
+
+    print("Test passed.")
+
+
 if __name__ == "__main__":
     # test_hierarchical_spaces()
     # test_dynamic_literal_action_space(verbose=False)
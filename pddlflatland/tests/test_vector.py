@@ -0,0 +1,78 @@
+from pddlflatland.vector import BatchedPDDLEnv, SubprocVecPDDLEnv
+from pddlflatland.core import PDDLEnv, get_successor_state
+from pddlflatland.inference import check_goal
+
+import functools
+import numpy as np
+import os
+
+
+def test_batched_env():
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    domain_file = os.path.join(dir_path, 'pddl', 'test_domain.pddl')
+    problem_dir = os.path.join(dir_path, 'pddl', 'test_domain')
+    num_envs = len(BatchedPDDLEnv(domain_file, problem_dir, 1).actions)
+    env = BatchedPDDLEnv(domain_file, problem_dir, num_envs)
+    obs = env.reset()
+    assert obs.shape == (num_envs, env.num_atoms)
+    state = env.get_state(0)
+    assert state.literals == env.initial_state.literals
+
+    # Take every action once, in a different episode each
+    actions = np.arange(num_envs)
+    mask = env.get_action_mask()
+    assert mask.shape == (num_envs, len(env.actions))
+    obs, rewards, dones, applicable = env.step(actions)
+    assert applicable.sum() == 1
+    assert (applicable == mask[0]).all()
+    for i, action in enumerate(env.actions):
+        expected = get_successor_state(state, action, env.domain, inference_mode="csp")
+        assert env.get_state(i).literals == expected.literals
+        assert dones[i] == check_goal(expected, state.goal)
+        assert rewards[i] == float(dones[i])
+
+    env.reset(applicable)
+    assert (env.get_observations() == env.reset()).all()
+
+    # No applicable action in a state where the only action was taken
+    env.step(np.full(num_envs, np.flatnonzero(applicable)[0]))
+    assert (env.sample_actions() == -1).all()
+
+    print("Test passed.")
+
+
+def test_subproc_vec_env():
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    domain_file = os.path.join(dir_path, 'pddl', 'test_domain.pddl')
+    problem_dir = os.path.join(dir_path, 'pddl', 'test_domain')
+    env_fn = functools.partial(PDDLEnv, domain_file, problem_dir, operators_as_actions=True)
+    env = env_fn()
+    state, _ = env.reset()
+    action_pred = env.domain.predicates['action1']
+    valid_action = action_pred('a1', 'b2', 'c1', 'd1')
+    invalid_action = action_pred('a2', 'b2', 'c1', 'd1')
+    next_state = get_successor_state(state, valid_action, env.domain)
+
+    vec_env = SubprocVecPDDLEnv([env_fn, env_fn], ring_size=2)
+    try:
+        obs, _ = vec_env.reset()
+        assert len(obs) == 2
+        for i in range(2):
+            assert vec_env.get_state(i) == state
+        for _ in range(3):
+            vec_env.step_async([valid_action, invalid_action])
+            obs, rewards, dones, infos = vec_env.step_wait()
+            assert vec_env.decode(0, obs[0]) == next_state.literals
+            assert vec_env.get_state(1).literals == state.literals
+            assert not dones.any() and (rewards == 0).all()
+            # Back to the initial state
+            vec_env.reset()
+    finally:
+        vec_env.close()
+
+    print("Test passed.")
+
+
+if __name__ == "__main__":
+    test_batched_env()
+    test_subproc_vec_env()
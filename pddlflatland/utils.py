@@ -10,6 +10,7 @@ import sys
 import itertools
 import numpy as np
 import os
+import tempfile
 import gym
 import imageio
 
@@ -99,17 +100,21 @@ def run_planning_demo(env, planner_name, outdir='/tmp', fps=3, verbose=False, se
         env.seed(seed)
 
     obs, debug_info = env.reset()
-    plan = run_planner(debug_info['domain_file'], debug_info['problem_file'], planner_name)
+    plan = _run_planner(env, planner_name, debug_info['domain_file'], obs, debug_info)
 
     actions = []
     for s in plan:
-        a = parse_plan_step(
-                s,
-                env.domain.operators.values(),
-                env.action_predicates,
-                obs.objects,
-                operators_as_actions=env.operators_as_actions
-            )
+        if not isinstance(s, str):
+            # From the builtin planners
+            a = s
+        else:
+            a = parse_plan_step(
+                    s,
+                    env.domain.operators.values(),
+                    env.action_predicates,
+                    obs.objects,
+                    operators_as_actions=env.operators_as_actions
+                )
         actions.append(a)
 
     tot_reward = 0.
@@ -141,6 +146,22 @@ def run_planning_demo(env, planner_name, outdir='/tmp', fps=3, verbose=False, se
     return tot_reward
 
 
+def _run_planner(env, planner_name, domain_file, obs, debug_info):
+    """Helper for the planning demos. The builtin planners plan from obs
+    in this process; the others get a problem file, which is written from
+    the state of envs that have none (see PDDLFlatlandEnv.write_problem).
+    """
+    if planner_name.startswith('builtin-'):
+        return run_planner(domain_file, debug_info['problem_file'], planner_name, state=obs,
+                           operators_as_actions=env.operators_as_actions)
+    if debug_info['problem_file'] is None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            problem_file = os.path.join(tmp_dir, 'problem.pddl')
+            env.write_problem(problem_file)
+            return run_planner(domain_file, problem_file, planner_name)
+    return run_planner(domain_file, debug_info['problem_file'], planner_name)
+
+
 def run_probabilistic_planning_demo(env, planner_name, verbose=False, num_epi=20, outdir='/tmp', fps=3):
     """Probabilistic planning via simple determinization.
     """
@@ -166,17 +187,21 @@ def run_probabilistic_planning_demo(env, planner_name, verbose=False, num_epi=20
         domain.determinize()
         domain.write("/tmp/domain.pddl")
 
-        plan = run_planner("/tmp/domain.pddl", debug_info['problem_file'], planner_name)
+        plan = _run_planner(env, planner_name, "/tmp/domain.pddl", obs, debug_info)
 
         actions = []
         for s in plan:
-            a = parse_plan_step(
-                    s,
-                    env.domain.operators.values(),
-                    env.action_predicates,
-                    obs.objects,
-                    operators_as_actions=env.operators_as_actions
-                )
+            if not isinstance(s, str):
+                # From the builtin planners
+                a = s
+            else:
+                a = parse_plan_step(
+                        s,
+                        env.domain.operators.values(),
+                        env.action_predicates,
+                        obs.objects,
+                        operators_as_actions=env.operators_as_actions
+                    )
             actions.append(a)
 
         tot_reward = 0.
@@ -0,0 +1,439 @@
+"""Vectorized environments that step many episodes of one domain at once.
+
+BatchedPDDLEnv keeps the states of N episodes of one PDDL problem as rows of
+a NumPy bool array over the atoms of a common grounding. Every ground action
+is compiled into index arrays of its preconditions and effects, so checking
+applicability, executing effects and testing the goal for all N episodes
+are a few fancy-indexing operations per step instead of N Python-level
+successor computations.
+
+SubprocVecPDDLEnv is for domains whose inference cannot be vectorized (e.g.
+Prolog). It steps one PDDLEnv or PDDLFlatlandEnv per persistent worker
+process. Observations are passed back as integer literal ids through
+shared memory instead of pickled States.
+"""
+from pddlflatland.core import PDDLEnv, _check_domain_for_strips
+from pddlflatland.structs import (Literal, LiteralConjunction, State, AtomTable,
+                                  ground_literal)
+from pddlflatland.spaces import LiteralActionSpace, _pad
+from multiprocessing import shared_memory
+
+import multiprocessing
+import numpy as np
+
+
+class BatchedPDDLEnv(object):
+    """N episodes of one PDDL problem, stepped together.
+
+    Only deterministic STRIPS domains without derived predicates are
+    supported, with operators as actions. Actions are indices into
+    self.actions; observations are bool arrays indexed by atom id (see
+    self.atoms). As in PDDLEnv, an action whose preconditions do not hold
+    leaves the state unchanged. Episodes are not reset automatically.
+
+    Parameters
+    ----------
+    domain_file : str
+        Path to a PDDL domain file.
+    problem_dir : str
+        Path to a directory of PDDL problem files.
+    num_envs : int
+    problem_index : int
+        The problem used by all episodes. See PDDLEnv.load_pddl.
+    seed : int
+        Random seed used by self.sample_actions.
+    """
+
+    def __init__(self, domain_file, problem_dir, num_envs, problem_index=0, seed=0):
+        self.num_envs = num_envs
+        self.domain, problems = PDDLEnv.load_pddl(domain_file, problem_dir,
+                                                  operators_as_actions=True)
+        if not _check_domain_for_strips(self.domain) or self.domain.is_probabilistic or \
+                any(p.is_derived for p in self.domain.predicates.values()):
+            raise NotImplementedError("Only deterministic STRIPS domains can be batched")
+        self._problem = problems[problem_index]
+        self.initial_state = State(frozenset(self._problem.initial_state),
+                                   frozenset(self._problem.objects),
+                                   self._problem.goal)
+        self.seed(seed)
+
+        # Ground actions and their preconditions, see LiteralActionSpace
+        action_predicates = [self.domain.predicates[a] for a in self.domain.actions]
+        action_space = LiteralActionSpace(self.domain, action_predicates,
+                                          type_to_parent_types=self.domain.type_to_parent_types)
+        self.actions, precond_atoms, pos_preconds, neg_preconds = \
+            action_space.precondition_arrays(self.initial_state)
+        self.action_to_index = {a: i for i, a in enumerate(self.actions)}
+
+        self.table = AtomTable(sorted(self.initial_state.literals))
+        precond_ids = [self.table.intern(lit) for lit in precond_atoms]
+        add_effects, delete_effects = [], []
+        for action in self.actions:
+            adds, deletes = self._get_ground_effects(action)
+            add_effects.append(self._intern(adds))
+            delete_effects.append(self._intern(deletes))
+        goal_pos, goal_neg = self._get_goal_literals(self.initial_state.goal)
+        goal_pos, goal_neg = self._intern(goal_pos), self._intern(goal_neg)
+
+        # Two sentinel columns after the atoms pad the index arrays: one
+        # is always true and one is always false
+        self.num_atoms = len(self.table)
+        self._true_column, self._false_column = self.num_atoms, self.num_atoms + 1
+        # The precondition arrays of the action space are padded with its
+        # own sentinel columns, which map to these
+        columns = np.array(precond_ids + [self._true_column, self._false_column],
+                           dtype=np.int64)
+        self._pos_preconds = columns[pos_preconds]
+        self._neg_preconds = columns[neg_preconds]
+        self._add_effects = _pad(add_effects, self._true_column)
+        self._delete_effects = _pad(delete_effects, self._false_column)
+        self._goal_pos = np.array(goal_pos, dtype=np.int64)
+        self._goal_neg = np.array(goal_neg, dtype=np.int64)
+
+        self._initial_row = np.zeros(self.num_atoms + 2, dtype=bool)
+        self._initial_row[[self.table.intern(lit) for lit in self.initial_state.literals]] = True
+        self._initial_row[self._true_column] = True
+        self._states = np.tile(self._initial_row, (num_envs, 1))
+
+    @property
+    def atoms(self):
+        """The ground literals, indexed by atom id.
+        """
+        return [self.table.atom(i) for i in range(self.num_atoms)]
+
+    def seed(self, seed):
+        self._seed = seed
+        self.rng = np.random.RandomState(seed)
+
+    def reset(self, env_indices=None):
+        """Reset some or all episodes to the initial state.
+
+        Parameters
+        ----------
+        env_indices : np.ndarray or None
+            Indices or bool mask of the episodes to reset; all if None.
+
+        Returns
+        -------
+        obs : np.ndarray
+            (num_envs, num_atoms) bool array.
+        """
+        if env_indices is None:
+            self._states[:] = self._initial_row
+        else:
+            self._states[env_indices] = self._initial_row
+        return self.get_observations()
+
+    def step(self, actions):
+        """Take one action in each episode.
+
+        Parameters
+        ----------
+        actions : np.ndarray
+            (num_envs,) int array of indices into self.actions. Negative
+            entries leave the state unchanged.
+
+        Returns
+        -------
+        obs : np.ndarray
+            (num_envs, num_atoms) bool array.
+        rewards : np.ndarray
+            1 where the goal is reached and 0 otherwise.
+        dones : np.ndarray
+            True where the goal is reached.
+        applicable : np.ndarray
+            True where the preconditions of the action held.
+        """
+        actions = np.asarray(actions, dtype=np.int64)
+        assert actions.shape == (self.num_envs,)
+        rows = np.arange(self.num_envs)[:, None]
+        applicable = self._states[rows, self._pos_preconds[actions]].all(axis=1) & \
+            ~self._states[rows, self._neg_preconds[actions]].any(axis=1) & \
+            (actions >= 0)
+        rows = np.flatnonzero(applicable)[:, None]
+        applied_actions = actions[applicable]
+        # Delete then add, as in core._apply_effects
+        self._states[rows, self._delete_effects[applied_actions]] = False
+        self._states[rows, self._add_effects[applied_actions]] = True
+        dones = self._is_goal_reached()
+        return self.get_observations(), dones.astype(np.float64), dones, applicable
+
+    def get_observations(self):
+        return self._states[:, :self.num_atoms].copy()
+
+    def get_state(self, env_index):
+        """Decode the state of one episode into a State.
+        """
+        literals = frozenset(self.table.atom(i)
+                             for i in np.flatnonzero(self._states[env_index, :self.num_atoms]))
+        return self.initial_state.with_literals(literals)
+
+    def get_action_mask(self):
+        """Get a (num_envs, num_actions) bool array of the applicable actions.
+        """
+        return self._states[:, self._pos_preconds].all(axis=-1) & \
+            ~self._states[:, self._neg_preconds].any(axis=-1)
+
+    def sample_actions(self):
+        """Sample one applicable action per episode, uniformly at random.
+
+        Returns
+        -------
+        actions : np.ndarray
+            (num_envs,) int array; -1 where no action is applicable.
+        """
+        mask = self.get_action_mask()
+        scores = np.where(mask, self.rng.random_sample(mask.shape), -1.)
+        actions = scores.argmax(axis=1)
+        actions[~mask.any(axis=1)] = -1
+        return actions
+
+    def _is_goal_reached(self):
+        return self._states[:, self._goal_pos].all(axis=1) & \
+            ~self._states[:, self._goal_neg].any(axis=1)
+
+    def _intern(self, literals):
+        return sorted(self.table.intern(lit) for lit in literals)
+
+    def _get_ground_effects(self, action):
+        operator = self.domain.get_action_operators(action.predicate)[0]
+        if isinstance(operator.effects, Literal):
+            lifted_effects = [operator.effects]
+        else:
+            lifted_effects = operator.effects.literals
+        subs = dict(zip(operator.params, action.variables))
+        subs.update({c: c for c in self.domain.constants})
+        adds, deletes = set(), set()
+        for lifted_effect in lifted_effects:
+            if not isinstance(lifted_effect, Literal):
+                raise NotImplementedError("Only literal effects can be batched")
+            effect = ground_literal(lifted_effect, subs)
+            if effect.is_anti:
+                deletes.add(effect.inverted_anti)
+            else:
+                adds.add(effect)
+        return adds, deletes
+
+    @staticmethod
+    def _get_goal_literals(goal):
+        if isinstance(goal, Literal):
+            literals = [goal]
+        elif isinstance(goal, LiteralConjunction) and \
+                all(isinstance(lit, Literal) for lit in goal.literals):
+            literals = goal.literals
+        else:
+            raise NotImplementedError("Only conjunctive goals can be batched")
+        return ([lit for lit in literals if not lit.is_negative],
+                [lit.positive for lit in literals if lit.is_negative])
+
+
+class SubprocVecPDDLEnv(object):
+    """Steps several envs in persistent worker processes.
+
+    Each worker creates its env once, so the domain and problems are
+    parsed once per worker. A worker interns the literals of its states
+    in its own AtomTable and writes the ids of each observation into its
+    slot of a shared memory ring buffer; only literals that the worker
+    has not interned before are pickled. Episodes are reset automatically
+    when done; the ids of the final observation are then given in the
+    info dict under "terminal_observation".
+
+    Parameters
+    ----------
+    env_fns : [ fn ]
+        Picklable functions (e.g. functools.partial(PDDLEnv, ...)) that
+        create the env of each worker.
+    seed : int
+        Worker i is seeded with seed + i. See PDDLEnv.seed.
+    ring_size : int
+        Number of observation slots per worker, written round-robin.
+    max_literals : int
+        Capacity of a slot. Larger observations are pickled instead.
+    start_method : str or None
+        See multiprocessing.get_context.
+    """
+
+    def __init__(self, env_fns, seed=0, ring_size=4, max_literals=4096, start_method=None):
+        assert ring_size >= 2
+        self.num_envs = len(env_fns)
+        self._ring_size = ring_size
+        self._max_literals = max_literals
+        # Mirrors of the AtomTables of the workers
+        self._atoms = [[] for _ in env_fns]
+        # Objects and goal of the current problem of each worker
+        self._problems = [None for _ in env_fns]
+        self._obs = [None for _ in env_fns]
+        self._waiting = False
+        self._closed = False
+
+        ctx = multiprocessing.get_context(start_method)
+        self._buffers, self._remotes, self._processes = [], [], []
+        for env_fn in env_fns:
+            shm = shared_memory.SharedMemory(create=True,
+                                             size=ring_size * (max_literals + 1) * 4)
+            remote, work_remote = ctx.Pipe()
+            process = ctx.Process(target=_worker, daemon=True,
+                                  args=(work_remote, remote, env_fn, shm.name,
+                                        ring_size, max_literals))
+            process.start()
+            work_remote.close()
+            self._buffers.append((shm, np.ndarray((ring_size, max_literals + 1),
+                                                  dtype=np.int32, buffer=shm.buf)))
+            self._remotes.append(remote)
+            self._processes.append(process)
+        self.seed(seed)
+
+    def seed(self, seed):
+        for i, remote in enumerate(self._remotes):
+            remote.send(("seed", seed + i))
+
+    def reset(self):
+        """Reset all envs.
+
+        Returns
+        -------
+        obs : [ np.ndarray ]
+            The literal ids of each observation, see self.get_state.
+        infos : [ dict ]
+        """
+        for remote in self._remotes:
+            remote.send(("reset", None))
+        results = [self._receive(i) for i in range(self.num_envs)]
+        return [r[0] for r in results], [r[3] for r in results]
+
+    def step_async(self, actions):
+        """Send one action (a Literal) to each env.
+        """
+        assert not self._waiting
+        for remote, action in zip(self._remotes, actions):
+            remote.send(("step", action))
+        self._waiting = True
+
+    def step_wait(self):
+        """Wait for the results of step_async.
+
+        Returns
+        -------
+        obs : [ np.ndarray ]
+        rewards : np.ndarray
+        dones : np.ndarray
+        infos : [ dict ]
+        """
+        assert self._waiting
+        results = [self._receive(i) for i in range(self.num_envs)]
+        self._waiting = False
+        obs, rewards, dones, infos = zip(*results)
+        return list(obs), np.array(rewards), np.array(dones), list(infos)
+
+    def step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+    def decode(self, env_index, ids):
+        """Get the literals with the given ids of one worker.
+        """
+        atoms = self._atoms[env_index]
+        return frozenset(atoms[i] for i in ids)
+
+    def get_state(self, env_index, ids=None):
+        """Decode an observation of one env (the last one if ids is None)
+        into a State.
+        """
+        if ids is None:
+            ids = self._obs[env_index]
+        objects, goal = self._problems[env_index]
+        return State(self.decode(env_index, ids), objects, goal)
+
+    def close(self):
+        if self._closed:
+            return
+        if self._waiting:
+            for i in range(self.num_envs):
+                self._receive(i)
+        for remote in self._remotes:
+            remote.send(("close", None))
+        for process in self._processes:
+            process.join()
+        shms = [shm for shm, _ in self._buffers]
+        self._buffers = None
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+        self._closed = True
+
+    def _receive(self, env_index):
+        """Receive a result from a worker; see _worker.
+        """
+        slot, reward, done, info, new_atoms, problem = self._remotes[env_index].recv()
+        self._atoms[env_index].extend(new_atoms)
+        if problem is not None:
+            self._problems[env_index] = problem
+        if isinstance(slot, int):
+            buf = self._buffers[env_index][1]
+            obs = buf[slot, 1:buf[slot, 0] + 1].copy()
+        else:
+            obs = slot
+        self._obs[env_index] = obs
+        return obs, reward, done, info
+
+
+def _worker(remote, parent_remote, env_fn, shm_name, ring_size, max_literals):
+    """Worker loop of SubprocVecPDDLEnv.
+
+    Every reset or step is answered with (slot, reward, done, info,
+    new_atoms, problem), where slot is the ring buffer slot of the
+    observation or an array of ids if it did not fit, new_atoms are the
+    atoms interned since the last answer and problem is (objects, goal)
+    if it changed.
+    """
+    parent_remote.close()
+    env = env_fn()
+    shm = shared_memory.SharedMemory(name=shm_name)
+    buf = np.ndarray((ring_size, max_literals + 1), dtype=np.int32, buffer=shm.buf)
+    table = AtomTable()
+    num_sent_atoms = 0
+    slot = 0
+    problem = None
+
+    def encode(state):
+        return np.array([table.intern(lit) for lit in state.literals], dtype=np.int32)
+
+    def send(state, reward, done, info):
+        nonlocal num_sent_atoms, slot, problem
+        ids = encode(state)
+        if len(ids) <= max_literals:
+            buf[slot, 0] = len(ids)
+            buf[slot, 1:len(ids) + 1] = ids
+            obs = slot
+            slot = (slot + 1) % ring_size
+        else:
+            obs = ids
+        new_atoms = [table.atom(i) for i in range(num_sent_atoms, len(table))]
+        num_sent_atoms = len(table)
+        new_problem = None
+        if problem is None or state.goal is not problem[1] or state.objects != problem[0]:
+            problem = new_problem = (state.objects, state.goal)
+        remote.send((obs, reward, done, info, new_atoms, new_problem))
+
+    try:
+        while True:
+            cmd, data = remote.recv()
+            if cmd == "step":
+                state, reward, done, info = env.step(data)
+                if done:
+                    info = dict(info, terminal_observation=encode(state))
+                    state, _ = env.reset()
+                send(state, reward, done, info)
+            elif cmd == "reset":
+                state, info = env.reset()
+                send(state, 0., False, info)
+            elif cmd == "seed":
+                env.seed(data)
+            elif cmd == "close":
+                break
+            else:
+                raise NotImplementedError(cmd)
+    finally:
+        del buf
+        shm.close()
+        env.close()